@@ -0,0 +1,213 @@
+"""
+Batched training of tagging adapters with gradient accumulation and mixed
+precision, shared by the training scripts
+"""
+
+import argparse
+import logging
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Callable, NamedTuple
+
+import torch
+from torch import nn
+
+from length_bucketing import BucketBatchSampler
+
+logger = logging.getLogger(__file__)
+
+# label id of padded tokens, ignored by the loss and the evaluation
+ignore_label: int = -100
+
+
+class TrainingSettings(NamedTuple):
+    # sequences per forward pass, padded to the longest one of the batch;
+    # 1 keeps the recipe (learning rates, epochs) the adapters were trained
+    # with, larger batches need a larger learning rate
+    batch_size: int = 1
+    # batches per optimizer step, the effective batch size is
+    # batch_size * accumulation_steps
+    accumulation_steps: int = 1
+    # autocast the forward passes to bfloat16
+    bf16: bool = False
+    # DataLoader worker processes, 0 to load batches in the training process
+    num_workers: int = 0
+    # page-locked batches for faster copies to the GPU
+    pin_memory: bool = False
+    # sequences per forward pass in evaluation
+    eval_batch_size: int = 64
+
+
+def add_training_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the command line options of TrainingSettings to a parser.
+    """
+    defaults = TrainingSettings()
+    parser.add_argument('--batch-size', type=int, default=defaults.batch_size,
+                        help=f"sequences per batch (optional, default {defaults.batch_size})")
+    parser.add_argument('--accumulation-steps', type=int, default=defaults.accumulation_steps,
+                        help="batches per optimizer step (optional, default "
+                             f"{defaults.accumulation_steps})")
+    parser.add_argument('--bf16', action='store_true',
+                        help="bfloat16 autocast of the forward passes, also on the CPU")
+    parser.add_argument('--workers', type=int, default=defaults.num_workers,
+                        help="DataLoader worker processes (optional, default "
+                             f"{defaults.num_workers})")
+    parser.add_argument('--pin-memory', action='store_true',
+                        help="page-locked batches for faster copies to the GPU")
+    parser.add_argument('--eval-batch-size', type=int, default=defaults.eval_batch_size,
+                        help="sequences per batch in evaluation (optional, default "
+                             f"{defaults.eval_batch_size})")
+
+
+def settings_from_arguments(args: argparse.Namespace) -> TrainingSettings:
+    return TrainingSettings(batch_size=args.batch_size,
+                            accumulation_steps=args.accumulation_steps, bf16=args.bf16,
+                            num_workers=args.workers, pin_memory=args.pin_memory,
+                            eval_batch_size=args.eval_batch_size)
+
+
+def bucketed_dataloader(dataset, collate: Callable[[list[dict]], dict], batch_size: int = 1,
+                        shuffle: bool = False,
+                        settings: TrainingSettings = TrainingSettings()
+                        ) -> torch.utils.data.DataLoader:
+    """
+    DataLoader with batches of sequences of similar length, padded to the
+    longest one by collate.
+    :param dataset: dataset with an input_ids column
+    """
+    lengths = [len(ids) for ids in dataset.with_format(None)["input_ids"]]
+    sampler = BucketBatchSampler(lengths, batch_size, shuffle=shuffle)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=collate,
+                                       num_workers=settings.num_workers,
+                                       pin_memory=settings.pin_memory,
+                                       persistent_workers=settings.num_workers > 0)
+
+
+class TrainingEngine:
+    """
+    Trains a token tagger for epochs of batches and evaluates it. The model
+    is called through forward, which maps a batch (on the device) to logits
+    of shape (batch, sequence, labels); labels of padded tokens are
+    ignore_label.
+
+    Several taggers sharing a forward pass (e.g. parallel adapters) are
+    trained together when forward returns a dict of logits per task; the
+    labels of a task are the batch column <task>_labels then, and the loss
+    of a batch is the sum of the task losses.
+
+    Usage:
+        engine = TrainingEngine(forward, loss_function, optimizer, settings, device)
+        for epoch in range(epochs):
+            engine.train_epoch(train_dataloader)
+            dev_loss, predicted, expected = engine.evaluate(dev_dataloader)
+            # or with a dict of logits per task
+            for task, (dev_loss, predicted, expected) in engine.evaluate_tasks(
+                    dev_dataloader).items():
+                ...
+    """
+
+    def __init__(self, forward: Callable[[dict], torch.Tensor | dict[str, torch.Tensor]],
+                 loss_function: nn.Module,
+                 optimizer: torch.optim.Optimizer | None, settings: TrainingSettings,
+                 device: str):
+        """
+        :param loss_function: loss of flattened logits and labels, it has to
+            ignore the label ignore_label
+        :param optimizer: optimizer of the trained parameters, None if the
+            engine only evaluates
+        """
+        self.forward = forward
+        self.loss_function = loss_function
+        self.optimizer = optimizer
+        self.settings = settings
+        self.device = device
+
+    def _autocast(self):
+        if not self.settings.bf16:
+            return nullcontext()
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
+
+    def _to_device(self, batch: dict) -> dict:
+        return {k: v.to(self.device, non_blocking=self.settings.pin_memory)
+                if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+
+    def _loss(self, logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        # the loss in float32, also with bf16 logits
+        return self.loss_function(torch.flatten(logits.float(), 0, 1),
+                                  torch.flatten(labels.long(), 0, 1))
+
+    @staticmethod
+    def _task_logits(logits: torch.Tensor | dict[str, torch.Tensor], batch: dict
+                     ) -> dict[str | None, tuple[torch.Tensor, torch.Tensor]]:
+        """
+        :return: logits and labels per task, the task is None for a single tagger
+        """
+        if isinstance(logits, dict):
+            return {task: (task_logits, batch[f"{task}_labels"])
+                    for task, task_logits in logits.items()}
+        return {None: (logits, batch["labels"])}
+
+    def train_epoch(self, dataloader: torch.utils.data.DataLoader, log_every: int = 100) -> float:
+        """
+        Train for one pass over the dataloader, with one optimizer step per
+        accumulation_steps batches (and one for the remaining batches).
+        :param log_every: log the loss every this many batches
+        :return: mean loss of the batches
+        """
+        accumulation_steps = self.settings.accumulation_steps
+        total_loss = 0.0
+        batches = 0
+        self.optimizer.zero_grad()
+        for i, batch in enumerate(dataloader):
+            batch = self._to_device(batch)
+            with self._autocast():
+                logits = self.forward(batch)
+            loss = sum(self._loss(task_logits, labels)
+                       for task_logits, labels in self._task_logits(logits, batch).values())
+            (loss / accumulation_steps).backward()
+            if (i + 1) % accumulation_steps == 0:
+                self.optimizer.step()
+                self.optimizer.zero_grad()
+            total_loss += loss.item()
+            batches += 1
+            if i % log_every == 0:
+                logger.info(f"batch {i}: loss {loss.item():.4f}")
+        if batches % accumulation_steps:
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+        return total_loss / max(batches, 1)
+
+    def evaluate(self, dataloader: torch.utils.data.DataLoader
+                 ) -> tuple[float, torch.Tensor, torch.Tensor]:
+        """
+        :return: mean loss of the batches, and the predicted and expected
+            labels of all tokens that are not padding, flattened
+        """
+        return self.evaluate_tasks(dataloader)[None]
+
+    def evaluate_tasks(self, dataloader: torch.utils.data.DataLoader
+                       ) -> dict[str | None, tuple[float, torch.Tensor, torch.Tensor]]:
+        """
+        Evaluate all taggers in one pass over the dataloader.
+        :return: per task (None for a single tagger) the mean loss of the
+            batches, and the predicted and expected labels of all tokens that
+            are not padding, flattened
+        """
+        losses = defaultdict(list)
+        predicted = defaultdict(list)
+        expected = defaultdict(list)
+        with torch.no_grad():
+            for batch in dataloader:
+                batch = self._to_device(batch)
+                with self._autocast():
+                    logits = self.forward(batch)
+                for task, (task_logits, labels) in self._task_logits(logits, batch).items():
+                    losses[task].append(self._loss(task_logits, labels).item())
+                    labels = labels.long()
+                    tokens = labels != ignore_label
+                    predicted[task].append(torch.argmax(task_logits, -1)[tokens])
+                    expected[task].append(labels[tokens])
+        return {task: (sum(losses[task]) / max(len(losses[task]), 1),
+                       torch.cat(predicted[task]).cpu(), torch.cat(expected[task]).cpu())
+                for task in losses}
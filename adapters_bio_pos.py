@@ -2,7 +2,6 @@ import datasets
 from datasets import load_dataset
 from adapters import AutoAdapterModel
 from transformers import AutoTokenizer, AutoConfig
-from transformers import BertModel
 from transformers import AdamW, get_linear_schedule_with_warmup
 from torch.utils.data import Dataset
 import torch
@@ -19,6 +18,11 @@ import os
 import spacy
 from spacy.tokens import Doc
 
+from adapter_training import TrainingEngine, TrainingSettings, bucketed_dataloader, ignore_label
+from adapters_bio_tags_server import align_word_labels
+from dataset_cache import load_encoded_csv
+from length_bucketing import PadCollator
+
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -44,6 +48,7 @@ os.environ["WANDB_DISABLED"] = "true"
 
 max_len_bio = 128
 batch_size = 16
+training = TrainingSettings()
 
 do_train = False
 
@@ -93,13 +98,13 @@ model.add_custom_head(head_type="pos_custom_head", head_name=task+"_head", **con
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 
 
-bert_model = BertModel.from_pretrained(model_name)
-
+# fixed random embeddings of the POS tags, looked up for every batch
 pos_embedder = nn.Embedding(len(pos_tags), pos_emb_size)
 init.normal_(pos_embedder.weight, std=0.02)
+pos_embedder.requires_grad_(False)
 
-def get_pos_embeds(tokens):
-    tags = [pos_tags['O']]
+def get_pos_embeds(tokens, word_ids):
+    word_tags = []
     for token in nlp(tokens):
         pos_tag = token.tag_
         if pos_tag=='PPER':
@@ -116,89 +121,68 @@ def get_pos_embeds(tokens):
             pos_tag = pos_tags['Prep']
         else:
             pos_tag = pos_tags['Other']
-
-        for subtoken in tokenizer.tokenize(token.text):
-            tags.append(pos_tag)
-    tags = tags[:max_len_bio-1]
-    while len(tags)<(max_len_bio-1):
-        tags.append(pos_tags['O'])
-    tags = tags+[pos_tags['O']]
-    return tags
+        word_tags.append(pos_tag)
+    # every subtoken gets the tag of its word, special tokens and padding 'O'
+    return [pos_tags['O'] if word is None else word_tags[word] for word in word_ids]
 
 def encode_data(data):
-    encoded = tokenizer([' '.join(doc.split()) for doc in data["tokens"]], pad_to_max_length=True, padding="max_length", max_length=max_len_bio, truncation=True, add_special_tokens=True)
-    bert_out = bert_model(torch.tensor(encoded['input_ids']), torch.tensor(encoded['attention_mask']))
+    # one tokenizer call per batch, word_ids align subtokens with the words;
+    # batches are padded to their longest sequence when they are loaded
+    words = [doc.split() for doc in data["tokens"]]
+    encoded = tokenizer(words, max_length=max_len_bio, truncation=True, add_special_tokens=True, is_split_into_words=True)
     pos_tags = []
-    for sample in data['tokens']:
-        sample = ' '.join(sample.split())
-        sample_pos_tags = get_pos_embeds(sample)
-        pos_tags.append(sample_pos_tags)        
-    embedded_pos_tags = pos_embedder(torch.tensor(pos_tags)).tolist()
-    encoded["pos_input"] = embedded_pos_tags
+    labels = []
+    for i, sample in enumerate(words):
+        word_ids = encoded.word_ids(i)
+        sample_pos_tags = get_pos_embeds(' '.join(sample), word_ids)
+        pos_tags.append(sample_pos_tags)
+        labels.append(align_word_labels(data['tags'][i].split(), word_ids, label2id))
     encoded["pos_labels"] = pos_tags
+    encoded["labels"] = labels
     return encoded    
-    
-def encode_labels(example):
-    r_tags = []
-    count = 0
-    all_tokenized = []
-    for idx, token in enumerate(example['tokens'].split()):
-        tokenized = tokenizer.tokenize(token)
-        all_tokenized.extend(tokenized)
-        label = example['tags'].split()[idx]
-        for ti, t in enumerate(tokenized):
-            if ti!=0:
-                if label=='O':
-                    r_tags.append(label2id[label])
-                else:
-                    r_tags.append(label2id['I'])
-            else:
-                r_tags.append(label2id[label])
-    r_tags = [label2id['O']]+r_tags[:max_len_bio-1]+[label2id['O']]
-    rest = max_len_bio-len(r_tags)
-    if rest>0:
-        for i in range(rest):
-            r_tags.append(label2id['O'])
-    labels = dict()
-    labels['labels'] = torch.tensor(r_tags)
-    return labels
-
-
-
-train_task_dataset = datasets.Dataset.from_csv(anno_type+'_csv/'+anno_type+'_'+task+'_train.csv')
-train_task_dataset = train_task_dataset.map(encode_labels)
-train_task_dataset = train_task_dataset.map(encode_data, batched=True, batch_size=batch_size)
-
-dev_task_dataset = datasets.Dataset.from_csv(anno_type+'_csv/'+anno_type+'_'+task+'_dev.csv')
-dev_task_dataset = dev_task_dataset.map(encode_labels)
-dev_task_dataset = dev_task_dataset.map(encode_data, batched=True, batch_size=batch_size)
-
-test_task_dataset = datasets.Dataset.from_csv(anno_type+'_csv/'+anno_type+'_'+task+'_test.csv')
-test_task_dataset = test_task_dataset.map(encode_labels)
-test_task_dataset = test_task_dataset.map(encode_data, batched=True, batch_size=batch_size)
-
-
-train_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_input'])
-dev_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_input'])
-test_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_input'])
+
+
+
+def load_encoded_dataset(csv_file):
+    # the POS tags depend on the spacy model as well
+    return load_encoded_csv(csv_file, encode_data, tokenizer, batch_size=batch_size, max_length=max_len_bio,
+                            label2id=label2id, pos_tags=pos_tags, get_pos_embeds=get_pos_embeds,
+                            spacy_model=nlp.meta["name"] + "-" + nlp.meta["version"],
+                            align_word_labels=align_word_labels)
+
+train_task_dataset = load_encoded_dataset(anno_type+'_csv/'+anno_type+'_'+task+'_train.csv')
+dev_task_dataset = load_encoded_dataset(anno_type+'_csv/'+anno_type+'_'+task+'_dev.csv')
+test_task_dataset = load_encoded_dataset(anno_type+'_csv/'+anno_type+'_'+task+'_test.csv')
+
+
+train_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_labels'])
+dev_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_labels'])
+test_task_dataset.set_format(type='torch', columns=['input_ids', 'token_type_ids', 'attention_mask', 'labels', 'pos_labels'])
 
 print('train:', len(train_task_dataset))
 print('dev:', len(dev_task_dataset))
 print('test:', len(test_task_dataset))
 
-dataloader = torch.utils.data.DataLoader(train_task_dataset, shuffle=True)
-evaluate_dataloader = torch.utils.data.DataLoader(dev_task_dataset)
-test_dataloader = torch.utils.data.DataLoader(test_task_dataset)
+# padded labels are ignored, padded tokens get the POS tag 'O'
+collate = PadCollator({'input_ids': tokenizer.pad_token_id, 'token_type_ids': 0, 'attention_mask': 0,
+                       'labels': ignore_label, 'pos_labels': pos_tags['O']})
+dataloader = bucketed_dataloader(train_task_dataset, collate, training.batch_size, shuffle=True, settings=training)
+evaluate_dataloader = bucketed_dataloader(dev_task_dataset, collate, training.eval_batch_size, settings=training)
+test_dataloader = bucketed_dataloader(test_task_dataset, collate, training.eval_batch_size, settings=training)
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 model.to(device)
+pos_embedder.to(device)
+
+def forward(batch):
+    return model(batch["input_ids"], attention_mask=batch["attention_mask"], pos_input=pos_embedder(batch["pos_labels"]), adapter_names=[task])
 
 if do_train:
     model.set_active_adapters([[task]])
     model.train_adapter([task])
 
     class_weights = torch.FloatTensor([1, 1.5, 1.5]).to(device)
-    loss_function = nn.CrossEntropyLoss(weight=class_weights)
+    loss_function = nn.CrossEntropyLoss(weight=class_weights, ignore_index=ignore_label)
 
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [{"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)], "weight_decay": 1e-4,}, {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0,},]
@@ -209,61 +193,29 @@ if do_train:
 
     print(model)
 
+    engine = TrainingEngine(forward, loss_function, optimizer, training, device)
     for epoch in range(12):
-        for i, batch in enumerate(dataloader):
-            for k, v in batch.items():
-                if k=='pos_input' and len(v)>1:
-                    batch[k] = torch.stack(v).to(device)
-                else:
-                    batch[k] = v.to(device)
-
-            outputs = model(batch["input_ids"], attention_mask=batch["attention_mask"], pos_input=batch["pos_input"], adapter_names=[task])
-            predictions = outputs[0]
-            expected = torch.flatten(batch["labels"].long(), 0, 1)
-            loss = loss_function(predictions, expected)
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-            if i % 10000 == 0:
-                print(epoch)
-                print(f"loss: {loss}")
-        with torch.no_grad():
-            predictions_list = []
-            expected_list = []
-            dev_losses = []
-            for i, batch in enumerate(evaluate_dataloader):
-                for k, v in batch.items():
-                    if k=='pos_input' and len(v)>1:
-                        batch[k] = torch.stack(v).to(device)
-                    else:
-                        batch[k] = v.to(device)
-                outputs = model(batch["input_ids"], attention_mask=batch["attention_mask"], pos_input=batch["pos_input"], adapter_names=[task])
-                predictions = torch.argmax(outputs[0], 1)
-                expected = batch["labels"].float()
-
-                mpredictions = outputs[0]
-                mexpected = torch.flatten(batch["labels"].long(), 0, 1)
-                loss = loss_function(mpredictions, mexpected)
-                dev_losses.append(loss.item())
-                predictions_list.append(predictions)
-                expected_list.append(expected)
-            cur_epoch_dev_loss = round(sum(dev_losses)/len(dev_losses),3)
-            print(epoch, 'Dev loss:', cur_epoch_dev_loss)
-            # always save the last epoch if there are too few samples in dev data!
-            if True:
-                # save adapter and head
-                model.save_adapter('adapters_pos/'+task+'_adapter/', task)
-                model.save_head('heads_pos/'+task+'_head/', task+"_head")
-                best_epoch = epoch
-                prev_smallest_dev_loss = cur_epoch_dev_loss
-
-            if epoch%5==0:
-                true_labels = torch.flatten(torch.cat(expected_list)).cpu().numpy()
-                predicted_labels = torch.flatten(torch.cat(predictions_list)).cpu().numpy()
-                print(confusion_matrix(true_labels, predicted_labels))
-                print('Micro f1:', f1_score(true_labels, predicted_labels, average='micro'))
-                print('Macro f1:', f1_score(true_labels, predicted_labels, average='macro'))
-                print('Weighted f1:', f1_score(true_labels, predicted_labels, average='weighted'))
+        train_loss = engine.train_epoch(dataloader)
+        print(epoch)
+        print(f"loss: {train_loss}")
+        dev_loss, predictions, expected = engine.evaluate(evaluate_dataloader)
+        cur_epoch_dev_loss = round(dev_loss,3)
+        print(epoch, 'Dev loss:', cur_epoch_dev_loss)
+        # always save the last epoch if there are too few samples in dev data!
+        if True:
+            # save adapter and head
+            model.save_adapter('adapters_pos/'+task+'_adapter/', task)
+            model.save_head('heads_pos/'+task+'_head/', task+"_head")
+            best_epoch = epoch
+            prev_smallest_dev_loss = cur_epoch_dev_loss
+
+        if epoch%5==0:
+            true_labels = expected.numpy()
+            predicted_labels = predictions.numpy()
+            print(confusion_matrix(true_labels, predicted_labels))
+            print('Micro f1:', f1_score(true_labels, predicted_labels, average='micro'))
+            print('Macro f1:', f1_score(true_labels, predicted_labels, average='macro'))
+            print('Weighted f1:', f1_score(true_labels, predicted_labels, average='weighted'))
 
     print('Best epoch:', best_epoch, prev_smallest_dev_loss, task)
 
@@ -277,23 +229,12 @@ model.active_adapters = ad
 
 model.to(device)
 model.eval()
-predictions_list = []
-expected_list = []
-for i, batch in enumerate(test_dataloader):
-    for k, v in batch.items():
-        if k=='pos_input' and len(v)>1:
-            batch[k] = torch.stack(v).to(device)
-        else:
-            batch[k] = v.to(device)
-    
-    outputs = model(batch["input_ids"], attention_mask=batch["attention_mask"], pos_input=batch["pos_input"], adapter_names=[task])
-    predictions = torch.argmax(outputs[0], 1)
-    expected = batch["labels"].float()
-    predictions_list.append(predictions)
-    expected_list.append(expected)
+# the loss is not used
+test_engine = TrainingEngine(forward, nn.CrossEntropyLoss(ignore_index=ignore_label), None, training, device)
+_, predictions, expected = test_engine.evaluate(test_dataloader)
 print('Test set evaluation!', task)
-true_labels = torch.flatten(torch.cat(expected_list)).cpu().numpy()
-predicted_labels = torch.flatten(torch.cat(predictions_list)).cpu().numpy()
+true_labels = expected.numpy()
+predicted_labels = predictions.numpy()
 print(confusion_matrix(true_labels, predicted_labels))
 print('Micro f1:', f1_score(true_labels, predicted_labels, average='micro'))
 print('Macro f1:', f1_score(true_labels, predicted_labels, average='macro'))
@@ -1,16 +1,25 @@
+import argparse
+import json
 import logging
 import os
+import time
 from pathlib import Path
-import sys
 
-import datasets
+import numpy as np
 import torch
 from adapters import AutoAdapterModel
+from adapters.composition import Parallel
 from sklearn.metrics import confusion_matrix, f1_score
 from torch import nn
 from transformers import AutoTokenizer, AutoConfig
 
-from adapters_bio_tags_server import merge_labels
+from adapter_training import (TrainingEngine, TrainingSettings, add_training_arguments,
+                              bucketed_dataloader, ignore_label, settings_from_arguments)
+from adapters_bio_tags_server import align_word_labels, merge_word_labels
+import dataset_cache
+from dataset_cache import load_encoded_csv
+from length_bucketing import PadCollator, pad_sequences
+from slot_decoding import decode_spans, word_flags, word_labels
 
 os.environ["WANDB_DISABLED"] = "true"
 # all_samples needs batch_size=8 and class_weights (4, 4, 1.0) for similiar
@@ -21,6 +30,10 @@ max_len_bio = 128
 data_type = "balanced"  # "all_samples"
 adapters_dir = "adapters/" + data_type
 do_train = False
+training = TrainingSettings()
+# data set with the tags of all tasks per utterance, for training them jointly
+# (written by all_samples_csv/create_datasets.py)
+joint_label_type = "all_samples"
 
 # configure logger
 logging.basicConfig(
@@ -30,44 +43,37 @@ logging.basicConfig(
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
-def encode_labels(example):
-    r_tags = []
-    all_tokenized = []
-    for idx, token in enumerate(example["tokens"].split()):
-        tokenized = tokenizer.tokenize(token)
-        all_tokenized.extend(tokenized)
-        label = example["tags"].split()[idx]
-        for ti, t in enumerate(tokenized):
-            if ti != 0:
-                if label == "O":
-                    r_tags.append(label2id["O"])
-                else:
-                    r_tags.append(label2id["I"])
-            else:
-                r_tags.append(label2id[label])
-    r_tags = [label2id["O"]] + r_tags[:max_len_bio - 2] + [label2id["O"]]  # for CLS and SEP tokens
-    rest = max_len_bio - len(r_tags)
-    if rest > 0:
-        for i in range(rest):
-            r_tags.append(label2id["O"])
-    labels = dict()
-    labels["labels"] = torch.tensor(r_tags)
-    return labels
-
-
 def encode_data(data):
-    encoded = tokenizer([doc for doc in data["tokens"]], pad_to_max_length=True,
-                        padding="max_length", max_length=max_len_bio, truncation=True,
-                        add_special_tokens=True)
-    return (encoded)
-
-
-def tokenize(line: str):
-    all_tokens = ['#BOS']
-    for token in line.split():
-        tokenized = tokenizer.tokenize(token)
-        all_tokens.extend(tokenized)
-    return all_tokens
+    """
+    Encode the words of a batch in one tokenizer call and spread the word
+    labels over the subtokens. word_ids keeps the word index of every
+    subtoken (-1 for special tokens) for merging predictions in evaluation.
+    """
+    encoded = tokenizer([doc.split() for doc in data["tokens"]], max_length=max_len_bio,
+                        truncation=True, add_special_tokens=True, is_split_into_words=True)
+    encoded["labels"] = []
+    encoded["word_ids"] = []
+    for i, tags in enumerate(data["tags"]):
+        word_ids = encoded.word_ids(i)
+        encoded["labels"].append(align_word_labels(tags.split(), word_ids, label2id))
+        encoded["word_ids"].append([-1 if word is None else word for word in word_ids])
+    return encoded
+
+
+def encode_joint_data(data):
+    """
+    Encode the words of a batch of the all-in-one data set once and spread
+    the word labels of every task over the subtokens, into <task>_labels.
+    """
+    encoded = tokenizer([doc.split() for doc in data["tokens"]], max_length=max_len_bio,
+                        truncation=True, add_special_tokens=True, is_split_into_words=True)
+    encoded["word_ids"] = [[-1 if word is None else word for word in encoded.word_ids(i)]
+                           for i in range(len(data["tokens"]))]
+    for task in tasks:
+        encoded[task + "_labels"] = [
+            align_word_labels(tags.split(), encoded.word_ids(i), label2id)
+            for i, tags in enumerate(data[task + "_tags"])]
+    return encoded
 
 
 labels = ["B", "I", "O"]
@@ -82,6 +88,43 @@ tokenizer = AutoTokenizer.from_pretrained(model_name)
 
 tasks = ["einheit", "auftrag", "mittel", "ziel", "weg"]
 
+# batches are padded to their longest sequence, padded labels are ignored
+collate = PadCollator({"input_ids": tokenizer.pad_token_id, "token_type_ids": 0,
+                       "attention_mask": 0, "labels": ignore_label, "word_ids": -1,
+                       **{task + "_labels": ignore_label for task in tasks}})
+
+
+def load_encoded_dataset(csv_file, encode=encode_data):
+    """
+    :return: the encoded data set of a CSV file, from the data set cache if
+        it was encoded before
+    """
+    return load_encoded_csv(csv_file, encode, tokenizer, batch_size=16, max_length=max_len_bio,
+                            label2id=label2id, tasks=tasks, align_word_labels=align_word_labels)
+
+
+def optimizer_parameters(weight_decay: float = 1e-4) -> list[dict]:
+    """
+    :return: parameter groups of the model for the optimizer, without weight
+        decay of biases and LayerNorm weights
+    """
+    no_decay = ["bias", "LayerNorm.weight"]
+    return [
+        { "params": [p for n, p in model.named_parameters() if
+                     not any(nd in n for nd in no_decay)],
+          "weight_decay": weight_decay, },
+        { "params": [p for n, p in model.named_parameters() if
+                     any(nd in n for nd in no_decay)],
+          "weight_decay": 0.0, }, ]
+
+
+def print_f1_scores(true_labels, predicted_labels):
+    print(confusion_matrix(true_labels, predicted_labels))
+    print("Micro f1:", f1_score(true_labels, predicted_labels, average="micro"))
+    print("Macro f1:", f1_score(true_labels, predicted_labels, average="macro"))
+    print("Weighted f1:", f1_score(true_labels, predicted_labels, average="weighted"))
+
+
 def train_task(task):
     dir = Path(adapters_dir + "/" + task)
     if not dir.exists():
@@ -90,20 +133,12 @@ def train_task(task):
     model.add_adapter(task)
     model.add_tagging_head(task, num_labels=len(labels), id2label=id2label)
 
-    train_dataset = datasets.Dataset.from_csv(
+    train_task_dataset = load_encoded_dataset(
         label_type + "_csv/" + label_type + "_" + task + "_train.csv")
-    train_dataset = train_dataset.map(encode_labels)
-    train_task_dataset = train_dataset.map(encode_data, batched=True, batch_size=16)
-
-    dev_dataset = datasets.Dataset.from_csv(
+    dev_task_dataset = load_encoded_dataset(
         label_type + "_csv/" + label_type + "_" + task + "_dev.csv")
-    dev_dataset = dev_dataset.map(encode_labels)
-    dev_task_dataset = dev_dataset.map(encode_data, batched=True, batch_size=16)
-
-    test_task_dataset = datasets.Dataset.from_csv(
+    test_task_dataset = load_encoded_dataset(
         label_type + "_csv/" + label_type + "_" + task + "_test.csv")
-    test_task_dataset = test_task_dataset.map(encode_labels)
-    test_task_dataset = test_task_dataset.map(encode_data, batched=True, batch_size=16)
 
     train_task_dataset.set_format(type="torch",
                                   columns=["input_ids", "token_type_ids", "attention_mask",
@@ -115,75 +150,43 @@ def train_task(task):
                                  columns=["input_ids", "token_type_ids", "attention_mask",
                                           "labels"])
 
-    dataloader = torch.utils.data.DataLoader(train_task_dataset, shuffle=True)
-    evaluate_dataloader = torch.utils.data.DataLoader(dev_task_dataset)
-    #test_dataloader = torch.utils.data.DataLoader(test_task_dataset)
+    dataloader = bucketed_dataloader(train_task_dataset, collate, training.batch_size,
+                                     shuffle=True, settings=training)
+    evaluate_dataloader = bucketed_dataloader(dev_task_dataset, collate,
+                                              training.eval_batch_size, settings=training)
+    #test_dataloader = bucketed_dataloader(test_task_dataset, collate, training.eval_batch_size)
 
     model.to(device)
     model.set_active_adapters(task)
     model.train_adapter(task)
     class_weights = torch.FloatTensor([1.5, 1.5, 1.0]).to(device)
-    loss_function = nn.CrossEntropyLoss(weight=class_weights)
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        { "params": [p for n, p in model.named_parameters() if
-                     not any(nd in n for nd in no_decay)],
-          "weight_decay": 1e-4, },
-        { "params": [p for n, p in model.named_parameters() if
-                     any(nd in n for nd in no_decay)],
-          "weight_decay": 0.0, }, ]
-    optimizer = torch.optim.AdamW(params=optimizer_grouped_parameters, lr=1e-3)
+    loss_function = nn.CrossEntropyLoss(weight=class_weights, ignore_index=ignore_label)
+    optimizer = torch.optim.AdamW(params=optimizer_parameters(), lr=1e-3)
 
     prev_smallest_dev_loss = None
     best_epoch = None
 
+    def forward(batch):
+        return model(batch["input_ids"], attention_mask=batch["attention_mask"],
+                     adapter_names=[task])[0]
+
+    engine = TrainingEngine(forward, loss_function, optimizer, training, device)
     for epoch in range(12):
-        for i, batch in enumerate(dataloader):
-            batch = {k: v.to(device) for k, v in batch.items()}
-            outputs = model(batch["input_ids"], attention_mask=batch["attention_mask"],
-                            adapter_names=[task])
-            predictions = torch.flatten(outputs[0], 0, 1)
-            expected = torch.flatten(batch["labels"].long(), 0, 1)
-            loss = loss_function(predictions, expected)
-            loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-            if i % 10000 == 0:
-                print(epoch)
-                print(f"loss: {loss}")
-        with torch.no_grad():
-            predictions_list = []
-            expected_list = []
-            dev_losses = []
-            for i, batch in enumerate(evaluate_dataloader):
-                batch = {k: v.to(device) for k, v in batch.items()}
-                outputs = model(batch["input_ids"], adapter_names=[task])
-                predictions = torch.argmax(outputs[0], 2)
-                expected = batch["labels"].float()
-
-                mpredictions = torch.flatten(outputs[0], 0, 1)
-                mexpected = torch.flatten(batch["labels"].long(), 0, 1)
-                loss = loss_function(mpredictions, mexpected)
-                dev_losses.append(loss.item())
-                predictions_list.append(predictions)
-                expected_list.append(expected)
-            cur_epoch_dev_loss = round(sum(dev_losses) / len(dev_losses), 3)
-            print(epoch, "Dev loss:", cur_epoch_dev_loss)
-            if prev_smallest_dev_loss is None or cur_epoch_dev_loss <= prev_smallest_dev_loss:
-                # save adapter and head
-                model.save_adapter(adapters_dir + "/" + task, task)
-                #model.save_head(heads_dir + "/" + task + "_head/", task)
-                best_epoch = epoch
-                prev_smallest_dev_loss = cur_epoch_dev_loss
-
-            if epoch % 5 == 0 or cur_epoch_dev_loss <= prev_smallest_dev_loss:
-                true_labels = torch.flatten(torch.cat(expected_list)).cpu().numpy()
-                predicted_labels = torch.flatten(torch.cat(predictions_list)).cpu().numpy()
-                print(confusion_matrix(true_labels, predicted_labels))
-                print("Micro f1:", f1_score(true_labels, predicted_labels, average="micro"))
-                print("Macro f1:", f1_score(true_labels, predicted_labels, average="macro"))
-                print("Weighted f1:",
-                      f1_score(true_labels, predicted_labels, average="weighted"))
+        train_loss = engine.train_epoch(dataloader)
+        print(epoch)
+        print(f"loss: {train_loss}")
+        dev_loss, predictions, expected = engine.evaluate(evaluate_dataloader)
+        cur_epoch_dev_loss = round(dev_loss, 3)
+        print(epoch, "Dev loss:", cur_epoch_dev_loss)
+        if prev_smallest_dev_loss is None or cur_epoch_dev_loss <= prev_smallest_dev_loss:
+            # save adapter and head
+            model.save_adapter(adapters_dir + "/" + task, task)
+            #model.save_head(heads_dir + "/" + task + "_head/", task)
+            best_epoch = epoch
+            prev_smallest_dev_loss = cur_epoch_dev_loss
+
+        if epoch % 5 == 0 or cur_epoch_dev_loss <= prev_smallest_dev_loss:
+            print_f1_scores(expected.numpy(), predictions.numpy())
 
     print("Best epoch:", best_epoch, prev_smallest_dev_loss, task)
 
@@ -199,21 +202,101 @@ def train_task(task):
     print(res)
 
 
-def eval_task(task):
+def joint_csv(split):
+    """
+    :param split: train, dev or test
+    :return: path of the all-in-one CSV file of joint_label_type
+    :raise FileNotFoundError: if create_datasets.py has not written it yet
+    """
+    csv_file = joint_label_type + "_csv/" + joint_label_type + "_all-in-one_" + split + ".csv"
+    if not os.path.exists(csv_file):
+        raise FileNotFoundError(f"{csv_file} not found, run create_datasets.py in "
+                                f"{joint_label_type}_csv first to create the all-in-one data set")
+    return csv_file
+
+
+def train_joint():
+    """
+    Train the adapters and heads of all tasks together on the all-in-one
+    data set: every batch is tokenized once and goes through the model once,
+    with the adapters in parallel. The adapter of every task is saved at the
+    epoch of its smallest dev loss, as with train_task.
+    """
+    csv_files = {split: joint_csv(split) for split in ["train", "dev"]}
+    for task in tasks:
+        Path(adapters_dir + "/" + task).mkdir(parents=True, exist_ok=True)
+        model.add_adapter(task)
+        model.add_tagging_head(task, num_labels=len(labels), id2label=id2label)
+
+    columns = ["input_ids", "token_type_ids", "attention_mask"] + [
+        task + "_labels" for task in tasks]
+    joint_datasets = dict()
+    for split, csv_file in csv_files.items():
+        joint_datasets[split] = load_encoded_dataset(csv_file, encode_joint_data)
+        joint_datasets[split].set_format(type="torch", columns=columns)
+
+    dataloader = bucketed_dataloader(joint_datasets["train"], collate, training.batch_size,
+                                     shuffle=True, settings=training)
+    evaluate_dataloader = bucketed_dataloader(joint_datasets["dev"], collate,
+                                              training.eval_batch_size, settings=training)
+
+    model.to(device)
+    model.train_adapter(Parallel(*tasks))
+    # head k gets the hidden states of adapter k
+    model.active_head = Parallel(*tasks)
+    class_weights = torch.FloatTensor([1.5, 1.5, 1.0]).to(device)
+    loss_function = nn.CrossEntropyLoss(weight=class_weights, ignore_index=ignore_label)
+    optimizer = torch.optim.AdamW(params=optimizer_parameters(), lr=1e-3)
+
+    prev_smallest_dev_loss = {task: None for task in tasks}
+    best_epoch = {task: None for task in tasks}
+
+    def forward(batch):
+        outputs = model(batch["input_ids"], attention_mask=batch["attention_mask"])
+        return {task: output[0] for task, output in zip(tasks, outputs.head_outputs)}
+
+    engine = TrainingEngine(forward, loss_function, optimizer, training, device)
+    for epoch in range(12):
+        train_loss = engine.train_epoch(dataloader)
+        print(epoch)
+        print(f"loss: {train_loss}")
+        for task, (dev_loss, predictions, expected) in engine.evaluate_tasks(
+                evaluate_dataloader).items():
+            cur_epoch_dev_loss = round(dev_loss, 3)
+            print(epoch, task, "Dev loss:", cur_epoch_dev_loss)
+            if (prev_smallest_dev_loss[task] is None
+                    or cur_epoch_dev_loss <= prev_smallest_dev_loss[task]):
+                model.save_adapter(adapters_dir + "/" + task, task)
+                best_epoch[task] = epoch
+                prev_smallest_dev_loss[task] = cur_epoch_dev_loss
+
+            if epoch % 5 == 0 or cur_epoch_dev_loss <= prev_smallest_dev_loss[task]:
+                print_f1_scores(expected.numpy(), predictions.numpy())
+
+    for task in tasks:
+        print("Best epoch:", best_epoch[task], prev_smallest_dev_loss[task], task)
+
+
+def eval_task(task, load_adapter=True):
+    """
+    Evaluate the tagger of a task on its test set.
+    :param load_adapter: load the adapter and head of the task first, False
+        if they are already loaded (e.g. into a quantized model)
+    :return: f1 scores of the subtoken labels and of the merged word labels
+    """
     # test evaluation
     print("Task:", task)
-    model.load_adapter(adapters_dir + "/" + task)
-    model.to(device)
+    if load_adapter:
+        model.load_adapter(adapters_dir + "/" + task)
+        model.to(device)
     model.eval()
-    test_task_dataset = datasets.Dataset.from_csv(
+    test_task_dataset = load_encoded_dataset(
         label_type + "_csv/" + label_type + "_" + task + "_test.csv")
-    test_task_dataset = test_task_dataset.map(encode_labels)
-    test_task_dataset = test_task_dataset.map(encode_data, batched=True, batch_size=16)
 
     test_task_dataset.set_format(type="torch",
                                  columns=["input_ids", "token_type_ids", "attention_mask",
-                                          "labels", "tokens", "tags"])
-    test_dataloader = torch.utils.data.DataLoader(test_task_dataset, batch_size=16)
+                                          "labels", "word_ids", "tags"])
+    test_dataloader = bucketed_dataloader(test_task_dataset, collate, batch_size=16)
 
     # set adapter and head for current task
     model.active_adapters = task
@@ -230,8 +313,8 @@ def eval_task(task):
         for k in range(len(batch[next(iter(batch))])):
             expected = batch["labels"][k].int()
             att_mask = batch['attention_mask'][k]
-            # get first index where attention is not 1
-            index = torch.where(att_mask != 1)[0][0].item()
+            # number of non-padded tokens
+            index = int(att_mask.sum().item())
             # ignore padded tokens in evaluation
             predictions_list.append(predictions[k][:index])
             expected_list.append(expected[:index])
@@ -239,29 +322,201 @@ def eval_task(task):
             merged_predicted = predictions[k][:index]
             merged_predicted = torch.flatten(merged_predicted).cpu().numpy()
             merged_predicted = [id2label[l] for l in merged_predicted]
-            merged_predicted = merge_labels(merged_predicted, tokenize(batch['tokens'][k]))
             merged_expected = batch["tags"][k].split()
+            merged_predicted = merge_word_labels(merged_predicted,
+                                                 batch["word_ids"][k][:index].tolist(),
+                                                 len(merged_expected))
             merged_predictions_list.extend(merged_predicted)
             merged_expected_list.extend(merged_expected)
     print(f"Test set evaluation for {task}!")
     true_labels = torch.flatten(torch.cat(expected_list)).cpu().numpy()
     predicted_labels = torch.flatten(torch.cat(predictions_list)).cpu().numpy()
+    metrics = dict()
     print(confusion_matrix(true_labels, predicted_labels))
-    print("Micro f1:", f1_score(true_labels, predicted_labels, average="micro"))
-    print("Macro f1:", f1_score(true_labels, predicted_labels, average="macro"))
-    print("Weighted f1:", f1_score(true_labels, predicted_labels, average="weighted"))
+    for average in ["micro", "macro", "weighted"]:
+        metrics[average + "_f1"] = f1_score(true_labels, predicted_labels, average=average)
+        print(f"{average.capitalize()} f1:", metrics[average + "_f1"])
     print("Merged test set evaluation!")
     print(confusion_matrix(merged_expected_list, merged_predictions_list))
-    print("Micro f1:", f1_score(merged_expected_list, merged_predictions_list, average="micro"))
-    print("Macro f1:", f1_score(merged_expected_list, merged_predictions_list, average="macro"))
-    print("Weighted f1:",
-          f1_score(merged_expected_list, merged_predictions_list, average="weighted"))
+    for average in ["micro", "macro", "weighted"]:
+        metrics["merged_" + average + "_f1"] = f1_score(
+            merged_expected_list, merged_predictions_list, average=average)
+        print(f"{average.capitalize()} f1:", metrics["merged_" + average + "_f1"])
+    return metrics
+
+def tagging_scores(true_labels, predicted_labels) -> dict:
+    """
+    :return: confusion matrix (rows: expected B, I, O) and f1 scores of labels
+    """
+    scores = {"confusion_matrix": confusion_matrix(
+        true_labels, predicted_labels, labels=list(range(len(labels)))).tolist()}
+    for average in ["micro", "macro", "weighted"]:
+        scores[average + "_f1"] = f1_score(true_labels, predicted_labels, average=average)
+    return scores
+
+
+def span_scores(correct: int, predicted: int, expected: int) -> dict:
+    """
+    :return: precision, recall and f1 score of exactly matching phrases
+    """
+    precision = correct / predicted if predicted else 0.0
+    recall = correct / expected if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "correct": correct,
+            "predicted": predicted, "expected": expected}
+
+
+def _span_keys(spans: torch.Tensor, num_words: int) -> torch.Tensor:
+    # one number per (line, first word, end) row of decode_spans
+    return (spans[:, 0] * (num_words + 1) + spans[:, 1]) * (num_words + 1) + spans[:, 2]
+
+
+def eval_taggers(dataset, eval_tasks, columns) -> dict:
+    """
+    Evaluate the taggers of several tasks on an encoded test set in one pass
+    of batches, with the adapters in parallel. Subtoken labels are merged to
+    word labels like the server does, and the phrases of the words are
+    compared with the expected phrases.
+    :param dataset: test set with input_ids, attention_mask, word_ids and
+        the label and tag columns of the tasks, in torch format
+    :param eval_tasks: tasks whose adapters and heads are loaded
+    :param columns: names of the subtoken label column and of the word tag
+        column of every task
+    :return: token, word and span scores of every task
+    """
+    begin_id, inside_id, outside_id = label2id["B"], label2id["I"], label2id["O"]
+    setup = Parallel(*eval_tasks) if len(eval_tasks) > 1 else eval_tasks[0]
+    model.active_adapters = setup
+    model.active_head = setup
+    token_results = {task: ([], []) for task in eval_tasks}
+    word_results = {task: ([], []) for task in eval_tasks}
+    span_counts = {task: [0, 0, 0] for task in eval_tasks}
+    with torch.inference_mode():
+        for batch in bucketed_dataloader(dataset, collate, training.eval_batch_size):
+            outputs = model(batch["input_ids"].to(device),
+                            attention_mask=batch["attention_mask"].to(device))
+            tokens = batch["attention_mask"].bool()
+            word_ids = batch["word_ids"]
+            head_outputs = outputs.head_outputs if len(eval_tasks) > 1 else [outputs]
+            for task, output in zip(eval_tasks, head_outputs):
+                label_column, tag_column = columns[task]
+                predictions = torch.argmax(output[0], -1).cpu()
+                token_results[task][0].append(batch[label_column][tokens])
+                token_results[task][1].append(predictions[tokens])
+
+                expected = pad_sequences([[label2id[tag] for tag in tags.split()]
+                                          for tags in batch[tag_column]], ignore_label)
+                num_words = expected.shape[1]
+                words = expected != ignore_label
+                predicted = word_labels(*word_flags(predictions, word_ids, num_words,
+                                                    begin_id, inside_id),
+                                        begin_id, inside_id, outside_id)
+                word_results[task][0].append(expected[words])
+                word_results[task][1].append(predicted[words])
+
+                predicted_spans = _span_keys(decode_spans(predictions, word_ids, num_words,
+                                                          begin_id, inside_id), num_words)
+                expected_spans = _span_keys(decode_spans(
+                    expected, torch.where(words, torch.arange(num_words), -1), num_words,
+                    begin_id, inside_id), num_words)
+                span_counts[task][0] += int(torch.isin(predicted_spans, expected_spans).sum())
+                span_counts[task][1] += len(predicted_spans)
+                span_counts[task][2] += len(expected_spans)
+    return {task: {"samples": len(dataset),
+                   "tokens": tagging_scores(*(torch.cat(r).numpy() for r in token_results[task])),
+                   "words": tagging_scores(*(torch.cat(r).numpy() for r in word_results[task])),
+                   "spans": span_scores(*span_counts[task])}
+            for task in eval_tasks}
+
+
+def eval_all(joint=False, report=None, load_adapters=True):
+    """
+    Evaluate the taggers of all tasks: on the test set of every task, or on
+    the all-in-one test set in one pass for all tasks.
+    :param joint: use the all-in-one test set of joint_label_type
+    :param report: path of a JSON file for the scores (optional)
+    :param load_adapters: load the adapters and heads of the tasks first,
+        False if they are already loaded
+    :return: token, word and span scores of every task
+    """
+    start = time.perf_counter()
+    if load_adapters:
+        for task in tasks:
+            model.load_adapter(adapters_dir + "/" + task)
+    model.to(device)
+    model.eval()
+    if joint:
+        test_sets = {tuple(tasks): joint_csv("test")}
+        columns = {task: (task + "_labels", task + "_tags") for task in tasks}
+    else:
+        test_sets = {(task,): label_type + "_csv/" + label_type + "_" + task + "_test.csv"
+                     for task in tasks}
+        columns = {task: ("labels", "tags") for task in tasks}
+
+    results = dict()
+    for test_tasks, test_file in test_sets.items():
+        dataset = load_encoded_dataset(test_file, encode_joint_data if joint else encode_data)
+        dataset.set_format(type="torch", columns=[
+            "input_ids", "attention_mask", "word_ids",
+            *(column for task in test_tasks for column in columns[task])])
+        for task, scores in eval_taggers(dataset, list(test_tasks), columns).items():
+            results[task] = {"test_set": test_file, **scores}
+
+    for task, scores in results.items():
+        print(f"Test set evaluation for {task}!")
+        for level in ["tokens", "words"]:
+            print(level.capitalize() + ":")
+            print(np.array(scores[level]["confusion_matrix"]))
+            for average in ["micro", "macro", "weighted"]:
+                print(f"{average.capitalize()} f1:", scores[level][average + "_f1"])
+        print("Spans: precision {precision:.4f} recall {recall:.4f} f1 {f1:.4f} "
+              "({correct} of {predicted} predicted, {expected} expected)".format(**scores["spans"]))
+    seconds = time.perf_counter() - start
+    print(f"Evaluated {len(results)} taggers in {seconds:.1f} s")
+    if report:
+        with open(report, "w") as f:
+            json.dump({"adapters_dir": adapters_dir, "seconds": seconds, "tasks": results},
+                      f, indent=2)
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--train', action='store_true',
+                        help="train the adapters, otherwise evaluate them on the test sets")
+    parser.add_argument('-j', '--joint', action='store_true',
+                        help="train (-t) or evaluate (-a) the adapters of all tasks together "
+                             f"on the {joint_label_type}_csv all-in-one data set, which "
+                             f"create_datasets.py writes when it is run in {joint_label_type}_csv")
+    parser.add_argument('-a', '--eval-all', action='store_true',
+                        help="evaluate all taggers in one pass per test set, with phrase "
+                             "(span) scores")
+    parser.add_argument('-r', '--report',
+                        help="with -a, write the scores to this JSON file (optional)")
+    parser.add_argument('--no-dataset-cache', action='store_true',
+                        help="encode the CSV files again instead of loading them from "
+                             f"{dataset_cache.cache_dir}")
+    add_training_arguments(parser)
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1 and sys.argv[1] == '-t':
-        do_train = True
-    for task in tasks:
-        if do_train:
-            train_task(task)
-        else:
-            eval_task(task)
+    args = parse_arguments()
+    do_train = args.train
+    training = settings_from_arguments(args)
+    if args.no_dataset_cache:
+        dataset_cache.cache_dir = None
+    if do_train and args.joint:
+        train_joint()
+    elif not do_train and args.eval_all:
+        eval_all(joint=args.joint, report=args.report)
+    else:
+        for task in tasks:
+            if do_train:
+                train_task(task)
+            else:
+                eval_task(task)
@@ -5,18 +5,52 @@
 Web service with endpoint for annotation of radio traffic with task specific entities
 """
 
+import time
+
+# start of the imports, for the startup time log
+import_started = time.perf_counter()
+
 import argparse
+import csv
 import json
 import logging
+import math
+import os
+import random
+import socket
 import string
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Iterator, NamedTuple, NoReturn
 
 import torch
-from adapters import BertAdapterModel, AutoAdapterModel
-from flask import Flask, abort, Response, request, Request
+from flask import Flask, abort, g, Response, request, Request, stream_with_context
 from flask.typing import ResponseReturnValue
-from transformers import BertTokenizerFast, AutoTokenizer, AutoConfig
-from transformers import pipeline
 from waitress import serve
+from werkzeug.exceptions import ServiceUnavailable
+
+from annotation_scheduler import DeadlineError, MicroBatchScheduler, RejectedError
+import model_bundle
+from length_bucketing import length_buckets, pad_sequences
+from onnx_backend import OnnxModel
+from partial_hypotheses import HypothesisTracker
+from quantization import model_size_mb, quantize_model
+from request_profiler import RequestProfile, forward_prefix, stage_prefix, stage_range
+from result_cache import ResultCache
+from server_metrics import Gauge, Histogram, Registry
+from server_metrics import Counter as MetricCounter
+from session_store import SessionStore, Turn
+from slot_decoding import decode_spans
+from stream_server import StreamServer
+from worker_pool import WorkerPool, process_memory
+
+# adapters and transformers take seconds to import, they are imported when
+# the model is loaded, after the server has started listening
+if TYPE_CHECKING:
+    from adapters import BertAdapterModel
+    from transformers import BertTokenizerFast
 
 # configure logger
 logging.basicConfig(
@@ -31,16 +65,36 @@ app = Flask(__name__)
 
 # model related stuff
 model_name: str = "bert-base-german-cased"
-model: BertAdapterModel
-tokenizer: BertTokenizerFast
+# adapters and heads are selected per forward pass with the thread-local
+# AdapterSetup context, never with model.active_adapters/active_head, so that
+# several threads can run forward passes at the same time
+model: "BertAdapterModel | OnnxModel"
+tokenizer: "BertTokenizerFast"
+# the fast tokenizer changes its truncation settings on every call and fails
+# when it is used by several threads at once
+tokenizer_lock = threading.Lock()
 max_len_bio = 128
+max_len_dact = 512
+# maximal number of utterances per forward pass, larger batches are split
+# into buckets of similar length
+forward_batch_size = 32
 labels = ["B", "I", "O"]
 id2label = {id_: label for id_, label in enumerate(labels)}
 label2id = {label: id_ for id_, label in enumerate(labels)}
+dact_id2label: dict[int, str]
 device: str = "cuda" if torch.cuda.is_available() else "cpu"
 
 # supported tasks
 tasks: list[str] = ["einheit", "auftrag", "mittel", "ziel", "weg"]
+# run all slot taggers in one forward pass with Parallel adapter composition
+parallel_slots: bool = False
+# dynamic INT8 quantization of all Linear layers (CPU only)
+quantize: bool = False
+# inference backend: "torch", or "onnx" for the graphs exported to onnx_dir
+backend: str = "torch"
+onnx_dir: str = "onnx"
+# consolidated model written by build_bundle.py, None: base model and adapter folders
+bundle_dir: str | None = None
 
 # folders
 data_type: str = "balanced"  # "all_samples"
@@ -50,6 +104,137 @@ da_with_slot = [ 'Einsatzbefehl', 'Information_Geben' ]
 
 remove_punct = str.maketrans('', '', string.punctuation)
 
+
+class AnnotationRequest(NamedTuple):
+    text: str
+    prev_text: str = ''
+    force_slots: bool = False
+    slots_only: bool = False
+    speaker: str = ''
+    prev_speaker: str = ''
+    # utterance id and revision of a partial speech recognition hypothesis
+    stream: str = ''
+    revision: int = 0
+    # index in lanes, and time.monotonic() by which it has to be annotated
+    lane: int = 1
+    deadline: float | None = None
+    # profile of the batch the request is annotated in, wherever it runs
+    profile: RequestProfile | None = None
+    # a newer revision of the partial hypothesis arrived before this one
+    superseded: bool = False
+
+
+# input of the dialogue act classifier, the anno_type of adapters_classifier.py
+# the dact adapter was trained with
+dact_input_format: str = "with_context"
+dact_input_formats = ["without_context_and_without_speaker",
+                      "without_context_with_current_speaker", "with_context",
+                      "with_context_with_current_and_previous_speaker"]
+
+# last turns of the sessions (e.g. radio channels) of the clients, which don't
+# have to send prev_text then, None: no sessions
+session_store: SessionStore | None = None
+# False with several worker processes: every worker has its own sessions and
+# partial hypotheses, WebSocket connections stay with their worker but HTTP
+# requests don't
+http_state: bool = True
+
+# newest revisions of partial hypotheses, older ones are not annotated,
+# None: every request is annotated
+hypotheses: HypothesisTracker | None = None
+
+
+# dynamic micro-batching of concurrent requests, None: every request thread
+# runs its own forward passes
+scheduler: MicroBatchScheduler | None = None
+# lanes of the micro-batching queue, highest priority first, and the share of
+# the queue each lane can fill
+lanes: list[str] = ["command", "normal", "bulk"]
+lane_shares: tuple[float, ...] = (1.0, 0.75, 0.5)
+# sessions (radio channels) whose requests use the command lane
+priority_channels: set[str] = set()
+
+# pre-forked worker processes sharing the model, None: single process
+worker_pool: WorkerPool | None = None
+
+# WebSocket streaming of utterances per radio channel, None: no streaming
+stream_server: StreamServer | None = None
+
+# cache of results for repeated utterances, None: no caching
+result_cache: ResultCache | None = None
+# training data with frequent utterances to pre-warm the cache with
+prewarm_csvs: list[str] = ["csv_da_annotations/csv_with_context/train.csv"]
+
+# set when the model is loaded and warmed up
+model_ready = threading.Event()
+# endpoints rejected with status 503 until the model is ready
+model_endpoints = {'annotate', 'annotate_slots', 'annotate_batch_endpoint', 'reload'}
+
+# profiling of single /annotate and /annotate_slots requests with the torch
+# profiler: on demand with ?profile=1 or the X-Profile header, if enabled,
+# and of a random fraction of all requests
+profiling_enabled: bool = False
+profile_sample: float = 0.0
+# sampled profiles are only written for requests taking at least this long
+profile_slow_ms: float = 0.0
+profile_dir: str = "logs"
+
+# maximal size of a JSON array body for /annotate_batch, larger uploads have
+# to be sent as JSON lines, which are read incrementally
+max_json_batch_bytes = 16 * 1024 * 1024
+
+# metrics of this process for /metrics, cheap enough to be always on
+metrics_registry = Registry()
+requests_total = metrics_registry.register(MetricCounter(
+    'tag_server_requests_total', "HTTP requests by endpoint and status",
+    ('endpoint', 'status')))
+request_seconds = metrics_registry.register(Histogram(
+    'tag_server_request_seconds', "HTTP request latency by endpoint", ('endpoint',)))
+dialogue_acts_total = metrics_registry.register(MetricCounter(
+    'tag_server_dialogue_acts_total', "annotated utterances by dialogue act",
+    ('dialogue_act',)))
+stage_seconds = metrics_registry.register(Histogram(
+    'tag_server_stage_seconds', "time per call of a processing stage, for a request or a batch",
+    ('stage',)))
+forward_seconds = metrics_registry.register(Histogram(
+    'tag_server_forward_seconds', "time per forward pass by adapter, 'parallel' for all "
+    "slot adapters in one pass", ('adapter',)))
+in_flight = metrics_registry.register(Gauge(
+    'tag_server_in_flight_requests', "HTTP requests being processed"))
+queue_depth = metrics_registry.register(Gauge(
+    'tag_server_queue_depth', "requests waiting for a micro-batch",
+    function=lambda: scheduler.queue_depth() if scheduler else 0))
+rejected_total = metrics_registry.register(MetricCounter(
+    'tag_server_rejected_total',
+    "requests rejected because the queue was full ('queue_full') or they could not be "
+    "annotated before their deadline ('deadline' on arrival, 'shed' in the queue)",
+    ('reason', 'lane'),
+    function=lambda: {(reason, lanes[int(lane)]): count
+                      for (reason, lane), count in scheduler.rejections().items()}
+    if scheduler else {}))
+stream_connections = metrics_registry.register(Gauge(
+    'tag_server_stream_connections', "open WebSocket connections",
+    function=lambda: stream_server.connections if stream_server else 0))
+stream_messages_total = metrics_registry.register(MetricCounter(
+    'tag_server_stream_messages_total', "utterances annotated for WebSocket connections"))
+sessions = metrics_registry.register(Gauge(
+    'tag_server_sessions', "sessions with a stored turn",
+    function=lambda: len(session_store) if session_store is not None else 0))
+sessions_evicted_total = metrics_registry.register(MetricCounter(
+    'tag_server_sessions_evicted_total', "sessions dropped because the store was full",
+    function=lambda: session_store.stats()['evictions'] if session_store is not None else 0))
+sessions_expired_total = metrics_registry.register(MetricCounter(
+    'tag_server_sessions_expired_total', "sessions dropped after the idle timeout",
+    function=lambda: session_store.stats()['expirations'] if session_store is not None else 0))
+hypotheses_total = metrics_registry.register(MetricCounter(
+    'tag_server_hypotheses_total', "partial hypotheses received",
+    function=lambda: hypotheses.stats()['hypotheses'] if hypotheses else 0))
+hypotheses_dropped_total = metrics_registry.register(MetricCounter(
+    'tag_server_hypotheses_dropped_total',
+    "superseded partial hypotheses that were not annotated, by the check that dropped them",
+    ('check',), function=lambda: hypotheses.dropped() if hypotheses else {}))
+
+
 @app.route('/alive')
 def alive() -> ResponseReturnValue:
     """
@@ -58,18 +243,363 @@ def alive() -> ResponseReturnValue:
     """
     return Response("tag server is alive", status=200, mimetype='text/html')
 
-def _annotate(callback):
+@app.route('/ready')
+def ready() -> ResponseReturnValue:
+    """
+    Check if the model is loaded and warmed up
+    :return: ready message, status 503 while the model is loading
+    """
+    if not model_ready.is_set():
+        return Response("tag server is loading", status=503, mimetype='text/html')
+    return Response("tag server is ready", status=200, mimetype='text/html')
+
+@app.before_request
+def start_request_metrics() -> None:
+    g.request_started = time.perf_counter()
+    in_flight.inc()
+
+@app.after_request
+def count_request(response: Response) -> Response:
+    endpoint = request.endpoint or 'unknown'
+    requests_total.inc(endpoint, str(response.status_code))
+    started = g.request_started
+
+    def finish() -> None:
+        in_flight.dec()
+        request_seconds.observe(time.perf_counter() - started, endpoint)
+
+    # streamed responses are closed when the last line has been sent
+    response.call_on_close(finish)
+    return response
+
+@app.before_request
+def require_model() -> None:
+    """
+    Reject requests that need the model while it is loading.
+    """
+    if request.endpoint in model_endpoints and not model_ready.is_set():
+        abort(503, description="model is loading")
+
+@app.route('/metrics')
+def metrics() -> ResponseReturnValue:
+    """
+    Request counts, dialogue act distribution, latency histograms per
+    request, processing stage and adapter, requests in flight and queue depth
+    :return: metrics in the Prometheus text format
+    """
+    return Response(metrics_registry.exposition(), status=200,
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats')
+def stats() -> ResponseReturnValue:
+    """
+    Throughput and latency counters of the micro-batching scheduler
+    :return: counters in JSON format, empty if micro-batching is off
+    """
+    result = scheduler.stats() if scheduler else {}
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+@app.route('/workers')
+def workers() -> ResponseReturnValue:
+    """
+    Memory usage and throughput of the worker processes
+    :return: one entry per worker in JSON format
+    """
+    if worker_pool:
+        result = worker_pool.report()
+    else:
+        result = [{'worker': 0, 'pid': os.getpid(), **process_memory(os.getpid())}]
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+@app.route('/cache')
+def cache() -> ResponseReturnValue:
+    """
+    Counters of the result cache
+    :return: counters in JSON format, empty if caching is off
+    """
+    result = result_cache.stats() if result_cache else {}
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+@app.route('/sessions')
+def sessions_endpoint() -> ResponseReturnValue:
+    """
+    Counters of the session store, or the stored turns of the session given
+    by the 'session' parameter
+    :return: counters or turns in JSON format, empty if sessions are off
+    """
+    if session_store is None:
+        result = {}
+    elif 'session' in request.args:
+        result = [turn._asdict() for turn in session_store.turns(request.args['session'])]
+    else:
+        result = session_store.stats()
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+@app.route('/hypotheses')
+def hypotheses_endpoint() -> ResponseReturnValue:
+    """
+    Counters of the partial hypotheses: received, annotated and dropped
+    because they were superseded, i.e. the saved inferences
+    :return: counters in JSON format, empty if the tracking is off
+    """
+    result = hypotheses.stats() if hypotheses else {}
+    return Response(json.dumps(result), status=200, mimetype='application/json')
+
+@app.route('/reload', methods=['POST'])
+def reload() -> ResponseReturnValue:
+    """
+    Reload the base model and all adapters, e.g. after retraining, and drop
+    all cached results.
+    :return: reloaded message
+    """
+    if worker_pool:
+        abort(409, description="restart the server to reload the model of all workers")
+    init_model()
+    warm_up()
+    return Response("model reloaded", status=200, mimetype='text/html')
+
+def _annotate(slots_only: bool):
     """
     Entry point to annotate radio traffic.
     :return: result in JSON format
     """
+    request_profile = _request_profile()
+    started = time.perf_counter()
     try:
-        text, prev_text = _get_text_from_request(request)
+        with _stage('parse'):
+            text, prev_text = _get_text_from_request(request)
+            session = request.args.get('session', type=str)
+            anno_request = _request_from_args(request, text, prev_text, slots_only)
+            _check_http_state(anno_request, session)
+            anno_request = _arrived(anno_request, session)._replace(profile=request_profile)
     except Exception as e:
         logger.error(e)
         abort(400, description=e)
-    result = callback(text, prev_text)
-    return Response(json.dumps(result), status=200, mimetype='application/json')
+    try:
+        if not _stable(anno_request):
+            result = _superseded_result(anno_request)
+        else:
+            # the same way as every other request, through the cache and the
+            # scheduler, the batch of the request is profiled where it runs
+            result = _annotate_requests([anno_request])[0]
+    except RejectedError as e:
+        _overloaded(e)
+    with _stage('serialize'):
+        body = json.dumps(result)
+    if request_profile and request_profile.blocking:
+        # empty if the request was not annotated by the model, e.g. cached
+        summary = (_write_profile(request_profile, anno_request, time.perf_counter() - started)
+                   if request_profile.started else {})
+        body = json.dumps(dict(result, profile=summary))
+    elif request_profile and request_profile.started:
+        _write_profile(request_profile, anno_request, time.perf_counter() - started)
+    return Response(body, status=200, mimetype='application/json')
+
+def _overloaded(e: RejectedError) -> NoReturn:
+    """
+    Reject the current request with status 503 and a Retry-After header.
+    """
+    logger.error(e)
+    raise ServiceUnavailable(description=str(e), retry_after=_retry_after(e))
+
+def _retry_after(e: RejectedError) -> int:
+    """
+    :return: whole seconds after which a rejected request should be retried,
+        at least 1, also before the first batch has given a batch time
+    """
+    return max(1, math.ceil(e.retry_after))
+
+def _request_profile() -> RequestProfile | None:
+    """
+    Profile of the current request, if it is requested with the 'profile'
+    query parameter or the X-Profile header, or sampled.
+    :return: profile to run the request in, None for no profiling
+    """
+    requested = request.args.get('profile') or request.headers.get('X-Profile')
+    if requested and requested.lower() not in ('0', 'false'):
+        if not profiling_enabled:
+            abort(403, description="profiling is disabled, start the server with --profiling")
+        return RequestProfile()
+    if profile_sample and random.random() < profile_sample:
+        # skip the sample if another request is being profiled
+        return RequestProfile(blocking=False)
+    return None
+
+def _write_profile(request_profile: RequestProfile, anno_request: AnnotationRequest,
+                   seconds: float) -> dict:
+    """
+    Write the trace of a requested profile, or of a sampled profile of a
+    slow request, to the profile folder.
+    :param seconds: time of the whole request, including the queue
+    :return: the stage breakdown and top operators of the profile
+    """
+    if not request_profile.blocking and seconds * 1000 < profile_slow_ms:
+        return {}
+    summary = dict(request_profile.summary(), request_ms=round(seconds * 1000, 3))
+    summary['trace'] = request_profile.write(profile_dir, str(os.getpid()))
+    logger.info(f"profile of {anno_request.text!r}: {summary['total_ms']:.1f}ms, "
+                f"stages {summary['stages_ms']}, forward passes {summary['forward_ms']}, "
+                f"written to {summary['trace']}")
+    return summary
+
+def _annotate_requests(anno_requests: list[AnnotationRequest],
+                       rejected_errors: bool = False) -> list[dict]:
+    """
+    Annotate requests, taking results from the cache where possible.
+    :param rejected_errors: return an error object for every request that the
+        scheduler rejects or sheds, instead of raising RejectedError, so that
+        the other requests are still annotated
+    :raises RejectedError: if the scheduler rejects a request
+    """
+    if worker_pool:
+        worker_pool.count_requests(len(anno_requests))
+    futures = _cached_results(anno_requests) if result_cache else _run_model(anno_requests)
+    results = []
+    for future, anno_request in zip(futures, anno_requests):
+        try:
+            result = future.result()
+        except RejectedError as e:
+            if not rejected_errors:
+                raise
+            logger.error(e)
+            results.append(_rejected_result(e))
+            continue
+        if 'dialogue_act' in result:
+            dialogue_acts_total.inc(result['dialogue_act'])
+        # cached results are shared by all utterances with the same key
+        results.append(dict(result, text=anno_request.text))
+    return results
+
+def _rejected_result(e: RejectedError) -> dict:
+    return {'error': str(e), 'retry_after': _retry_after(e)}
+
+def _cached_results(anno_requests: list[AnnotationRequest]) -> list[Future]:
+    """
+    Take results from the cache, and annotate the requests that are neither
+    cached nor being annotated for another request of the same or a higher
+    lane and no earlier deadline.
+    :return: future for the result of every request
+    """
+    keys = [_cache_key(anno_request) for anno_request in anno_requests]
+    futures: list[Future] = []
+    todo = []
+    for i, key in enumerate(keys):
+        if key is None:
+            futures.append(Future())
+            todo.append(i)
+            continue
+        future, owner = result_cache.get(key, anno_requests[i].lane, anno_requests[i].deadline)
+        futures.append(future)
+        if owner:
+            todo.append(i)
+    if todo:
+        try:
+            model_futures = _run_model([anno_requests[i] for i in todo])
+        except Exception as e:
+            for i in todo:
+                if keys[i] is not None:
+                    result_cache.fail(keys[i], futures[i], e)
+            raise
+        for i, model_future in zip(todo, model_futures):
+            if keys[i] is None:
+                futures[i] = model_future
+            else:
+                # stored as soon as it is computed, for the requests waiting for it
+                model_future.add_done_callback(
+                    lambda done, key=keys[i], owned=futures[i]: _cache_result(key, owned, done))
+    return futures
+
+def _cache_result(key: tuple, owned: Future, future: Future) -> None:
+    if future.exception() is not None:
+        result_cache.fail(key, owned, future.exception())
+    else:
+        result_cache.put(key, owned, future.result())
+
+def _cache_key(anno_request: AnnotationRequest) -> tuple | None:
+    """
+    Utterances that only differ in punctuation and whitespace get the same
+    annotation, except for the text itself. The context only counts as far as
+    the dialogue act classifier sees it. Partial hypotheses are not cached,
+    they would only evict results that are used again.
+    """
+    if anno_request.stream:
+        return None
+    text = ' '.join(anno_request.text.translate(remove_punct).split())
+    if anno_request.slots_only:
+        return 'slots', text
+    return 'annotate', anno_request.force_slots, text, ' '.join(_dact_input(anno_request).split())
+
+def _run_model(anno_requests: list[AnnotationRequest]) -> list[Future]:
+    """
+    Annotate requests through the micro-batching scheduler, if there is one,
+    or directly in the current thread.
+    :return: future for the result of every request, it raises RejectedError
+        if the request is rejected or shed
+    """
+    futures: list[Future] = []
+    if scheduler:
+        for anno_request in anno_requests:
+            try:
+                futures.append(scheduler.submit(anno_request, anno_request.lane,
+                                                anno_request.deadline))
+            except RejectedError as e:
+                futures.append(Future())
+                futures[-1].set_exception(e)
+        return futures
+    now = time.monotonic()
+    for anno_request in anno_requests:
+        futures.append(Future())
+        if anno_request.deadline is not None and anno_request.deadline < now:
+            futures[-1].set_exception(
+                DeadlineError("deadline passed before the request could be annotated"))
+    current = [i for i, future in enumerate(futures) if not future.done()]
+    if current:
+        for i, result in zip(current, _annotate_current([anno_requests[i] for i in current])):
+            futures[i].set_result(result)
+    return futures
+
+def _annotate_current(anno_requests: list[AnnotationRequest]) -> list[dict]:
+    """
+    annotate_batch() for the requests that are not superseded partial
+    hypotheses, right before the model would annotate them. If a request is
+    profiled, the batch is profiled in the thread that runs it (e.g. the
+    scheduler thread).
+    :return: the annotation of every request, in the same order
+    """
+    # only one profile can run at a time
+    request_profile = next((anno_request.profile for anno_request in anno_requests
+                            if anno_request.profile), None)
+    with request_profile or nullcontext():
+        return _annotate_current_requests(anno_requests)
+
+def _annotate_current_requests(anno_requests: list[AnnotationRequest]) -> list[dict]:
+    if not hypotheses:
+        return annotate_batch(anno_requests)
+    current = [i for i, anno_request in enumerate(anno_requests) if not anno_request.superseded
+               and (not anno_request.stream
+                    or hypotheses.check(anno_request.stream, anno_request.revision))]
+    if len(current) == len(anno_requests):
+        return annotate_batch(anno_requests)
+    results = [_superseded_result(anno_request) for anno_request in anno_requests]
+    if current:
+        for i, result in zip(current, annotate_batch([anno_requests[i] for i in current])):
+            results[i] = result
+    return results
+
+def _stable(anno_request: AnnotationRequest) -> bool:
+    """
+    Wait until a partial hypothesis is stable for the debounce time.
+    :return: False if it was superseded, True for other requests
+    """
+    if anno_request.superseded:
+        return False
+    if not anno_request.stream or not hypotheses:
+        return True
+    return hypotheses.wait_stable(anno_request.stream, anno_request.revision)
+
+def _superseded_result(anno_request: AnnotationRequest) -> dict:
+    return {'superseded': True, 'text': anno_request.text, 'stream': anno_request.stream,
+            'revision': anno_request.revision}
 
 @app.route('/annotate', methods=['GET', 'POST'])
 def annotate() -> ResponseReturnValue:
@@ -78,7 +608,7 @@ def annotate() -> ResponseReturnValue:
     task specific entities
     :return: intent and task specific entities in JSON format
     """
-    return _annotate(_annotate_line)
+    return _annotate(slots_only=False)
 
 
 @app.route('/annotate_slots', methods=['GET', 'POST'])
@@ -88,7 +618,7 @@ def annotate_slots() -> ResponseReturnValue:
     task specific entities
     :return: intent and task specific entities in JSON format
     """
-    return _annotate(_annotate_line_slots)
+    return _annotate(slots_only=True)
 
 
 def _get_text_from_request(req: Request) -> tuple[str, str]:
@@ -96,7 +626,6 @@ def _get_text_from_request(req: Request) -> tuple[str, str]:
     Extract text from request.
     :return: text, linebreaks replaced by space
     """
-    # TODO: we need a new model for that: speaker info is missing
     prev_text = ''
     if req.method == 'GET':
         if 'text' not in req.args:
@@ -114,12 +643,233 @@ def _get_text_from_request(req: Request) -> tuple[str, str]:
     return text, prev_text
 
 
-def tokenize(line: str):
-    all_tokens = ['#BOS']
-    for token in line.split():
-        tokenized = tokenizer.tokenize(token)
-        all_tokens.extend(tokenized)
-    return all_tokens
+def _request_from_args(req: Request, text: str, prev_text: str,
+                       slots_only: bool) -> AnnotationRequest:
+    """
+    Annotation request with the optional query parameters (and the
+    X-Deadline-Ms header) of /annotate and /annotate_slots.
+    :raises ValueError: for invalid parameters
+    """
+    return AnnotationRequest(text, prev_text, slots_only=slots_only,
+                             speaker=req.args.get('speaker', type=str, default=''),
+                             prev_speaker=req.args.get('prev_speaker', type=str, default=''),
+                             stream=req.args.get('stream', type=str, default=''),
+                             revision=int(req.args.get('revision', default=0)),
+                             lane=_lane(req.args.get('priority', type=str),
+                                        req.args.get('session', type=str), 'normal'),
+                             deadline=_deadline(req.args.get('deadline_ms')
+                                                or req.headers.get('X-Deadline-Ms')))
+
+
+def _lane(priority: str | None, session: str | None, default: str) -> int:
+    """
+    :param priority: requested lane, None for the command lane for priority
+        channels and the default lane otherwise
+    :param session: session id, e.g. the radio channel
+    :return: index of the lane in lanes
+    :raises ValueError: for an unknown lane
+    """
+    if priority is None:
+        priority = lanes[0] if session in priority_channels else default
+    if priority not in lanes:
+        raise ValueError(f"unknown priority '{priority}', must be one of {lanes}")
+    return lanes.index(priority)
+
+
+def _deadline(deadline_ms) -> float | None:
+    """
+    :param deadline_ms: milliseconds from now, None or '' for no deadline
+    :return: deadline as time.monotonic()
+    :raises ValueError: if deadline_ms is not a number
+    """
+    if deadline_ms is None or deadline_ms == '':
+        return None
+    return time.monotonic() + float(deadline_ms) / 1000
+
+
+def _check_http_state(anno_request: AnnotationRequest, session: str | None) -> None:
+    """
+    Check that an HTTP request does not depend on the sessions or partial
+    hypotheses of a worker process, when the worker processes don't share
+    them and any of them gets HTTP requests.
+    :raises ValueError: if the previous turn would come from the session, or
+        for partial hypotheses
+    """
+    if http_state:
+        return
+    if session and session_store is not None and not anno_request.prev_text:
+        raise ValueError("with several worker processes, HTTP requests with a 'session' have "
+                         "to send 'prev_text', or use the WebSocket endpoint")
+    if anno_request.stream:
+        raise ValueError("with several worker processes, partial hypotheses ('stream') "
+                         "are only supported on the WebSocket endpoint")
+
+
+def _arrived(anno_request: AnnotationRequest, session: str | None) -> AnnotationRequest:
+    """
+    Register a new request: the revision of a partial hypothesis and, unless
+    it is superseded already, the utterance as the last turn of its session.
+    :param session: session id, e.g. the radio channel, None for no session
+    :return: the request with the previous turn and speaker of the session
+    """
+    if (anno_request.stream and hypotheses
+            and not hypotheses.submit(anno_request.stream, anno_request.revision)):
+        return anno_request._replace(superseded=True)
+    return _with_session(anno_request, session)
+
+
+def _with_session(anno_request: AnnotationRequest, session: str | None) -> AnnotationRequest:
+    """
+    Store the utterance as the last turn of its session, a partial hypothesis
+    replaces the previous revision of its utterance. If the client did not
+    send the previous turn, it is taken from the session.
+    :param session: session id, e.g. the radio channel, None for no session
+    :return: the request with the previous turn and speaker of the session
+    """
+    if not session or session_store is None:
+        return anno_request
+    previous = session_store.advance(session, Turn(anno_request.text, anno_request.speaker,
+                                                   anno_request.stream))
+    if previous is None or anno_request.prev_text:
+        return anno_request
+    return anno_request._replace(prev_text=previous.text,
+                                 prev_speaker=anno_request.prev_speaker or previous.speaker)
+
+
+@app.route('/annotate_batch', methods=['POST'])
+def annotate_batch_endpoint() -> ResponseReturnValue:
+    """
+    Annotate many utterances with one request. The body is a JSON array
+    (content-type application/json) or JSON lines (any other content-type) of
+    objects with 'text' and optional 'prev_text', 'speaker', 'prev_speaker',
+    'session', 'stream', 'revision', 'priority' (default bulk), 'deadline_ms',
+    'force_slots' and 'slots_only' fields. The utterances are annotated in batches and the
+    results are streamed back as soon as a batch is done.
+    :return: one JSON result per line, the same as /annotate or, with
+        'slots_only', /annotate_slots would return, or an 'error' object for
+        invalid items
+    """
+    if request.mimetype == 'application/json':
+        if (request.content_length or 0) > max_json_batch_bytes:
+            abort(413, description="JSON body too large, send JSON lines instead")
+        # at most one byte beyond the limit, for chunked bodies and bodies
+        # without a Content-Length
+        body = request.stream.read(max_json_batch_bytes + 1)
+        if len(body) > max_json_batch_bytes:
+            abort(413, description="JSON body too large, send JSON lines instead")
+        try:
+            with _stage('parse'):
+                items = json.loads(body)
+        except ValueError as e:
+            logger.error(e)
+            abort(400, description=e)
+        if not isinstance(items, list):
+            abort(400, description="JSON body must be an array")
+    else:
+        items = _read_json_lines(request)
+
+    def generate() -> Iterator[str]:
+        chunk: list[AnnotationRequest | str] = []
+        for item in _parse_batch_items(items):
+            chunk.append(item)
+            if len(chunk) == forward_batch_size:
+                yield from _annotate_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from _annotate_chunk(chunk)
+
+    return Response(stream_with_context(generate()), status=200,
+                    mimetype='application/x-ndjson')
+
+
+def _read_json_lines(req: Request) -> Iterator[str]:
+    """
+    Read the non-empty lines of the request body one after the other.
+    """
+    encoding = req.args.get('encoding', type=str, default='utf-8').lower()
+    for line in req.stream:
+        line = line.decode(encoding).strip()
+        if line:
+            yield line
+
+
+def _parse_batch_items(items) -> Iterator[AnnotationRequest | str]:
+    """
+    Convert the items of a batch request into annotation requests.
+    :param items: objects or JSON strings of objects
+    :return: an annotation request, or an error message for invalid items
+    """
+    for item in items:
+        yield _parse_batch_item(item, default_priority='bulk', http=True)
+
+
+def _parse_batch_item(item, session: str | None = None, default_priority: str = 'normal',
+                      http: bool = False) -> AnnotationRequest | str:
+    """
+    Convert an item of a batch request or a streamed message into an
+    annotation request.
+    :param item: object or JSON string of an object
+    :param session: session of items without a 'session' field, e.g. the
+        channel of a WebSocket
+    :param default_priority: lane of items without a 'priority' field that
+        are not from a priority channel
+    :param http: the item is from an HTTP request, not from a WebSocket
+    :return: an annotation request, or an error message for an invalid item
+    """
+    started = time.perf_counter()
+    try:
+        if isinstance(item, str):
+            item = json.loads(item)
+        if not isinstance(item, dict) or not isinstance(item.get('text'), str):
+            raise ValueError("item must be an object with a 'text' string")
+        if not isinstance(item.get('revision', 0), int):
+            raise ValueError("'revision' must be an integer")
+        for field in ('prev_text', 'speaker', 'prev_speaker', 'stream', 'session'):
+            if not isinstance(item.get(field) or '', str):
+                raise ValueError(f"'{field}' must be a string")
+        session = item.get('session') or session
+        anno_request = AnnotationRequest(item['text'], item.get('prev_text') or '',
+                                         bool(item.get('force_slots', False)),
+                                         bool(item.get('slots_only', False)),
+                                         item.get('speaker') or '',
+                                         item.get('prev_speaker') or '',
+                                         item.get('stream') or '',
+                                         item.get('revision', 0),
+                                         _lane(item.get('priority'), session, default_priority),
+                                         _deadline(item.get('deadline_ms')))
+        if http:
+            _check_http_state(anno_request, session)
+        parsed = _arrived(anno_request, session)
+    except (ValueError, TypeError) as e:
+        logger.error(e)
+        parsed = str(e)
+    stage_seconds.observe(time.perf_counter() - started, 'parse')
+    return parsed
+
+
+def _annotate_streamed(anno_request: AnnotationRequest) -> dict:
+    """
+    Annotate an utterance of a WebSocket stream the same way as /annotate.
+    :return: the annotation, or an error object if the scheduler rejected it
+    """
+    stream_messages_total.inc()
+    if not _stable(anno_request):
+        return _superseded_result(anno_request)
+    return _annotate_requests([anno_request], rejected_errors=True)[0]
+
+
+def _annotate_chunk(chunk: list[AnnotationRequest | str]) -> Iterator[str]:
+    """
+    Annotate the valid requests of a chunk in one batch.
+    :return: one JSON line per item of the chunk, in the same order, an error
+        line for the items that the scheduler rejected
+    """
+    anno_requests = [item for item in chunk if isinstance(item, AnnotationRequest)]
+    results = iter(_annotate_requests(anno_requests, rejected_errors=True))
+    with _stage('serialize'):
+        lines = [json.dumps(next(results) if isinstance(item, AnnotationRequest)
+                            else {'error': item}) + '\n' for item in chunk]
+    yield from lines
 
 
 def merge_labels(pred_labels, subtokens):
@@ -161,102 +911,508 @@ def merge_labels(pred_labels, subtokens):
         merged_labels.append('O')
     return merged_labels[1:]
 
+
+def merge_word_labels(pred_labels: list[str], word_ids: list[int | None],
+                      num_words: int) -> list[str]:
+    """
+    Merge the labels of the subtokens of every word into one label per word,
+    like merge_labels, but with the word boundaries of the tokenizer: B
+    overrides I, and I after O becomes B. Words without subtokens (cut off by
+    truncation) get O.
+    :param pred_labels: BIO label of every subtoken
+    :param word_ids: word index of every subtoken, None (or negative) for
+        special tokens and padding
+    :param num_words: number of words of the line
+    :return: BIO label of every word
+    """
+    word_labels = [set() for _ in range(num_words)]
+    for label, word in zip(pred_labels, word_ids):
+        if word is not None and word >= 0:
+            word_labels[word].add(label)
+    merged_labels = []
+    previous = 'O'
+    for current_labels in word_labels:
+        if 'B' in current_labels:
+            previous = 'B'
+        elif 'I' in current_labels:
+            previous = 'B' if previous == 'O' else 'I'
+        else:
+            previous = 'O'
+        merged_labels.append(previous)
+    return merged_labels
+
+
+def align_word_labels(word_labels: list[str], word_ids: list[int | None],
+                      label2id: dict[str, int]) -> list[int]:
+    """
+    Spread the labels of words over their subtokens for training: the first
+    subtoken of a word gets the label of the word, the following ones I (O
+    outside of phrases). Special tokens get O.
+    :param word_labels: BIO label of every word
+    :param word_ids: word index of every subtoken, None for special tokens
+    :param label2id: ids of the labels
+    :return: label id of every subtoken
+    """
+    label_ids = []
+    previous_word = None
+    for word in word_ids:
+        if word is None:
+            label_ids.append(label2id['O'])
+        elif word != previous_word:
+            label_ids.append(label2id[word_labels[word]])
+        elif word_labels[word] == 'O':
+            label_ids.append(label2id['O'])
+        else:
+            label_ids.append(label2id['I'])
+        previous_word = word
+    return label_ids
+
+
+def _tokenize(lines: list[str] | list[list[str]], max_length: int,
+              split_words: bool = False):
+    """
+    Encode lines in one call of the fast tokenizer.
+    :param lines: strings, or lists of words with split_words
+    :param split_words: lines are split into words, the encoding then has
+        the word index of every subtoken (word_ids)
+    """
+    # including the time waiting for the lock
+    with _stage('tokenize'), tokenizer_lock:
+        return tokenizer(lines, max_length=max_length, truncation=True,
+                         add_special_tokens=True, is_split_into_words=split_words)
+
+
+def _buckets(encoded) -> list[dict[str, torch.Tensor]]:
+    """
+    Group encoded lines into buckets of similar length and pad every bucket
+    to its longest line.
+    :return: the indices of the lines and the padded encodings per bucket
+    """
+    buckets = []
+    for bucket in length_buckets([len(ids) for ids in encoded['input_ids']],
+                                 forward_batch_size):
+        buckets.append({
+            'indices': bucket,
+            'input_ids': pad_sequences([encoded['input_ids'][i] for i in bucket],
+                                       tokenizer.pad_token_id).to(device),
+            'attention_mask': pad_sequences([encoded['attention_mask'][i] for i in bucket],
+                                            0).to(device),
+            'token_type_ids': pad_sequences([encoded['token_type_ids'][i] for i in bucket],
+                                            0).to(device),
+        })
+    return buckets
+
+
+@contextmanager
+def _stage(stage: str) -> Iterator[None]:
+    """
+    Observe the time of a processing stage, and mark it in the profile of a
+    profiled request.
+    """
+    with stage_seconds.time(stage), stage_range(stage_prefix + stage):
+        yield
+
+
+@contextmanager
+def _forward_timer(adapter: str) -> Iterator[None]:
+    """
+    Observe the time of a forward pass, including the time the GPU takes to
+    finish it, and mark it in the profile of a profiled request.
+    """
+    with forward_seconds.time(adapter), stage_range(forward_prefix + adapter):
+        yield
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+
+
+def dact_logits(tensor: torch.Tensor, mask: torch.Tensor,
+                token_type_ids: torch.Tensor | None = None) -> torch.Tensor:
+    """
+    Run the 'dact' adapter and head on a batch of encoded lines.
+    :return: classification logits, shape (batch, labels)
+    """
+    if backend == 'onnx':
+        with _forward_timer('dact'):
+            return model.dact_logits(tensor, mask, token_type_ids)
+    from adapters import AdapterSetup
+
+    with torch.inference_mode(), AdapterSetup('dact'), _forward_timer('dact'):
+        return model(tensor, attention_mask=mask, token_type_ids=token_type_ids)[0]
+
+
+def classify_dialogue_acts(lines: list[str]) -> list[str]:
+    """
+    Run the 'dact' adapter and head on a batch of (already cleaned) lines.
+    :param lines: dialogue act classifier input, one string per utterance
+    :return: the dialogue act label for every line
+    """
+    dialogue_acts = [''] * len(lines)
+    for bucket in _buckets(_tokenize(lines, max_len_dact)):
+        logits = dact_logits(bucket['input_ids'], bucket['attention_mask'],
+                             bucket['token_type_ids'])
+        with _stage('decode'):
+            for i, k in zip(bucket['indices'], torch.argmax(logits, 1).tolist()):
+                dialogue_acts[i] = dact_id2label[k]
+    return dialogue_acts
+
+
+def annotate_batch(anno_requests: list[AnnotationRequest]) -> list[dict]:
+    """
+    Annotate a batch of requests. The dialogue acts of all requests are
+    classified in one batch, then all lines that need slots are tagged in
+    another one.
+    :return: the annotation of every request, in the same order
+    """
+    results: list[dict] = [dict() for _ in anno_requests]
+    da_indices = [i for i, req in enumerate(anno_requests) if not req.slots_only]
+    with _stage('strip_punctuation'):
+        da_lines = [_dact_input(anno_requests[i]) for i in da_indices]
+    if da_lines:
+        for i, dialogue_act in zip(da_indices, classify_dialogue_acts(da_lines)):
+            results[i]['dialogue_act'] = dialogue_act
+
+    slot_indices = []
+    for i, req in enumerate(anno_requests):
+        if (req.slots_only or req.force_slots
+                or results[i]['dialogue_act'] in da_with_slot):
+            slot_indices.append(i)
+        else:
+            results[i]['text'] = req.text
+    if slot_indices:
+        slot_results = annotate_slots_batch([anno_requests[i].text for i in slot_indices])
+        for i, slot_result in zip(slot_indices, slot_results):
+            results[i].update(slot_result)
+    return results
+
+
+def _dact_input(anno_request: AnnotationRequest) -> str:
+    """
+    Input of the dialogue act classifier in the dact_input_format, the same as
+    adapters_classifier.build_intext() builds for training, but without
+    punctuation in the turns. Without a previous turn, there is no context for
+    with_context and the placeholders of the training data otherwise.
+    """
+    text = anno_request.text.translate(remove_punct)
+    prev_text = anno_request.prev_text.translate(remove_punct)
+    if dact_input_format == "without_context_and_without_speaker":
+        return text
+    if dact_input_format == "without_context_with_current_speaker":
+        return anno_request.speaker + ' [SEP] ' + text
+    if dact_input_format == "with_context_with_current_and_previous_speaker":
+        if not anno_request.prev_text:
+            return 'None [SEP] Start [SEP] ' + anno_request.speaker + ' [SEP] ' + text
+        return (anno_request.prev_speaker + ' [SEP] ' + prev_text + ' [SEP] '
+                + anno_request.speaker + ' [SEP] ' + text)
+    if anno_request.prev_text:
+        return prev_text + ' [SEP] ' + text
+    return text
+
+
 def _annotate_line(line: str, prev_line: str, force_slots:bool = False):
-    clean_line = line.translate(remove_punct)
-    if prev_line:
-        da_clean_line = (prev_line.translate(remove_punct) + ' [SEP] '
-                         + clean_line)
-    else:
-        da_clean_line = clean_line
+    return annotate_batch([AnnotationRequest(line, prev_line, force_slots)])[0]
+
+
+def _annotate_line_slots(line: str, prev_line="") -> dict[str, dict[str, list[str]]]:
+    return annotate_slots_batch([line])[0]
+
+
+def slot_logits(tensor: torch.Tensor, mask: torch.Tensor) -> dict[str, torch.Tensor]:
+    """
+    Run the slot tagging adapters and heads on a batch of encoded lines.
+    With parallel_slots, all taggers share one forward pass through the base
+    model (the input is replicated once per task by the Parallel block),
+    otherwise the tasks are run one after the other.
+    :param tensor: input ids, shape (batch, sequence)
+    :param mask: attention mask, shape (batch, sequence)
+    :return: tagging logits of shape (batch, sequence, labels) per task
+    """
+    if backend == 'onnx':
+        # the exported graph runs all taggers in parallel
+        with _forward_timer('parallel'):
+            return model.slot_logits(tensor, mask)
+    from adapters import AdapterSetup
+    from adapters.composition import Parallel
+
+    task_logits = {}
+    with torch.inference_mode():
+        if parallel_slots:
+            with AdapterSetup(Parallel(*tasks)), _forward_timer('parallel'):
+                model_result = model(tensor, attention_mask=mask)
+            # without a global Parallel setup every head gets the output of
+            # all replicas, task k is the k-th slice of the batch
+            batch_size = tensor.shape[0]
+            for k, (task, head_result) in enumerate(zip(tasks, model_result.head_outputs)):
+                task_logits[task] = head_result[0][k * batch_size:(k + 1) * batch_size]
+        else:
+            for task in tasks:
+                # adapter and head for current task
+                with AdapterSetup(task), _forward_timer(task):
+                    task_logits[task] = model(tensor, attention_mask=mask)[0]
+    return task_logits
+
+
+def _decode_bucket(task_logits: dict[str, torch.Tensor], indices: list[int], encoded,
+                   words: list[list[str]], line_phrases: list[dict[str, list[str]]]) -> None:
+    """
+    Decode the slot phrases of all tasks and lines of a bucket at once.
+    :param task_logits: tagging logits of the bucket per task
+    :param indices: indices of the lines of the bucket
+    :param encoded: the tokenizer output for all lines
+    :param words: the words of all lines
+    :param line_phrases: phrases per task of all lines, the phrases of the
+        bucket are added
+    """
+    # shape (task, line, subtoken)
+    predictions = torch.argmax(torch.stack([task_logits[task] for task in tasks]), 3).cpu()
+    word_ids = pad_sequences([[-1 if word is None else word for word in encoded.word_ids(i)]
+                              for i in indices], -1, predictions.shape[2])
+    num_words = max(len(words[i]) for i in indices)
+    for t, k, start, end in decode_spans(predictions, word_ids, num_words,
+                                         label2id['B'], label2id['I']).tolist():
+        line_phrases[indices[k]].setdefault(tasks[t], []).append(
+            ' '.join(words[indices[k]][start:end]))
+
+
+def annotate_slots_batch(lines: list[str]) -> list[dict[str, dict[str, list[str]]]]:
+    """
+    Tag the slots of a batch of lines.
+    :return: text and slot phrases for every line
+    """
+    with _stage('strip_punctuation'):
+        clean_lines = [line.translate(remove_punct) for line in lines]
+        words = [clean_line.split() for clean_line in clean_lines]
+    encoded = _tokenize(words, max_len_bio, split_words=True)
+    line_phrases: list[dict[str, list[str]]] = [dict() for _ in lines]
+    for bucket in _buckets(encoded):
+        task_logits = slot_logits(bucket['input_ids'], bucket['attention_mask'])
+        with _stage('decode'):
+            _decode_bucket(task_logits, bucket['indices'], encoded, words, line_phrases)
+    results = []
+    for line, clean_line, phrases in zip(lines, clean_lines, line_phrases):
+        logger.info(f'processing "{clean_line}"..')
+        for task, task_phrases in phrases.items():
+            logger.info(f'{task} phrases: {task_phrases}')
+        results.append({'text': line, 'phrases': phrases})
+    return results
 
-    model.active_adapters = 'dact'
-    model.active_head = 'dact'
 
-    dact_classifier = pipeline(model=model, tokenizer=tokenizer, device=device,
-                               task='text-classification')
-    turn_annotation = dict()
-    turn_annotation['dialogue_act'] = dact_classifier(da_clean_line)[0]['label']
-    if force_slots or turn_annotation['dialogue_act'] in da_with_slot:
-        turn_annotation.update(_annotate_line_slots(line))
+def init_model() -> None:
+    """
+    Load the base model, the tokenizer and all adapters and heads. Everything
+    that does not depend on the input is prepared here once, so the request
+    handlers only have to run the forward passes.
+    """
+    logger.info("initializing model...")
+    from transformers import AutoTokenizer
+
+    if backend == 'onnx':
+        if quantize:
+            raise ValueError("the onnx backend does not support quantization")
+        new_model = OnnxModel(onnx_dir)
+        if new_model.tasks != tasks:
+            raise ValueError(f"{onnx_dir} has the tasks {new_model.tasks}, not {tasks}")
+        new_tokenizer = AutoTokenizer.from_pretrained(model_name)
+        new_dact_id2label = new_model.dact_id2label
     else:
-        turn_annotation['text'] = line
-    return turn_annotation
+        if bundle_dir:
+            new_model, new_tokenizer = model_bundle.load(bundle_dir)
+        else:
+            from adapters import AutoAdapterModel
+            from transformers import AutoConfig
 
+            AutoConfig.from_pretrained(model_name, num_label=len(labels), id2label=id2label,
+                                       label2id=label2id, layers=2)
+            new_model = AutoAdapterModel.from_pretrained(model_name)
+            new_tokenizer = AutoTokenizer.from_pretrained(model_name)
+            for task in ['dact'] + tasks:
+                # load adapters and heads
+                new_model.load_adapter(adapters_dir + "/" + task)
+        new_model.to(device)
+        new_model.eval()
+        if quantize:
+            if device != 'cpu':
+                raise ValueError(f"quantized inference is only supported on the cpu, not {device}")
+            quantize_model(new_model)
+        logger.info(f"model weights: {model_size_mb(new_model):.1f}MB")
+        new_dact_id2label = new_model.get_labels_dict('dact')
+    global model, tokenizer, dact_id2label
+    model, tokenizer, dact_id2label = new_model, new_tokenizer, new_dact_id2label
+    if result_cache:
+        result_cache.clear()
+    logger.info("model initialized")
 
-def _annotate_line_slots(line: str, prev_line="") -> dict[str, dict[str, list[str]]]:
-    clean_line = line.translate(remove_punct)
-    subtokens = tokenize(clean_line)
-    encoded_line = tokenizer(clean_line,
-                             padding="max_length", max_length=max_len_bio,
-                             truncation=True, add_special_tokens=True)
-    tensor = torch.tensor([encoded_line['input_ids']]).to(device)
-    mask = torch.tensor([encoded_line['attention_mask']]).to(device)
-    logger.info(f'processing "{clean_line}"..')
-    result = {}
-    for task in tasks:
-        # set adapter and head for current task
-        model.active_adapters = task
-        model.active_head = task
-
-        # get predications
-        model_result = model(tensor, attention_mask=mask)
-        predictions = torch.argmax(model_result[0], 2)[0].tolist()
-
-        # merge subtokens and labels
-        merged_labels = merge_labels([id2label[k] for k in predictions], subtokens)
-
-        # group tagged tokens into tagged phrases
-        phrases = []
-        current_phrase = ''
-        for la, to in zip(merged_labels, clean_line.split()):
-            if la == 'B':  # beginning of a new phrase
-                if current_phrase:  # if a phrase is already being built, add it to phrases
-                    phrases.append(current_phrase)
-                current_phrase = to  # start a new phrase with the current token
-            elif la == 'I':  # continuation of the current phrase
-                current_phrase += ' ' + to
-            else:  # if it's an 'O' (outside), finalize the current phrase (if any)
-                if current_phrase:
-                    phrases.append(current_phrase)
-                    current_phrase = ''
-        # add the last phrase if it exists
-        if current_phrase:
-            phrases.append(current_phrase)
-        if phrases:
-            logger.info(f'{task} phrases: {phrases}')
-            result[task] = phrases
-
-    return {'text': line, 'phrases': result}
-
-
-def start_server(port: int, host: str) -> None:
+
+def prewarm_cache(size: int) -> None:
+    """
+    Fill the result cache with the most frequent utterances of the training
+    data, for /annotate (with their previous turn and, if the dialogue act
+    classifier uses them, speakers) and /annotate_slots.
+    :param size: number of utterances per endpoint
+    """
+    with_speakers = 'speaker' in dact_input_format
+    turns: Counter = Counter()
+    for fname in prewarm_csvs:
+        with open(fname, newline='') as f:
+            for row in csv.DictReader(f):
+                prev_text = row.get('previous') or ''
+                speaker = prev_speaker = ''
+                if with_speakers:
+                    speaker = row.get('speakers') or ''
+                    prev_speaker = row.get('previous_speakers') or ''
+                turns[row['tokens'], '' if prev_text == 'Start' else prev_text, speaker,
+                      '' if prev_speaker == 'None' else prev_speaker] += 1
+    texts: Counter = Counter()
+    for (text, *_), count in turns.items():
+        texts[text] += count
+    anno_requests = [AnnotationRequest(text, prev_text, speaker=speaker,
+                                       prev_speaker=prev_speaker)
+                     for (text, prev_text, speaker, prev_speaker), _ in turns.most_common(size)]
+    anno_requests += [AnnotationRequest(text, slots_only=True)
+                      for text, _ in texts.most_common(size)]
+    for start in range(0, len(anno_requests), forward_batch_size):
+        _annotate_requests(anno_requests[start:start + forward_batch_size])
+    logger.info(f"cache pre-warmed with {len(anno_requests)} utterances")
+
+
+def warm_up() -> None:
+    """
+    Annotate an utterance on its own and in a full batch, so that the first
+    requests don't pay for the lazy initialization of kernels and memory.
+    """
+    anno_request = AnnotationRequest("UGV fahr bitte über die Wiese zum Eingang", "Start",
+                                     force_slots=True)
+    annotate_batch([anno_request])
+    annotate_batch([anno_request] * forward_batch_size)
+
+
+def start_server(port: int, host: str, threads: int = 4, workers: int = 1,
+                 torch_threads: int = 0, micro_batch: bool = False,
+                 batch_size: int = 16, batch_wait_ms: float = 5.0,
+                 max_queue: int = 256, cache_size: int = 0, cache_ttl: float = 3600.0,
+                 cache_prewarm: int = 0, ws_port: int = 0, ws_max_pending: int = 16,
+                 max_sessions: int = 10000, session_timeout: float = 600.0,
+                 debounce_ms: float = 0.0) -> None:
     """
     The main function
     :param port: server port, None if not provided
     :param host: server host ip, None if not provided
+    :param threads: number of request threads (per worker process)
+    :param workers: number of worker processes sharing one copy of the model
+    :param torch_threads: number of torch threads per process, 0 for the default
+    :param micro_batch: collect concurrent requests into batches
+    :param batch_size: maximal number of requests per batch
+    :param batch_wait_ms: maximal time to wait for a batch to fill up
+    :param max_queue: maximal number of waiting requests, 0 for unlimited
+    :param cache_size: maximal number of cached results, 0 for no caching
+    :param cache_ttl: seconds a cached result stays valid, 0 for no expiry
+    :param cache_prewarm: number of frequent utterances to pre-warm the cache with
+    :param ws_port: port of the WebSocket streaming endpoint, 0 for no streaming
+    :param ws_max_pending: maximal number of pending utterances per WebSocket
+    :param max_sessions: maximal number of sessions with a stored turn, 0 for
+        no sessions
+    :param session_timeout: seconds after the last turn until a session is
+        dropped, 0 for no timeout
+    :param debounce_ms: time a partial hypothesis has to be stable before it
+        is annotated
     """
+    server_started = time.perf_counter()
+    logger.info(f"startup: imports took {server_started - import_started:.2f}s")
+    if cache_size:
+        global result_cache
+        result_cache = ResultCache(max_entries=cache_size, ttl=cache_ttl)
+    if max_sessions:
+        # per worker process, a WebSocket stays with its worker, HTTP requests don't
+        global session_store
+        session_store = SessionStore(max_sessions=max_sessions, idle_timeout=session_timeout)
+    global hypotheses, http_state
+    hypotheses = HypothesisTracker(debounce_ms=debounce_ms)
+    if workers > 1:
+        http_state = False
+        logger.warning(f"sessions and partial hypotheses are kept per worker process: with "
+                       f"{workers} workers, HTTP requests with a 'session' have to send "
+                       f"'prev_text' and can't send partial hypotheses ('stream'), both only "
+                       f"work on the WebSocket endpoint")
 
-    # init model
-    logger.info("initializing model...")
-    AutoConfig.from_pretrained(model_name, num_label=len(labels), id2label=id2label,
-                               label2id=label2id, layers=2)
-    global model
-    model = AutoAdapterModel.from_pretrained(model_name)
-    global tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    for task in ['dact'] + tasks:
-        # load adapters and heads
-        model.load_adapter(adapters_dir + "/" + task)
-    model.to(device)
-    model.eval()
-    logger.info("model initialized")
+    def load() -> None:
+        started = time.perf_counter()
+        init_model()
+        logger.info(f"startup: loading the model took {time.perf_counter() - started:.2f}s")
+
+    def prepare() -> None:
+        started = time.perf_counter()
+        warm_up()
+        warmed_up = time.perf_counter()
+        logger.info(f"startup: warm-up took {warmed_up - started:.2f}s")
+        if cache_prewarm and result_cache:
+            prewarm_cache(cache_prewarm)
+            logger.info(f"startup: pre-warming the cache took "
+                        f"{time.perf_counter() - warmed_up:.2f}s")
+        model_ready.set()
+        logger.info(f"startup: ready after {time.perf_counter() - import_started:.2f}s")
+
+    def prepare_in_background(load_model: bool) -> None:
+        try:
+            if load_model:
+                load()
+            prepare()
+        except Exception as e:
+            logger.exception(e)
+            os._exit(1)
 
     # start server
     if not port:
         port = 5050
     if not host:
         host = '0.0.0.0'
-    serve(app, host=host, port=port)
+    # like the WSGI socket, shared by all workers
+    ws_sock = socket.create_server((host, ws_port), backlog=1024) if ws_port else None
+
+    def run_worker(**listen) -> None:
+        if micro_batch:
+            global scheduler
+            scheduler = MicroBatchScheduler(_annotate_current, max_batch_size=batch_size,
+                                            max_wait_ms=batch_wait_ms, max_queue=max_queue,
+                                            lane_shares=lane_shares)
+            scheduler.start()
+            logger.info(f"micro-batching: batch size {batch_size}, "
+                        f"wait {batch_wait_ms}ms, queue {max_queue}")
+        if ws_sock:
+            global stream_server
+            stream_server = StreamServer(_annotate_streamed, _parse_batch_item, model_ready,
+                                         threads=threads, max_pending=ws_max_pending)
+            stream_server.start(ws_sock)
+        serve(app, threads=threads, **listen)
+
+    if workers > 1:
+        if device != 'cpu':
+            raise ValueError(f"worker processes can't share the model on {device}")
+        if backend == 'onnx':
+            raise ValueError("worker processes can't share ONNX Runtime sessions")
+        # the workers are forked with the loaded weights; the parent loads
+        # them with one thread, because the children of a process whose
+        # OpenMP thread pool is running can deadlock
+        worker_threads = torch_threads or torch.get_num_threads()
+        torch.set_num_threads(1)
+        load()
+
+        def init_worker() -> None:
+            torch.set_num_threads(worker_threads)
+            # warm-up forward passes in the worker, after the fork
+            threading.Thread(target=prepare_in_background, args=(False,),
+                             name='model-loader', daemon=True).start()
+
+        # all workers accept connections from the same listening socket
+        sock = socket.create_server((host, int(port)), backlog=1024)
+        global worker_pool
+        worker_pool = WorkerPool(workers, lambda: run_worker(sockets=[sock]), init_worker)
+        worker_pool.run()
+    else:
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        # accept connections (/alive, /ready) while the model is loading
+        threading.Thread(target=prepare_in_background, args=(True,), name='model-loader',
+                         daemon=True).start()
+        run_worker(host=host, port=port)
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -267,6 +1423,73 @@ def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('-ho', '--host', help="server host ip (optional, default 0.0.0.0")
     parser.add_argument('-p', '--port', help="server port (optional, default 5050)")
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help="number of request threads per worker (optional, default 4)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of worker processes sharing the model (optional, default 1)")
+    parser.add_argument('--torch-threads', type=int, default=0,
+                        help="number of torch threads per worker (optional, default: torch default)")
+    parser.add_argument('--parallel-slots', action='store_true',
+                        help="tag all slots in one forward pass (Parallel adapter composition)")
+    parser.add_argument('-q', '--quantize', action='store_true',
+                        help="dynamic INT8 quantization of the model (CPU only), see "
+                             "evaluate_quantization.py for its effect on accuracy")
+    parser.add_argument('--backend', choices=['torch', 'onnx'], default='torch',
+                        help="inference backend (optional, default torch), the onnx backend "
+                             "needs the graphs written by export_onnx.py")
+    parser.add_argument('--bundle',
+                        help="load the model from a bundle written by build_bundle.py "
+                             "(optional, default: base model and adapter folders)")
+    parser.add_argument('--onnx-dir', default=onnx_dir,
+                        help=f"folder of the exported ONNX graphs (optional, default {onnx_dir})")
+    parser.add_argument('-b', '--micro-batch', action='store_true',
+                        help="collect concurrent requests into batches")
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help="maximal number of requests per batch (optional, default 16)")
+    parser.add_argument('--batch-wait-ms', type=float, default=5.0,
+                        help="maximal time to wait for a batch to fill up (optional, default 5)")
+    parser.add_argument('--max-queue', type=int, default=256,
+                        help="maximal number of waiting requests, 0 for unlimited (optional, default 256)")
+    parser.add_argument('--priority-channels', default='',
+                        help="comma-separated sessions (radio channels) whose requests are "
+                             "micro-batched before all others (optional)")
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help="maximal number of cached results, 0 for no caching (optional, default 0)")
+    parser.add_argument('--cache-ttl', type=float, default=3600.0,
+                        help="seconds a cached result stays valid, 0 for no expiry "
+                             "(optional, default 3600)")
+    parser.add_argument('--cache-prewarm', type=int, default=0,
+                        help="pre-warm the cache with this number of frequent utterances "
+                             "(optional, default 0)")
+    parser.add_argument('--ws-port', type=int, default=0,
+                        help="port of the WebSocket streaming endpoint /stream/<channel> "
+                             "(optional, default: no streaming)")
+    parser.add_argument('--ws-max-pending', type=int, default=16,
+                        help="maximal number of utterances per WebSocket being annotated or "
+                             "waiting to be sent (optional, default 16)")
+    parser.add_argument('--sessions', type=int, default=10000,
+                        help="maximal number of sessions (e.g. radio channels) whose last turn "
+                             "is kept as the context of the next one, 0 for no sessions "
+                             "(optional, default 10000)")
+    parser.add_argument('--session-timeout', type=float, default=600.0,
+                        help="seconds after the last turn until a session is dropped, 0 for "
+                             "no timeout (optional, default 600)")
+    parser.add_argument('--debounce-ms', type=float, default=0.0,
+                        help="annotate a partial hypothesis (with 'stream' and 'revision') only "
+                             "after no newer revision arrived for this long (optional, default 0)")
+    parser.add_argument('--dact-input', choices=dact_input_formats, default=dact_input_format,
+                        help="input format of the dialogue act classifier, the anno_type of "
+                             "adapters_classifier.py the dact adapter was trained with "
+                             f"(optional, default {dact_input_format})")
+    parser.add_argument('--profiling', action='store_true',
+                        help="profile requests with ?profile=1 or the X-Profile header")
+    parser.add_argument('--profile-sample', type=float, default=0.0,
+                        help="fraction of requests to profile (optional, default 0)")
+    parser.add_argument('--profile-slow-ms', type=float, default=0.0,
+                        help="only write sampled profiles of requests taking at least this "
+                             "long (optional, default 0)")
+    parser.add_argument('--profile-dir', default=profile_dir,
+                        help=f"folder of the profiles (optional, default {profile_dir})")
     parsed_args = parser.parse_args()
     return parsed_args
 
@@ -274,4 +1497,22 @@ def parse_arguments() -> argparse.Namespace:
 if __name__ == '__main__':
     # read command-line arguments and pass them to main function
     args = parse_arguments()
-    start_server(args.host, args.port)
+    parallel_slots = args.parallel_slots
+    quantize = args.quantize
+    backend = args.backend
+    onnx_dir = args.onnx_dir
+    bundle_dir = args.bundle
+    dact_input_format = args.dact_input
+    priority_channels = {channel for channel in args.priority_channels.split(',') if channel}
+    profiling_enabled = args.profiling
+    profile_sample = args.profile_sample
+    profile_slow_ms = args.profile_slow_ms
+    profile_dir = args.profile_dir
+    start_server(args.port, args.host, threads=args.threads, workers=args.workers,
+                 torch_threads=args.torch_threads, micro_batch=args.micro_batch,
+                 batch_size=args.batch_size, batch_wait_ms=args.batch_wait_ms,
+                 max_queue=args.max_queue, cache_size=args.cache_size,
+                 cache_ttl=args.cache_ttl, cache_prewarm=args.cache_prewarm,
+                 ws_port=args.ws_port, ws_max_pending=args.ws_max_pending,
+                 max_sessions=args.sessions, session_timeout=args.session_timeout,
+                 debounce_ms=args.debounce_ms)
@@ -1,14 +1,17 @@
 #!/bin/env python
-import datasets
 from adapters import AutoAdapterModel, AdapterConfig, AdapterTrainer
-from transformers import TrainingArguments, EvalPrediction, AutoTokenizer
-from transformers import pipeline
+from transformers import TrainingArguments, EvalPrediction, AutoTokenizer, DataCollatorWithPadding
 import torch
 import os
 import sys
 from pathlib import Path
 
 import numpy as np
+from sklearn.metrics import confusion_matrix
+
+from adapter_training import bucketed_dataloader
+from dataset_cache import load_encoded_csv
+from length_bucketing import PadCollator
 
 os.environ["WANDB_DISABLED"] = "true"
 
@@ -28,6 +31,8 @@ anno_type = 'with_context'
 # low_resource_turn_and_speaker
 
 batch_size = 16#32
+# sequences per forward pass in the evaluation
+eval_batch_size = 64
 model_name = "bert-base-german-cased"
 
 data_folder = "csv_da_annotations/csv" + (
@@ -53,6 +58,12 @@ id2label = dict()
 for k,v in label2id.items():
     id2label[v] = k
 
+def truncate_summary(summary):
+    # the last 250 words of the summary of the dialogue so far
+    if summary is None:
+        return "Start"
+    return " ".join(summary.split()[-250:])
+
 def build_intext(data):
     encoded = None
     if anno_type=="without_context_and_without_speaker":
@@ -72,19 +83,97 @@ def build_intext(data):
 def encode_data(data):
     encoded = None
     if anno_type=="without_context_and_without_speaker":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=128, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=128, truncation=True, add_special_tokens=True)
     elif anno_type=="without_context_with_current_speaker" or anno_type=="low_resource_turn_and_speaker":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=256, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=256, truncation=True, add_special_tokens=True)
     elif anno_type=="with_context_with_current_and_previous_speaker":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=256, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=256, truncation=True, add_special_tokens=True)
     elif anno_type=="with_context":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=256, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=256, truncation=True, add_special_tokens=True)
     elif anno_type=="iso_simplified" or anno_type=="iso":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=256, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=256, truncation=True, add_special_tokens=True)
     elif anno_type=="summary":
-        encoded = tokenizer(build_intext(data), pad_to_max_length=True, padding="max_length", max_length=512, truncation=True, add_special_tokens=True)
+        encoded = tokenizer(build_intext(data), max_length=512, truncation=True, add_special_tokens=True)
     return encoded
 
+def encode_test_data(data):
+    # not truncated, like the text-classification pipeline that the
+    # evaluation used before
+    return tokenizer(build_intext(data), add_special_tokens=True)
+
+
+def load_encoded_dataset(csv_file, batch_size=batch_size, encode=encode_data):
+    """
+    :param encode: encode_data for training, encode_test_data for evaluation
+    :return: the encoded data set of a CSV file, from the data set cache if
+        it was encoded before
+    """
+    return load_encoded_csv(csv_file, encode, tokenizer, batch_size=batch_size,
+                            anno_type=anno_type, build_intext=build_intext)
+
+
+def dact_scores(gold_labels, predicted_labels):
+    """
+    Scores of dialogue act predictions, computed from their confusion matrix.
+    :param gold_labels: label ids of the samples
+    :param predicted_labels: predicted label ids of the samples
+    :return: accuracy, confusion matrix, f1 score per label, and macro, micro
+        and weighted f1
+    """
+    gold_labels = np.asarray(gold_labels)
+    predicted_labels = np.asarray(predicted_labels)
+    matrix = confusion_matrix(gold_labels, predicted_labels, labels=np.arange(len(label2id)))
+    tp = np.diag(matrix).astype(float)
+    fp = matrix.sum(axis=0) - tp
+    fn = matrix.sum(axis=1) - tp
+    prec = np.divide(tp, tp + fp, out=np.zeros_like(tp), where=tp + fp > 0)
+    rec = np.divide(tp, tp + fn, out=np.zeros_like(tp), where=tp + fn > 0)
+    f1 = np.divide(2 * prec * rec, prec + rec, out=np.zeros_like(tp), where=prec + rec > 0)
+    matched = int(tp.sum())
+    errors = (fp + fn).sum()
+    # the f1 score of every label is weighted with the number of samples of
+    # all labels up to it (in label2id order), as the evaluation always did
+    weights = np.cumsum(tp + (fp + fn) / 2)
+    return {"accuracy": matched / len(gold_labels), "matched": matched,
+            "total": len(gold_labels), "confusion_matrix": matrix,
+            "f1": {id2label[i]: float(f1[i]) for i in range(len(f1))},
+            "macro_f1": float(f1.mean()),
+            "micro_f1": float(matched / (matched + .5 * errors)),
+            "weighted_f1": float((f1 * weights).sum() / weights[-1])}
+
+def print_dact_scores(scores):
+    print("Accuracy:", round(scores["accuracy"],3), "matched:", scores["matched"], "total:", scores["total"])
+    print("F1 scores:")
+    for label, f1score in scores["f1"].items():
+        print(label, "F1:", round(f1score,3))
+    print("Macro F1:", round(scores["macro_f1"],3))
+    print("Micro F1:", round(scores["micro_f1"],3))
+    print("Weighted F1:", round(scores["weighted_f1"],3))
+
+def compute_dact_metrics(p: EvalPrediction):
+    scores = dact_scores(p.label_ids, np.argmax(p.predictions, axis=1))
+    return {"acc": scores["accuracy"], "macro_f1": scores["macro_f1"],
+            "micro_f1": scores["micro_f1"], "weighted_f1": scores["weighted_f1"]}
+
+def predict(dataset, label_column="tags"):
+    """
+    Classify an encoded data set in batches of sequences of similar length.
+    :return: gold and predicted label ids, in the order of the batches
+    """
+    dataset = dataset.with_format(type="torch", columns=["input_ids", "token_type_ids",
+                                                         "attention_mask", label_column])
+    collate = PadCollator({"input_ids": tokenizer.pad_token_id, "token_type_ids": 0,
+                           "attention_mask": 0})
+    gold_labels = []
+    predicted_labels = []
+    with torch.no_grad():
+        for batch in bucketed_dataloader(dataset, collate, eval_batch_size):
+            outputs = model(batch["input_ids"].to(device),
+                            token_type_ids=batch["token_type_ids"].to(device),
+                            attention_mask=batch["attention_mask"].to(device))
+            predicted_labels.append(torch.argmax(outputs[0], -1).cpu())
+            gold_labels.append(batch[label_column])
+    return torch.cat(gold_labels).numpy(), torch.cat(predicted_labels).numpy()
 
 def compute_accuracy(p: EvalPrediction):
     preds = np.argmax(p.predictions, axis=1)
@@ -127,12 +216,10 @@ def training():
     model.set_active_adapters(task)
     model.train_adapter(task)
 
-    train_dataset = datasets.Dataset.from_csv(data_folder+"/"+low_resource_annotation_prefix+"train.csv")
-    train_dataset = train_dataset.map(encode_data, batched=True, batch_size=batch_size)
+    train_dataset = load_encoded_dataset(data_folder+"/"+low_resource_annotation_prefix+"train.csv")
     train_dataset = train_dataset.rename_column("tokens","text").rename_column("tags","labels")
 
-    dev_dataset = datasets.Dataset.from_csv(data_folder+"/"+low_resource_annotation_prefix+"dev.csv")
-    dev_dataset = dev_dataset.map(encode_data, batched=True, batch_size=batch_size)
+    dev_dataset = load_encoded_dataset(data_folder+"/"+low_resource_annotation_prefix+"dev.csv")
     dev_dataset = dev_dataset.rename_column("tokens","text").rename_column("tags","labels")
 
     train_dataset.set_format(type="torch", columns=["input_ids", "attention_mask", "labels"])
@@ -150,6 +237,8 @@ def training():
         output_dir="training_output",
         overwrite_output_dir=True,
         remove_unused_columns=False,
+        # batches of similar length, padded to their longest sequence
+        group_by_length=True,
     )
 
 
@@ -158,7 +247,8 @@ def training():
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=dev_dataset,
-        compute_metrics=compute_accuracy,
+        data_collator=DataCollatorWithPadding(tokenizer),
+        compute_metrics=compute_dact_metrics,
     )
 
     trainer.train()
@@ -173,100 +263,30 @@ def training():
     model.save_adapter(dir, task)
 
 # test evaluation
-def evaluation():
-    intexts = []
-    gold_labels = []
-    test_dataset = datasets.Dataset.from_csv(data_folder+"/"+"test.csv")
-    test_dataset = test_dataset.map(encode_data, batched=True, batch_size=1)
-
-    for i in range(len(test_dataset)):
-        if anno_type=="iso_simplified" or anno_type=="iso":
-            intexts.append(test_dataset["speakers"][i]+" [SEP] "+test_dataset["isoda"][i]+" [SEP] "+test_dataset["tokens"][i])
-        elif anno_type=="summary":
-            if test_dataset["summary"][i] is not None:
-                truncated_summary = " ".join(test_dataset["summary"][i].split()[-250:])
-            else:
-                truncated_summary = "Start"
-            intexts.append(truncated_summary+" [SEP] "+test_dataset["speakers"][i]+" [SEP] "+test_dataset["tokens"][i])
-        if anno_type=="without_context_and_without_speaker":
-            intexts.append(test_dataset["tokens"][i])
-        elif anno_type=="without_context_with_current_speaker" or anno_type=="low_resource_turn_and_speaker":
-            intexts.append(test_dataset["speakers"][i]+" [SEP] "+test_dataset["tokens"][i])
-        elif anno_type=="with_context_with_current_and_previous_speaker":
-            intexts.append(test_dataset["previous_speakers"][i]+" [SEP] "+test_dataset["previous"][i]+" [SEP] "+test_dataset["speakers"][i]+" [SEP] "+test_dataset["tokens"][i])
-        elif anno_type=="with_context":
-            intexts.append(test_dataset["previous"][i] + " [SEP] " + test_dataset["tokens"][i])
-        gold_labels.append(test_dataset["tags"][i])
-
-    if anno_type=="low_resource_turn_and_speaker":
-        model.load_adapter("adapters/low_res"+task+"_"+low_resource_annotation_prefix.replace(".","-"))
-    else:
-        model.load_adapter("adapters/"+task+"_"+anno_type+"/")
+def evaluation(load_adapter=True):
+    """
+    Evaluate the dialogue act classifier on the test set.
+    :param load_adapter: load the adapter and head first, False if they are
+        already loaded (e.g. into a quantized model)
+    :return: accuracy and f1 scores
+    """
+    test_dataset = load_encoded_dataset(data_folder+"/"+"test.csv", encode=encode_test_data)
+
+    if load_adapter:
+        if anno_type=="low_resource_turn_and_speaker":
+            model.load_adapter("adapters/low_res"+task+"_"+low_resource_annotation_prefix.replace(".","-"))
+        else:
+            model.load_adapter("adapters/"+task+"_"+anno_type+"/")
 
     model.active_adapters = task
     model.active_head = task
+    model.to(device)
+    model.eval()
 
-    dact_classifier = pipeline(model=model, tokenizer=tokenizer, task="text-classification", device=0 if device=="cuda" else -1)
-    # if anno_type=="iso":
-    #     all_labels = ["Answer", "Disconfirm", "Inform", "Request", "Offer", "Confirm", "Auto-positive", "TurnAccept", "Question", "TurnAssign", "PropositionalQuestion", "Agreement", "Promise", "TurnTake", "AddressRequest", "AcceptOffer", "AcceptRequest", "Pausing", "CheckQuestion", "DeclineOffer", "Auto-negative", "SetQuestion", "ChoiceQuestion", "Instruct", "Allo-positive", "Other"]
-    # else:
-    #     all_labels = ["Absage", "Einsatzbefehl", "Information_geben", "Information_nachfragen", "Kontakt_Anfrage", "Kontakt_Bestaetigung", "Sonstiges", "Zusage"]
-    all_labels = label2id.keys()
-
-    scores = dict()
-    for label in all_labels:
-        scores[label] = {"tp":0, "fp":0, "fn":0}
-    match = 0
-    for i, intext in enumerate(intexts):
-        predicted_label = ""
-        prediction = dact_classifier(intext)
-        if len(prediction)>0:
-            predicted_label = prediction[0]["label"]
-        gold_label = id2label[gold_labels[i]]
-        if predicted_label==gold_label:
-            match+=1
-            scores[predicted_label]["tp"]+=1
-        else:
-            #print(prediction, intext, ">>>", predicted_label, gold_label)
-            scores[predicted_label]["fp"]+=1
-            scores[gold_label]["fn"]+=1
-    print("Accuracy:", round(match/len(intexts),3), "matched:", match, "total:", len(intexts))
-    print("F1 scores:")
-    f1scores = 0
-    all_tp = 0
-    all_f = 0
-    all_samples = 0
-    f1 = {}
-    # compute f1 scores (per label)
-    for label in all_labels:
-        tp = scores[label]["tp"]
-        fp = scores[label]["fp"]
-        fn = scores[label]["fn"]
-        if tp+fp>0:
-            prec = tp/(tp+fp)
-        else:
-            prec = 0
-        if tp+fn>0:
-            rec = tp/(tp+fn)
-        else:
-            rec = 0
-        if prec+rec>0:
-            f1score = 2*prec*rec/(prec+rec)
-        else:
-            f1score = 0
-        f1scores+=f1score
-        print(label, "F1:", round(f1score,3))
-        all_tp += tp
-        all_f += fp + fn
-        f1[label] = f1score * (all_tp + all_f / 2)
-        all_samples = all_tp + all_f / 2
-    weight_f1 = 0
-    for label in all_labels:
-        weight_f1 += f1[label] / all_samples
-    # compute macro f1 score (avg)
-    print("Macro F1:", round(f1scores/len(all_labels),3))
-    print("Micro F1:", round( all_tp / (all_tp + .5 * all_f), 3))
-    print("Weighted F1:", round( weight_f1, 3))
+    scores = dact_scores(*predict(test_dataset))
+    print_dact_scores(scores)
+    return {"accuracy": scores["accuracy"], "macro_f1": scores["macro_f1"],
+            "micro_f1": scores["micro_f1"], "weighted_f1": scores["weighted_f1"]}
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "-t":
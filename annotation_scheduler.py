@@ -0,0 +1,257 @@
+"""
+Dynamic micro-batching of annotation requests
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable
+
+logger = logging.getLogger(__file__)
+
+
+class RejectedError(Exception):
+    """
+    Raised for a request the scheduler does not process because it is
+    overloaded.
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        """
+        :param retry_after: estimated seconds until the queue has room again
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(RejectedError):
+    """
+    Raised when a request is submitted while the scheduler queue is full.
+    """
+
+
+class DeadlineError(RejectedError):
+    """
+    Raised for a request that can not be processed before its deadline.
+    """
+
+
+class MicroBatchScheduler:
+    """
+    Collects requests from many threads and processes them in batches on a
+    single worker thread, which is then the only thread using the model.
+
+    A batch is started with the first waiting request and closed when it has
+    max_batch_size requests or max_wait_ms have passed since it was started,
+    whichever comes first.
+
+    Requests wait in lanes, batches are filled from the first (highest
+    priority) lane first. A lane only accepts requests while the queue is
+    below its share of max_queue, so that lower lanes can't fill up the queue
+    for higher ones. Requests with a deadline are rejected when they arrive
+    if the requests before them are expected to take too long, and are
+    dropped (shed) if their deadline has passed when their batch is formed.
+    """
+
+    def __init__(self, process_batch: Callable[[list], list],
+                 max_batch_size: int = 16, max_wait_ms: float = 5.0,
+                 max_queue: int = 256, lane_shares: tuple[float, ...] = (1.0,)):
+        """
+        :param process_batch: function computing the list of results for a
+            list of requests, in the same order
+        :param max_batch_size: maximal number of requests per batch
+        :param max_wait_ms: maximal time to wait for more requests to fill a batch
+        :param max_queue: maximal number of waiting requests, 0 for unlimited
+        :param lane_shares: share of max_queue per lane, highest priority first
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self._limits = [max(1, int(max_queue * share)) if max_queue else 0
+                        for share in lane_shares]
+        # per lane: (request, future, time submitted, deadline or None, lane)
+        self._lanes: list[deque] = [deque() for _ in lane_shares]
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._worker = threading.Thread(target=self._run, name='micro-batcher',
+                                        daemon=True)
+        self._started = time.monotonic()
+        self._requests = 0
+        self._rejected: dict[tuple[str, int], int] = {}
+        self._failed = 0
+        # moving average of the seconds per batch
+        self._batch_seconds = 0.0
+        self._batches = 0
+        self._queue_time = 0.0
+        self._process_time = 0.0
+        self._latency = 0.0
+        self._max_latency = 0.0
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+        self._worker.start()
+
+    def submit(self, item: Any, lane: int = 0, deadline: float | None = None) -> Future:
+        """
+        Enqueue a request.
+        :param lane: index of the lane, 0 for the highest priority
+        :param deadline: time.monotonic() by which the request has to be
+            processed, None for no deadline
+        :return: future that will hold the result of the request, it raises
+            DeadlineError if the request is shed
+        :raises QueueFullError: if the queue is full for the lane
+        :raises DeadlineError: if the request is not expected to be processed
+            before its deadline
+        """
+        future: Future = Future()
+        now = time.monotonic()
+        with self._lock:
+            limit = self._limits[lane]
+            if limit and self._depth >= limit:
+                self._reject('queue_full', lane)
+                raise QueueFullError(f"queue is full ({self._depth} requests waiting)",
+                                     self._expected_wait(len(self._lanes)))
+            if deadline is not None and now + self._expected_wait(lane) > deadline:
+                self._reject('deadline', lane)
+                raise DeadlineError("request can't be processed before its deadline",
+                                    self._expected_wait(len(self._lanes)))
+            self._lanes[lane].append((item, future, now, deadline, lane))
+            self._depth += 1
+            self._not_empty.notify()
+        return future
+
+    def _reject(self, reason: str, lane: int) -> None:
+        self._rejected[reason, lane] = self._rejected.get((reason, lane), 0) + 1
+
+    def _expected_wait(self, lane: int) -> float:
+        """
+        Estimated seconds until a new request of a lane is processed: the
+        running batch and the batches of the requests waiting in this and
+        higher lanes.
+        """
+        ahead = sum(len(waiting) for waiting in self._lanes[:lane + 1])
+        return (ahead // self.max_batch_size + 2) * self._batch_seconds
+
+    def __call__(self, item: Any) -> Any:
+        """
+        Enqueue a request and wait for its result.
+        """
+        return self.submit(item).result()
+
+    def queue_depth(self) -> int:
+        """
+        Number of requests waiting for a batch.
+        """
+        return self._depth
+
+    def rejections(self) -> dict[tuple[str, str], int]:
+        """
+        :return: number of rejected requests per reason ('queue_full',
+            'deadline' or 'shed') and lane
+        """
+        with self._lock:
+            return {(reason, str(lane)): count
+                    for (reason, lane), count in self._rejected.items()}
+
+    def _take(self) -> tuple:
+        for waiting in self._lanes:
+            if waiting:
+                self._depth -= 1
+                return waiting.popleft()
+        raise IndexError("no waiting requests")
+
+    def _next_batch(self) -> list:
+        with self._not_empty:
+            while not self._depth:
+                self._not_empty.wait()
+            batch = [self._take()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if self._depth:
+                    batch.append(self._take())
+                    continue
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._not_empty.wait(timeout)
+        return batch
+
+    def _shed(self, batch: list, start: float) -> list:
+        """
+        Drop the requests that would not be done before their deadline.
+        :return: the remaining requests of the batch
+        """
+        expected_end = start + self._batch_seconds
+        kept = []
+        for entry in batch:
+            _, future, _, deadline, lane = entry
+            if deadline is not None and expected_end > deadline:
+                with self._lock:
+                    self._reject('shed', lane)
+                future.set_exception(DeadlineError("request was shed, it would not be "
+                                                   "processed before its deadline"))
+            else:
+                kept.append(entry)
+        return kept
+
+    def _run(self) -> None:
+        while True:
+            batch = self._shed(self._next_batch(), time.monotonic())
+            if not batch:
+                continue
+            start = time.monotonic()
+            try:
+                results = self.process_batch([entry[0] for entry in batch])
+                for (_, future, *_), result in zip(batch, results):
+                    future.set_result(result)
+                failed = 0
+            except Exception as e:
+                logger.exception(e)
+                for _, future, *_ in batch:
+                    future.set_exception(e)
+                failed = len(batch)
+            end = time.monotonic()
+            with self._lock:
+                self._batches += 1
+                self._requests += len(batch)
+                self._failed += failed
+                self._process_time += end - start
+                if self._batches == 1:
+                    self._batch_seconds = end - start
+                else:
+                    self._batch_seconds += 0.2 * (end - start - self._batch_seconds)
+                for _, _, submitted, *_ in batch:
+                    self._queue_time += start - submitted
+                    self._latency += end - submitted
+                    self._max_latency = max(self._max_latency, end - submitted)
+
+    def stats(self) -> dict[str, float]:
+        """
+        Throughput and latency counters since the scheduler was started.
+        """
+        with self._lock:
+            uptime = time.monotonic() - self._started
+            requests = max(self._requests, 1)
+            return {
+                'requests': self._requests,
+                'rejected': sum(count for (reason, _), count in self._rejected.items()
+                                if reason != 'shed'),
+                'shed': sum(count for (reason, _), count in self._rejected.items()
+                            if reason == 'shed'),
+                'failed': self._failed,
+                'batches': self._batches,
+                'queue_depth': self._depth,
+                'lane_depths': [len(waiting) for waiting in self._lanes],
+                # moving average, weighted towards the last batches
+                'recent_batch_ms': 1000 * self._batch_seconds,
+                'mean_batch_size': self._requests / max(self._batches, 1),
+                'requests_per_sec': self._requests / uptime if uptime > 0 else 0.0,
+                'mean_queue_ms': 1000 * self._queue_time / requests,
+                'mean_process_ms': 1000 * self._process_time / max(self._batches, 1),
+                'mean_latency_ms': 1000 * self._latency / requests,
+                'max_latency_ms': 1000 * self._max_latency,
+            }
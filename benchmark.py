@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+
+
+"""
+In-process benchmarks for the inference paths of the annotation server
+"""
+
+import argparse
+import csv
+import glob
+import json
+import logging
+import random
+import statistics
+import time
+
+import adapters_bio_tags_server as server
+from slot_decoding import decode_spans, word_flags, word_labels
+
+logger = logging.getLogger(__file__)
+
+test_csv: str = "csv_da_annotations/csv_with_context/test.csv"
+slot_test_csvs: str = "neg_samples_csv/neg_samples_*_test.csv"
+
+# latency statistics in milliseconds of every reported benchmark, for --output
+results: dict[str, dict[str, float]] = {}
+
+
+def load_turns(fname: str, limit: int) -> list[tuple[str, str]]:
+    """
+    Read (text, prev_text) pairs from a dialogue act annotation csv file.
+    :param fname: csv file with 'tokens' and 'previous' columns
+    :param limit: maximal number of turns to read, 0 for all
+    :return: list of (text, prev_text) pairs
+    """
+    turns = []
+    with open(fname, newline='') as f:
+        for row in csv.DictReader(f):
+            prev_text = row.get('previous') or ''
+            turns.append((row['tokens'], '' if prev_text == 'Start' else prev_text))
+            if limit and len(turns) >= limit:
+                break
+    return turns
+
+
+def da_input(text: str, prev_text: str) -> str:
+    """
+    Build the dialogue act classifier input the same way _annotate_line does.
+    """
+    clean_line = text.translate(server.remove_punct)
+    if prev_text:
+        return prev_text.translate(server.remove_punct) + ' [SEP] ' + clean_line
+    return clean_line
+
+
+def time_calls(fn, items: list, repeat: int) -> list[float]:
+    """
+    Call fn once per item, repeat times, and return the latencies in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings: list[float]) -> float:
+    """
+    Print mean, median, p95 and p99 latency of a benchmark, keep them in
+    results and return the mean.
+    """
+    timings = sorted(timings)
+    mean = statistics.fmean(timings)
+    p95 = timings[min(len(timings) - 1, int(0.95 * len(timings)))]
+    p99 = timings[min(len(timings) - 1, int(0.99 * len(timings)))]
+    print(f"{name:30s} n={len(timings):6d} mean={mean * 1000:8.3f}ms "
+          f"p50={statistics.median(timings) * 1000:8.3f}ms p95={p95 * 1000:8.3f}ms "
+          f"p99={p99 * 1000:8.3f}ms")
+    results[name] = {'n': len(timings), 'mean_ms': mean * 1000,
+                     'p50_ms': statistics.median(timings) * 1000,
+                     'p95_ms': p95 * 1000, 'p99_ms': p99 * 1000}
+    return mean
+
+
+def _pipeline_per_call(line: str) -> str:
+    """
+    Dialogue act classification as it was done before: a new pipeline for
+    every request.
+    """
+    from transformers import pipeline
+    server.model.active_adapters = 'dact'
+    server.model.active_head = 'dact'
+    dact_classifier = pipeline(model=server.model, tokenizer=server.tokenizer,
+                               device=server.device, task='text-classification')
+    return dact_classifier(line)[0]['label']
+
+
+def bench_dact(args: argparse.Namespace) -> None:
+    """
+    Per-request latency of the dialogue act classification: pipeline built
+    per call vs. the pre-built path of the server.
+    """
+    lines = [da_input(text, prev_text)
+             for text, prev_text in load_turns(args.csv, args.limit)]
+    mismatches = sum(_pipeline_per_call(line) != server.classify_dialogue_acts([line])[0]
+                     for line in lines)
+    print(f"dact: {len(lines)} utterances, {mismatches} label mismatches")
+    old = report("pipeline per request", time_calls(_pipeline_per_call, lines, args.repeat))
+    new = report("pre-built dact path",
+                 time_calls(lambda line: server.classify_dialogue_acts([line]),
+                            lines, args.repeat))
+    print(f"saved per request: {(old - new) * 1000:.3f}ms ({old / new:.1f}x)")
+
+
+def _encode_slots(text: str):
+    """
+    Encode a line for the slot taggers the same way _annotate_line_slots does.
+    """
+    encoded_line = server.tokenizer(text.translate(server.remove_punct),
+                                    padding="max_length", max_length=server.max_len_bio,
+                                    truncation=True, add_special_tokens=True)
+    tensor = server.torch.tensor([encoded_line['input_ids']]).to(server.device)
+    mask = server.torch.tensor([encoded_line['attention_mask']]).to(server.device)
+    return tensor, mask
+
+
+def _slot_logits(encoded, parallel: bool):
+    server.parallel_slots = parallel
+    return server.slot_logits(*encoded)
+
+
+def bench_slots(args: argparse.Namespace) -> None:
+    """
+    Per-request latency of slot tagging: one forward pass per task vs. one
+    forward pass for all tasks with Parallel adapter composition.
+    """
+    encoded = [_encode_slots(text) for text, _ in load_turns(args.csv, args.limit)]
+    max_diff = 0.0
+    for enc in encoded:
+        sequential = _slot_logits(enc, False)
+        parallel = _slot_logits(enc, True)
+        for task in server.tasks:
+            max_diff = max(max_diff,
+                           (sequential[task] - parallel[task]).abs().max().item())
+    print(f"slots: {len(encoded)} utterances, max logit difference {max_diff:.2e}")
+    old = report("sequential (5 passes)",
+                 time_calls(lambda enc: _slot_logits(enc, False), encoded, args.repeat))
+    new = report("parallel (1 pass)",
+                 time_calls(lambda enc: _slot_logits(enc, True), encoded, args.repeat))
+    print(f"saved per request: {(old - new) * 1000:.3f}ms ({old / new:.1f}x)")
+
+
+def _fixed_padding(lines: list[str], max_length: int, batch_size: int) -> list[dict]:
+    """
+    Encode lines in batches of batch_size, all padded to max_length.
+    """
+    batches = []
+    for start in range(0, len(lines), batch_size):
+        batches.append(server.tokenizer(lines[start:start + batch_size],
+                                        padding="max_length", max_length=max_length,
+                                        truncation=True, add_special_tokens=True,
+                                        return_tensors='pt').to(server.device))
+    return batches
+
+
+def _tokens_per_sec(batches: list[dict], forward, repeat: int) -> float:
+    """
+    Run forward on all batches and return the number of real (not padded)
+    input tokens processed per second.
+    """
+    tokens = sum(batch['attention_mask'].sum().item() for batch in batches)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            forward(batch)
+    return repeat * tokens / (time.perf_counter() - start)
+
+
+def bench_padding(args: argparse.Namespace) -> None:
+    """
+    Tokens/sec with padding to a fixed length vs. padding to the longest line
+    of length bucketed batches, on the slot and dialogue act test sets.
+    """
+    server.forward_batch_size = args.batch_size
+    slot_lines = []
+    for fname in sorted(glob.glob(slot_test_csvs)):
+        with open(fname, newline='') as f:
+            slot_lines.extend(row['tokens'].translate(server.remove_punct)
+                              for row in csv.DictReader(f))
+    da_lines = [da_input(text, prev_text) for text, prev_text in load_turns(args.csv, 0)]
+
+    def slot_forward(batch):
+        server.slot_logits(batch['input_ids'], batch['attention_mask'])
+
+    def dact_forward(batch):
+        server.dact_logits(batch['input_ids'], batch['attention_mask'],
+                           batch['token_type_ids'])
+
+    for name, lines, max_length, forward in [
+            ('slots', slot_lines, server.max_len_bio, slot_forward),
+            ('dact', da_lines, 256, dact_forward)]:
+        fixed = _tokens_per_sec(_fixed_padding(lines, max_length, args.batch_size),
+                                forward, args.repeat)
+        dynamic = _tokens_per_sec(server._buckets(server._tokenize(lines, max_length)),
+                                  forward, args.repeat)
+        print(f"{name}: {len(lines)} utterances, batch size {args.batch_size}")
+        print(f"  {f'padded to {max_length}':30s}{fixed:10.1f} tokens/s")
+        print(f"  {'bucketed, padded to longest':30s}{dynamic:10.1f} tokens/s "
+              f"({dynamic / fixed:.1f}x)")
+
+
+def _tokenize_per_word(line: str) -> tuple[list[str], list[int]]:
+    """
+    Slot tagger tokenization as it was done before: every word tokenized on
+    its own for merge_labels, then the whole line encoded again.
+    """
+    subtokens = ['#BOS']
+    for word in line.split():
+        subtokens.extend(server.tokenizer.tokenize(word))
+    encoded = server.tokenizer(line, max_length=server.max_len_bio, truncation=True,
+                               add_special_tokens=True)
+    return subtokens, encoded['input_ids']
+
+
+def bench_tokenize(args: argparse.Namespace) -> None:
+    """
+    Per-line tokenization of the slot tagger input: per-word loop plus a
+    second encoding vs. one fast tokenizer call with word ids.
+    """
+    lines = []
+    for fname in sorted(glob.glob(slot_test_csvs)):
+        with open(fname, newline='') as f:
+            lines.extend(row['tokens'].translate(server.remove_punct)
+                         for row in csv.DictReader(f))
+    misaligned = 0
+    for line in lines:
+        subtokens, _ = _tokenize_per_word(line)
+        # merge_labels finds a word for every subtoken not starting with ##
+        words = sum(not subtoken.startswith('##') for subtoken in subtokens[1:])
+        misaligned += words != len(line.split())
+    print(f"tokenize: {len(lines)} lines, {misaligned} with '##' word boundaries "
+          f"that differ from the words of the line")
+    old = report("per word + encode", time_calls(_tokenize_per_word, lines, args.repeat))
+    new = report("one call with word ids",
+                 time_calls(lambda line: server._tokenize([line.split()], server.max_len_bio,
+                                                          split_words=True),
+                            lines, args.repeat))
+    print(f"saved per line: {(old - new) * 1000:.3f}ms ({old / new:.1f}x)")
+
+
+def _phrases_per_task(words: list[str], subtokens: list[str],
+                      predictions: list[list[int]]) -> dict[str, list[str]]:
+    """
+    Slot phrases as they were decoded before: merge_labels and phrase grouping
+    in Python, once per task.
+    """
+    result = {}
+    for task, task_predictions in zip(server.tasks, predictions):
+        merged_labels = server.merge_labels([server.id2label[k] for k in task_predictions],
+                                            subtokens)
+        phrases = []
+        current_phrase = ''
+        for la, to in zip(merged_labels, words):
+            if la == 'B':
+                if current_phrase:
+                    phrases.append(current_phrase)
+                current_phrase = to
+            elif la == 'I':
+                current_phrase += ' ' + to
+            elif current_phrase:
+                phrases.append(current_phrase)
+                current_phrase = ''
+        if current_phrase:
+            phrases.append(current_phrase)
+        if phrases:
+            result[task] = phrases
+    return result
+
+
+def _decode_batch(words: list[list[str]], word_ids: server.torch.Tensor,
+                  logits: server.torch.Tensor) -> list[dict[str, list[str]]]:
+    """
+    Slot phrases of a batch with decode_spans, the way annotate_slots_batch
+    decodes them.
+    """
+    predictions = server.torch.argmax(logits, 3)
+    line_phrases: list[dict[str, list[str]]] = [dict() for _ in words]
+    for t, k, start, end in decode_spans(predictions, word_ids, max(map(len, words)),
+                                         server.label2id['B'],
+                                         server.label2id['I']).tolist():
+        line_phrases[k].setdefault(server.tasks[t], []).append(' '.join(words[k][start:end]))
+    return line_phrases
+
+
+def bench_decode(args: argparse.Namespace) -> None:
+    """
+    Decoding of slot tagger logits into phrases: merge_labels and phrase
+    grouping per line and task vs. decode_spans on the logits of all tasks
+    and lines of a batch, for batch sizes 1 to 256.
+    """
+    torch = server.torch
+    lines = []
+    for fname in sorted(glob.glob(slot_test_csvs)):
+        with open(fname, newline='') as f:
+            lines.extend(row['tokens'].translate(server.remove_punct)
+                         for row in csv.DictReader(f))
+    while len(lines) < 256:
+        lines += lines
+    words = [line.split() for line in lines]
+    encoded = server._tokenize(words, server.max_len_bio, split_words=True)
+    subtokens = [['#BOS'] + [subtoken for word in line_words
+                             for subtoken in server.tokenizer.tokenize(word)]
+                 for line_words in words]
+    word_ids = server.pad_sequences(
+        [[-1 if word is None else word for word in encoded.word_ids(i)]
+         for i in range(len(lines))], -1)
+    # random logits make all label sequences (e.g. I after O) occur
+    torch.manual_seed(0)
+    logits = torch.randn(len(server.tasks), len(lines), word_ids.shape[1],
+                         len(server.labels))
+    predictions = torch.argmax(logits, 3)
+    begins, in_phrase = word_flags(predictions, word_ids, max(map(len, words)),
+                                   server.label2id['B'], server.label2id['I'])
+    labels = word_labels(begins, in_phrase, server.label2id['B'], server.label2id['I'],
+                         server.label2id['O'])
+    mismatches = 0
+    for k, line_words in enumerate(words):
+        for t in range(len(server.tasks)):
+            expected = server.merge_labels(
+                [server.id2label[i] for i in predictions[t, k].tolist()], subtokens[k])
+            merged = [server.id2label[i] for i in labels[t, k, :len(line_words)].tolist()]
+            mismatches += merged != expected
+    old = [_phrases_per_task(words[k], subtokens[k], predictions[:, k].tolist())
+           for k in range(len(lines))]
+    new = _decode_batch(words, word_ids, logits)
+    mismatches += sum(a != b for a, b in zip(old, new))
+    print(f"decode: {len(lines)} lines, {len(server.tasks)} tasks, {mismatches} mismatches "
+          f"with merge_labels")
+    for batch_size in [1, 2, 4, 8, 16, 32, 64, 128, 256]:
+        batches = []
+        for start in range(0, len(lines) - batch_size + 1, batch_size):
+            batch = slice(start, start + batch_size)
+            length = int((word_ids[batch] >= 0).sum(1).max()) + 2
+            batches.append((batch, word_ids[batch, :length], logits[:, batch, :length]))
+
+        def per_line(batch):
+            batch_slice, _, batch_logits = batch
+            task_predictions = torch.argmax(batch_logits, 3)
+            return [_phrases_per_task(words[k], subtokens[k],
+                                      task_predictions[:, i].tolist())
+                    for i, k in enumerate(range(batch_slice.start, batch_slice.stop))]
+
+        def vectorized(batch):
+            batch_slice, batch_word_ids, batch_logits = batch
+            return _decode_batch(words[batch_slice], batch_word_ids, batch_logits)
+
+        print(f"batch size {batch_size}:")
+        old = report("  merge_labels per line", time_calls(per_line, batches, args.repeat))
+        new = report("  decode_spans per batch", time_calls(vectorized, batches, args.repeat))
+        print(f"  per line: {old / batch_size * 1000:.3f}ms vs "
+              f"{new / batch_size * 1000:.3f}ms ({old / new:.1f}x)")
+
+
+def bench_onnx(args: argparse.Namespace) -> None:
+    """
+    Per-request latency of the torch and the onnx backend, and the number of
+    responses that differ between them, on the dialogue act and slot test sets.
+    """
+    anno_requests = [server.AnnotationRequest(text, prev_text, force_slots=True)
+                     for text, prev_text in load_turns(args.csv, args.limit)]
+    for fname in sorted(glob.glob(slot_test_csvs)):
+        with open(fname, newline='') as f:
+            anno_requests.extend(server.AnnotationRequest(row['tokens'], slots_only=True)
+                                 for row in csv.DictReader(f))
+    responses = {}
+    latencies = {}
+    for name, backend, parallel in [('torch', 'torch', False),
+                                    ('torch --parallel-slots', 'torch', True),
+                                    ('onnx', 'onnx', False)]:
+        server.backend = backend
+        server.parallel_slots = parallel
+        server.onnx_dir = args.onnx_dir
+        server.init_model()
+        responses[name] = [json.dumps(server.annotate_batch([req])[0]) for req in anno_requests]
+        latencies[name] = report(f"{name} backend",
+                                 time_calls(lambda req: server.annotate_batch([req]),
+                                            anno_requests, args.repeat))
+    for name in ['torch', 'torch --parallel-slots']:
+        mismatches = sum(a != b for a, b in zip(responses[name], responses['onnx']))
+        print(f"onnx vs {name}: {len(anno_requests)} requests, {mismatches} responses differ, "
+              f"saved per request: {(latencies[name] - latencies['onnx']) * 1000:.3f}ms "
+              f"({latencies[name] / latencies['onnx']:.1f}x)")
+
+
+def bench_micro(args: argparse.Namespace) -> None:
+    """
+    Per-line latency of the building blocks of a request on the dialogue act
+    and slot test sets: merge_labels and merge_word_labels (with random
+    labels), tokenization, and a forward pass of the dialogue act classifier
+    and of the slot taggers.
+    """
+    turns = load_turns(args.csv, args.limit)
+    for fname in sorted(glob.glob(slot_test_csvs)):
+        turns.extend(load_turns(fname, 0))
+    da_lines = [da_input(text, prev_text) for text, prev_text in turns]
+    words = [text.translate(server.remove_punct).split() for text, _ in turns]
+    print(f"micro: {len(turns)} lines")
+
+    labels = random.Random(0)
+    merge_inputs = []
+    for line_words in words:
+        subtokens, _ = _tokenize_per_word(' '.join(line_words))
+        encoded = server._tokenize([line_words], server.max_len_bio, split_words=True)
+        word_ids = encoded.word_ids(0)
+        merge_inputs.append((subtokens, [labels.choice(server.labels) for _ in subtokens],
+                             word_ids, [labels.choice(server.labels) for _ in word_ids],
+                             len(line_words)))
+    report("merge_labels",
+           time_calls(lambda item: server.merge_labels(item[1], item[0]),
+                      merge_inputs, args.repeat))
+    report("merge_word_labels",
+           time_calls(lambda item: server.merge_word_labels(item[3], item[2], item[4]),
+                      merge_inputs, args.repeat))
+
+    report("tokenize dact input",
+           time_calls(lambda line: server._tokenize([line], server.max_len_dact),
+                      da_lines, args.repeat))
+    report("tokenize slot input",
+           time_calls(lambda line_words: server._tokenize([line_words], server.max_len_bio,
+                                                          split_words=True),
+                      words, args.repeat))
+
+    dact_buckets = [server._buckets(server._tokenize([line], server.max_len_dact))[0]
+                    for line in da_lines]
+    slot_buckets = [server._buckets(server._tokenize([line_words], server.max_len_bio,
+                                                     split_words=True))[0]
+                    for line_words in words]
+    report("forward dact",
+           time_calls(lambda bucket: server.dact_logits(bucket['input_ids'],
+                                                        bucket['attention_mask'],
+                                                        bucket['token_type_ids']),
+                      dact_buckets, args.repeat))
+    for name, parallel in [("forward slots (5 passes)", False),
+                           ("forward slots (parallel)", True)]:
+        server.parallel_slots = parallel
+        report(name, time_calls(lambda bucket: server.slot_logits(bucket['input_ids'],
+                                                                  bucket['attention_mask']),
+                                slot_buckets, args.repeat))
+
+
+benchmarks = {
+    'dact': bench_dact,
+    'slots': bench_slots,
+    'padding': bench_padding,
+    'tokenize': bench_tokenize,
+    'decode': bench_decode,
+    'onnx': bench_onnx,
+    'micro': bench_micro,
+}
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=benchmarks.keys(),
+                        help="benchmark to run")
+    parser.add_argument('-c', '--csv', default=test_csv,
+                        help=f"input turns (optional, default {test_csv})")
+    parser.add_argument('-l', '--limit', type=int, default=200,
+                        help="maximal number of utterances, 0 for all (optional, default 200)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="repetitions per utterance (optional, default 3)")
+    parser.add_argument('-b', '--batch-size', type=int, default=16,
+                        help="batch size of batched benchmarks (optional, default 16)")
+    parser.add_argument('--onnx-dir', default=server.onnx_dir,
+                        help=f"graphs written by export_onnx.py for the onnx benchmark "
+                             f"(optional, default {server.onnx_dir})")
+    parser.add_argument('-o', '--output',
+                        help="write the latency statistics to this JSON file (optional)")
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    logging.disable(logging.INFO)
+    server.init_model()
+    benchmarks[args.benchmark](args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'device': server.device,
+                       'results': results}, f, indent=2)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+
+"""
+Write the base model, all adapters and heads and the tokenizer of the
+annotation server into one bundle that the server loads in one step
+"""
+
+import argparse
+
+import adapters_bio_tags_server as server
+import model_bundle
+
+default_bundle_dir: str = "bundle"
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default=default_bundle_dir,
+                        help=f"output folder (optional, default {default_bundle_dir})")
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    server.device = 'cpu'
+    server.init_model()
+    model_bundle.build(server.model, server.tokenizer, args.output)
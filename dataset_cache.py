@@ -0,0 +1,105 @@
+"""
+Persistent cache of encoded (tokenized and label-aligned) data sets, shared
+by the training and evaluation scripts
+"""
+
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+from typing import Callable
+
+import datasets
+
+logger = logging.getLogger(__file__)
+
+# directory of the cached data sets, None to encode the CSV files every time
+cache_dir: str | None = "dataset_cache"
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    :return: hash of everything that determines the encoding of a tokenizer:
+        its class, vocabulary, normalization and special tokens
+    """
+    if getattr(tokenizer, "is_fast", False):
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        # set by the calls of the tokenizer, not part of its files
+        state.pop("truncation", None)
+        state.pop("padding", None)
+    else:
+        state = sorted(tokenizer.get_vocab().items())
+    content = json.dumps([type(tokenizer).__name__, state,
+                          tokenizer.special_tokens_map], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source(function: Callable) -> str:
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return function.__qualname__
+
+
+def dataset_key(csv_file: str, encode: Callable[[dict], dict], tokenizer,
+                batch_size: int, parameters: dict) -> str:
+    """
+    :return: hash of the CSV contents, the tokenizer, the source code of
+        encode and the parameters of the encoding (the source code of
+        functions)
+    """
+    parameters = {name: _source(value) if callable(value) else value
+                  for name, value in parameters.items()}
+    content = json.dumps([_file_hash(csv_file), tokenizer_fingerprint(tokenizer), _source(encode),
+                          batch_size, parameters, datasets.__version__],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+
+def load_encoded_csv(csv_file: str, encode: Callable[[dict], dict], tokenizer,
+                     batch_size: int = 16, **parameters) -> datasets.Dataset:
+    """
+    Read a CSV file into a data set and encode it in batches with encode, or
+    load the encoded data set of an earlier run. Cached data sets are Arrow
+    files in cache_dir, memory-mapped when they are loaded, so they hardly
+    take RAM, and they are shared by all scripts and tasks that encode the
+    same file the same way.
+    :param encode: batched map function of the data set, its source code is
+        part of the cache key
+    :param tokenizer: tokenizer used by encode, part of the cache key
+    :param parameters: further settings of encode that are not in its source
+        code, e.g. max_length=128, anno_type="with_context", and the functions
+        it calls
+    :return: the data set with the columns of the CSV file and of encode
+    """
+    if cache_dir is None:
+        dataset = datasets.Dataset.from_csv(csv_file)
+        return dataset.map(encode, batched=True, batch_size=batch_size)
+    key = dataset_key(csv_file, encode, tokenizer, batch_size, parameters)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(path):
+        logger.info(f"loading encoded {csv_file} from {path}")
+        return datasets.load_from_disk(path)
+    dataset = datasets.Dataset.from_csv(csv_file)
+    dataset = dataset.map(encode, batched=True, batch_size=batch_size)
+    # written next to the final directory and renamed, so that concurrent
+    # runs never load a partly written data set
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    dataset.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another run wrote it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    logger.info(f"cached encoded {csv_file} in {path}")
+    return datasets.load_from_disk(path)
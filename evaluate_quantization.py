@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+
+"""
+Accuracy, speed and memory of the slot taggers and the dialogue act
+classifier with dynamic INT8 quantization, compared with the fp32 models
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import adapters_bio_tags as bio_tags
+import adapters_classifier as classifier
+from quantization import model_size_mb, quantize_model
+from worker_pool import process_memory
+
+logger = logging.getLogger(__file__)
+
+
+def run_evaluations(tasks: list[str], load_adapters: bool) -> dict[str, dict[str, float]]:
+    """
+    Run eval_task for the slot tasks and the dialogue act test evaluation.
+    :param load_adapters: load the adapters and heads before evaluating
+    :return: metrics and evaluation time in seconds per task
+    """
+    results = {}
+    for task in tasks:
+        start = time.perf_counter()
+        metrics = bio_tags.eval_task(task, load_adapter=load_adapters)
+        results[task] = dict(metrics, seconds=time.perf_counter() - start)
+    start = time.perf_counter()
+    metrics = classifier.evaluation(load_adapter=load_adapters)
+    results[classifier.task] = dict(metrics, seconds=time.perf_counter() - start)
+    return results
+
+
+def memory() -> dict[str, float]:
+    """
+    Weight sizes of both models and memory of the process in MB.
+    """
+    return {'slot_model_mb': model_size_mb(bio_tags.model),
+            'dact_model_mb': model_size_mb(classifier.model),
+            **process_memory(os.getpid())}
+
+
+def print_comparison(fp32: dict[str, dict[str, float]],
+                     int8: dict[str, dict[str, float]],
+                     fp32_memory: dict[str, float], int8_memory: dict[str, float]) -> None:
+    print(f"{'task':10s} {'metric':20s} {'fp32':>9s} {'int8':>9s} {'delta':>9s}")
+    for task, metrics in fp32.items():
+        for metric, value in metrics.items():
+            if metric != 'seconds':
+                print(f"{task:10s} {metric:20s} {value:9.4f} {int8[task][metric]:9.4f} "
+                      f"{int8[task][metric] - value:+9.4f}")
+        print(f"{task:10s} {'seconds':20s} {metrics['seconds']:9.2f} "
+              f"{int8[task]['seconds']:9.2f} "
+              f"{metrics['seconds'] / int8[task]['seconds']:8.2f}x")
+    for key, value in fp32_memory.items():
+        print(f"{'memory':10s} {key:20s} {value:9.1f} {int8_memory[key]:9.1f} "
+              f"{int8_memory[key] - value:+9.1f}")
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tasks', default=','.join(bio_tags.tasks),
+                        help=f"comma separated slot tasks (optional, default "
+                             f"{','.join(bio_tags.tasks)})")
+    parser.add_argument('-o', '--output',
+                        help="write the metrics to this JSON file (optional)")
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    tasks = args.tasks.split(',')
+    # quantized models only run on the cpu
+    bio_tags.device = classifier.device = 'cpu'
+    fp32_results = run_evaluations(tasks, load_adapters=True)
+    fp32_memory = memory()
+    # all adapters and heads are loaded now and get quantized with the models
+    for model in [bio_tags.model, classifier.model]:
+        model.to('cpu')
+        model.eval()
+        quantize_model(model)
+    int8_results = run_evaluations(tasks, load_adapters=False)
+    int8_memory = memory()
+    print_comparison(fp32_results, int8_results, fp32_memory, int8_memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'fp32': fp32_results, 'int8': int8_results,
+                       'fp32_memory': fp32_memory, 'int8_memory': int8_memory}, f, indent=2)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+
+"""
+Export the dialogue act classifier and the slot taggers of the annotation
+server to ONNX, for the server's onnx backend
+"""
+
+import argparse
+
+import adapters_bio_tags_server as server
+import onnx_backend
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default=server.onnx_dir,
+                        help=f"output folder (optional, default {server.onnx_dir})")
+    parser.add_argument('--opset', type=int, default=17,
+                        help="ONNX opset version (optional, default 17)")
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    server.device = 'cpu'
+    server.init_model()
+    onnx_backend.export(server.model, server.tasks, server.dact_id2label, args.output,
+                        opset=args.opset)
@@ -0,0 +1,101 @@
+"""
+Length bucketing and dynamic padding of variable length sequences
+"""
+
+import math
+import random
+from typing import Iterator, Sequence
+
+import torch
+
+
+def length_buckets(lengths: Sequence[int], batch_size: int) -> list[list[int]]:
+    """
+    Group the indices of sequences into batches of similar length.
+    :param lengths: length of every sequence
+    :param batch_size: maximal number of sequences per batch
+    :return: batches of indices, sorted by sequence length
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def pad_sequences(sequences: Sequence, pad_value: int,
+                  length: int | None = None) -> torch.Tensor:
+    """
+    Pad (or truncate) sequences of ids to the same length.
+    :param sequences: lists or 1-dimensional tensors of ids
+    :param pad_value: id used for padding
+    :param length: target length, the longest sequence if None
+    :return: tensor of shape (len(sequences), length)
+    """
+    if length is None:
+        length = max(len(seq) for seq in sequences)
+    padded = torch.full((len(sequences), length), pad_value, dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        seq = seq[:length]
+        padded[i, :len(seq)] = torch.as_tensor(seq)
+    return padded
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that puts sequences of similar length into the same batch,
+    so that padding to the longest sequence of the batch wastes little
+    compute. With shuffle, the data is shuffled, split into pools of
+    bucket_factor batches which are sorted by length, and the resulting
+    batches are shuffled again.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int,
+                 shuffle: bool = False, bucket_factor: int = 50):
+        super().__init__()
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_factor = bucket_factor
+
+    def __iter__(self) -> Iterator[list[int]]:
+        if not self.shuffle:
+            yield from length_buckets(self.lengths, self.batch_size)
+            return
+        indices = list(range(len(self.lengths)))
+        random.shuffle(indices)
+        pool_size = self.batch_size * self.bucket_factor
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=self.lengths.__getitem__)
+            batches.extend(pool[i:i + self.batch_size]
+                           for i in range(0, len(pool), self.batch_size))
+        random.shuffle(batches)
+        yield from batches
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+class PadCollator:
+    """
+    Collate dataset rows into a batch padded to its longest input_ids. Fields
+    without a pad value are stacked if they are tensors and kept as lists
+    otherwise.
+    """
+
+    def __init__(self, pad_values: dict[str, int]):
+        """
+        :param pad_values: pad id for every sequence field, e.g. input_ids
+        """
+        self.pad_values = pad_values
+
+    def __call__(self, rows: list[dict]) -> dict:
+        length = max(len(row['input_ids']) for row in rows)
+        batch = {}
+        for key in rows[0]:
+            values = [row[key] for row in rows]
+            if key in self.pad_values:
+                batch[key] = pad_sequences(values, self.pad_values[key], length)
+            elif isinstance(values[0], torch.Tensor):
+                batch[key] = torch.stack(values)
+            else:
+                batch[key] = values
+        return batch
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+
+"""
+Load test for a running annotation server
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+test_csv: str = "csv_da_annotations/csv_with_context/test.csv"
+slot_test_csvs: str = "neg_samples_csv/neg_samples_*_test.csv"
+
+
+def load_turns(fname: str) -> list[tuple[str, str]]:
+    """
+    Read (text, prev_text) pairs from a dialogue act annotation csv file, or
+    a slot csv file without 'previous' column.
+    """
+    turns = []
+    with open(fname, newline='') as f:
+        for row in csv.DictReader(f):
+            prev_text = row.get('previous') or ''
+            turns.append((row['tokens'], '' if prev_text == 'Start' else prev_text))
+    return turns
+
+
+def load_all_turns(patterns: str) -> list[tuple[str, str]]:
+    """
+    Read the turns of all csv files matching comma separated glob patterns.
+    """
+    turns = []
+    for pattern in patterns.split(','):
+        fnames = sorted(glob.glob(pattern))
+        if not fnames:
+            raise ValueError(f"no csv file matches {pattern}")
+        for fname in fnames:
+            turns.extend(load_turns(fname))
+    return turns
+
+
+def annotate_url(url: str, endpoint: str, text: str, prev_text: str) -> str:
+    query = urllib.parse.urlencode({'text': text, 'prev_text': prev_text})
+    return f"{url}/{endpoint}?{query}"
+
+
+def fetch(request_url: str, timeout: float | None = None) -> bytes:
+    with urllib.request.urlopen(request_url, timeout=timeout) as response:
+        return response.read()
+
+
+def run_clients(urls: list[str], concurrency: int, duration: float,
+                timeout: float | None = None) -> tuple[list[float], int, float]:
+    """
+    Send requests from concurrency threads for duration seconds, every
+    thread waiting for its response before sending the next request
+    (closed loop).
+    :return: latencies of the successful requests, number of errors and
+        seconds until the last response
+    """
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    start = time.perf_counter()
+    stop = time.monotonic() + duration
+
+    def client(offset: int) -> None:
+        k = offset
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                fetch(urls[k % len(urls)], timeout)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            k += concurrency
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def run_open_loop(urls: list[str], rate: float, duration: float, max_outstanding: int,
+                  timeout: float | None = None) -> tuple[list[float], int, float]:
+    """
+    Send requests at random (Poisson) arrival times with a mean of rate
+    requests per second for duration seconds, without waiting for the
+    responses (open loop). The latency of a request is measured from its
+    arrival time, so it includes the time a request waits for a free client
+    thread when more than max_outstanding requests are in flight.
+    :return: latencies of the successful requests, number of errors and
+        seconds until the last response
+    """
+    latencies: list[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    arrivals = random.Random(0)
+
+    def send(request_url: str, arrival: float) -> None:
+        try:
+            fetch(request_url, timeout)
+            with lock:
+                latencies.append(time.perf_counter() - arrival)
+        except Exception:
+            with lock:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    arrival = start
+    k = 0
+    with ThreadPoolExecutor(max_workers=max_outstanding) as executor:
+        while True:
+            arrival += arrivals.expovariate(rate)
+            if arrival - start >= duration:
+                break
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, urls[k % len(urls)], arrival)
+            k += 1
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict[str, float]:
+    """
+    Throughput, latency percentiles in milliseconds and error rate of a run.
+    :param elapsed: seconds from the first request to the last response
+    """
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+
+    def percentile(q: float) -> float:
+        return 1000 * latencies[int(q * (len(latencies) - 1))] if latencies else 0.0
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'error_rate': errors / total if total else 0.0,
+        'requests_per_sec': len(latencies) / elapsed,
+        'mean_ms': 1000 * statistics.fmean(latencies) if latencies else 0.0,
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': 1000 * latencies[-1] if latencies else 0.0,
+    }
+
+
+def git_commit() -> str:
+    """
+    Commit of the working directory, to compare results across commits.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def stress(url: str, turns: list[tuple[str, str]], concurrency: int) -> int:
+    """
+    Send mixed /annotate and /annotate_slots requests from concurrency threads
+    at once and compare every response with the response to the same request
+    sent on its own.
+    :return: number of responses that differ from the serial run
+    """
+    urls = [annotate_url(url, endpoint, text, prev_text)
+            for text, prev_text in turns
+            for endpoint in ['annotate', 'annotate_slots']]
+    expected = [fetch(request_url) for request_url in urls]
+    results: list[bytes | None] = [None] * len(urls)
+
+    def client(offset: int) -> None:
+        for k in range(offset, len(urls), concurrency):
+            try:
+                results[k] = fetch(urls[k])
+            except Exception as e:
+                results[k] = str(e).encode()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    mismatches = 0
+    for request_url, expected_result, result in zip(urls, expected, results):
+        if result != expected_result:
+            mismatches += 1
+            print(f"mismatch for {request_url}:\n  serial:     {expected_result!r}\n"
+                  f"  concurrent: {result!r}")
+    return mismatches
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Read command line arguments
+    :return: command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--url', default='http://localhost:5050',
+                        help="server url (optional, default http://localhost:5050)")
+    parser.add_argument('-e', '--endpoint', default='annotate',
+                        choices=['annotate', 'annotate_slots'],
+                        help="endpoint to load (optional, default annotate)")
+    parser.add_argument('-c', '--csv', default=f"{test_csv},{slot_test_csvs}",
+                        help=f"comma separated csv files or glob patterns of the turns to "
+                             f"replay (optional, default {test_csv},{slot_test_csvs})")
+    parser.add_argument('-n', '--concurrency', default='1,2,4,8,16,32',
+                        help="comma separated numbers of concurrent clients "
+                             "(optional, default 1,2,4,8,16,32)")
+    parser.add_argument('-r', '--rate',
+                        help="comma separated arrival rates in requests/sec, sent without "
+                             "waiting for responses (open loop) instead of concurrent clients")
+    parser.add_argument('--max-outstanding', type=int, default=256,
+                        help="maximal number of requests in flight in open loop mode "
+                             "(optional, default 256)")
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help="seconds per concurrency level or rate (optional, default 10)")
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help="seconds until a request counts as failed (optional, default 30)")
+    parser.add_argument('-o', '--output',
+                        help="write the results to this JSON file (optional)")
+    parser.add_argument('-s', '--stress', action='store_true',
+                        help="send mixed /annotate and /annotate_slots requests from the "
+                             "largest number of clients at once and compare the results "
+                             "with serial requests")
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    turns = load_all_turns(args.csv)
+    if args.stress:
+        concurrency = max(int(c) for c in args.concurrency.split(','))
+        mismatches = stress(args.url, turns, concurrency)
+        print(f"{mismatches} of {2 * len(turns)} responses differ from the serial run")
+        sys.exit(1 if mismatches else 0)
+    urls = [annotate_url(args.url, args.endpoint, text, prev_text)
+            for text, prev_text in turns]
+    if args.rate:
+        mode, levels = 'rate', [float(r) for r in args.rate.split(',')]
+    else:
+        mode, levels = 'clients', [int(c) for c in args.concurrency.split(',')]
+    print(f"{mode:>7s} {'req/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} "
+          f"{'errors':>7s}")
+    results = []
+    for level in levels:
+        if args.rate:
+            latencies, errors, elapsed = run_open_loop(urls, level, args.duration,
+                                                       args.max_outstanding, args.timeout)
+        else:
+            latencies, errors, elapsed = run_clients(urls, level, args.duration, args.timeout)
+        result = {mode: level, **summarize(latencies, errors, elapsed)}
+        results.append(result)
+        print(f"{level:7g} {result['requests_per_sec']:8.1f} {result['p50_ms']:8.1f} "
+              f"{result['p95_ms']:8.1f} {result['p99_ms']:8.1f} "
+              f"{100 * result['error_rate']:6.1f}%")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'url': args.url, 'endpoint': args.endpoint, 'csv': args.csv,
+                       'turns': len(turns), 'duration': args.duration, 'mode': mode,
+                       'results': results}, f, indent=2)
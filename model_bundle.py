@@ -0,0 +1,77 @@
+"""
+Consolidated model bundle: the base model with all adapters and heads in one
+memory-mapped weights file, plus config and tokenizer
+"""
+
+import json
+import logging
+import os
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__file__)
+
+weights_file: str = "model.pt"
+adapters_file: str = "adapters.json"
+
+
+def build(model: nn.Module, tokenizer, bundle_dir: str) -> None:
+    """
+    Write a bundle of an adapter model with all its adapters and heads.
+    :param model: adapter model, e.g. AutoAdapterModel with loaded adapters
+    :param tokenizer: tokenizer of the model
+    :param bundle_dir: output folder
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    # the config has the heads, the adapters are added from adapters.json
+    model.config.save_pretrained(bundle_dir)
+    tokenizer.save_pretrained(bundle_dir)
+    adapter_configs = {name: model.adapters_config.get(name).to_dict()
+                       for name in model.adapters_config.adapters}
+    with open(os.path.join(bundle_dir, adapters_file), 'w') as f:
+        json.dump(adapter_configs, f, indent=2)
+    # non-persistent buffers (e.g. position_ids) are not part of the state dict
+    weights = {name: tensor.detach().cpu().contiguous()
+               for name, tensor in [*model.named_parameters(), *model.named_buffers()]}
+    torch.save(weights, os.path.join(bundle_dir, weights_file))
+    logger.info(f"bundle with {len(adapter_configs)} adapters written to {bundle_dir}")
+
+
+def _assign(model: nn.Module, name: str, tensor: torch.Tensor) -> None:
+    module_name, _, tensor_name = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if tensor_name in module._parameters:
+        module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[tensor_name] = tensor
+
+
+def load(bundle_dir: str):
+    """
+    Load the model and the tokenizer of a bundle. The model is created
+    without memory for its weights, which are then memory-mapped from the
+    weights file, so loading takes no copying and processes forked later
+    share the pages of the file.
+    :return: the model in eval mode on the cpu, and the tokenizer
+    """
+    from adapters import AdapterConfig, AutoAdapterModel
+    from transformers import AutoConfig, AutoTokenizer
+
+    config = AutoConfig.from_pretrained(bundle_dir)
+    with open(os.path.join(bundle_dir, adapters_file)) as f:
+        adapter_configs = json.load(f)
+    with torch.device('meta'):
+        model = AutoAdapterModel.from_config(config)
+        for name, adapter_config in adapter_configs.items():
+            model.add_adapter(name, config=AdapterConfig.load(adapter_config))
+    weights = torch.load(os.path.join(bundle_dir, weights_file), mmap=True,
+                         weights_only=True)
+    for name, tensor in weights.items():
+        _assign(model, name, tensor)
+    missing = [name for name, tensor in [*model.named_parameters(), *model.named_buffers()]
+               if tensor.is_meta]
+    if missing:
+        raise ValueError(f"{bundle_dir} has no weights for {missing}")
+    model.eval()
+    return model, AutoTokenizer.from_pretrained(bundle_dir)
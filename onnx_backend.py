@@ -0,0 +1,144 @@
+"""
+Export of the dialogue act classifier and the slot taggers to ONNX, and
+inference with ONNX Runtime
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+logger = logging.getLogger(__file__)
+
+dact_file: str = "dact.onnx"
+slots_file: str = "slots.onnx"
+labels_file: str = "labels.json"
+
+
+class _DactGraph(nn.Module):
+    """
+    The base model with the 'dact' adapter and head.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        from adapters import AdapterSetup
+
+        with AdapterSetup('dact'):
+            return self.model(input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids)[0]
+
+
+class _SlotsGraph(nn.Module):
+    """
+    The base model with all slot tagging adapters and heads in one Parallel
+    block, with one output per task.
+    """
+
+    def __init__(self, model: nn.Module, tasks: list[str]):
+        super().__init__()
+        self.model = model
+        self.tasks = tasks
+
+    def forward(self, input_ids, attention_mask):
+        from adapters import AdapterSetup
+        from adapters.composition import Parallel
+
+        with AdapterSetup(Parallel(*self.tasks)):
+            model_result = self.model(input_ids, attention_mask=attention_mask)
+        # every head gets the output of all replicas, task k is the k-th slice
+        batch_size = input_ids.shape[0]
+        return tuple(head_result[0][k * batch_size:(k + 1) * batch_size]
+                     for k, head_result in enumerate(model_result.head_outputs))
+
+
+def export(model: nn.Module, tasks: list[str], dact_id2label: dict[int, str],
+           onnx_dir: str, opset: int = 17) -> None:
+    """
+    Export the dialogue act classifier and the slot taggers (one graph with
+    one output per task) with dynamic batch size and sequence length.
+    :param model: adapter model with the 'dact' adapter and the task adapters loaded
+    :param tasks: slot tagging tasks
+    :param dact_id2label: dialogue act labels
+    :param onnx_dir: output folder
+    :param opset: ONNX opset version
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = model.to('cpu')
+    # the exporter restores the training mode of the wrappers afterwards,
+    # which has to be eval mode, also for the wrapped model
+    dact_graph = _DactGraph(model).eval()
+    slots_graph = _SlotsGraph(model, tasks).eval()
+    # the example has padding, so that code paths of transformers that skip
+    # the attention mask when there is no padding are not traced
+    example = torch.ones((2, 8), dtype=torch.long)
+    example_mask = torch.ones_like(example)
+    example_mask[1, 5:] = 0
+    sequence_axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(dact_graph, (example, example_mask, torch.zeros_like(example)),
+                          os.path.join(onnx_dir, dact_file), dynamo=False,
+                          input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+                          output_names=['logits'],
+                          dynamic_axes={'input_ids': sequence_axes,
+                                        'attention_mask': sequence_axes,
+                                        'token_type_ids': sequence_axes,
+                                        'logits': {0: 'batch'}},
+                          opset_version=opset)
+        torch.onnx.export(slots_graph, (example, example_mask),
+                          os.path.join(onnx_dir, slots_file), dynamo=False,
+                          input_names=['input_ids', 'attention_mask'], output_names=tasks,
+                          dynamic_axes={'input_ids': sequence_axes,
+                                        'attention_mask': sequence_axes,
+                                        **{task: sequence_axes for task in tasks}},
+                          opset_version=opset)
+    with open(os.path.join(onnx_dir, labels_file), 'w') as f:
+        json.dump({'tasks': tasks, 'dact': dact_id2label}, f, ensure_ascii=False, indent=2)
+    logger.info(f"exported {dact_file} and {slots_file} to {onnx_dir}")
+
+
+class OnnxModel:
+    """
+    Runs the exported graphs with ONNX Runtime on the CPU, taking and
+    returning torch tensors like the corresponding torch code.
+    """
+
+    def __init__(self, onnx_dir: str, num_threads: int = 0):
+        """
+        :param onnx_dir: folder written by export()
+        :param num_threads: threads per inference, 0 for the ONNX Runtime default
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.dact_session = onnxruntime.InferenceSession(
+            os.path.join(onnx_dir, dact_file), options, providers=['CPUExecutionProvider'])
+        self.slots_session = onnxruntime.InferenceSession(
+            os.path.join(onnx_dir, slots_file), options, providers=['CPUExecutionProvider'])
+        with open(os.path.join(onnx_dir, labels_file)) as f:
+            labels = json.load(f)
+        self.tasks: list[str] = labels['tasks']
+        self.dact_id2label = {int(k): label for k, label in labels['dact'].items()}
+
+    def dact_logits(self, tensor: torch.Tensor, mask: torch.Tensor,
+                    token_type_ids: torch.Tensor | None = None) -> torch.Tensor:
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(tensor)
+        logits, = self.dact_session.run(None, {
+            'input_ids': tensor.cpu().numpy(),
+            'attention_mask': mask.cpu().numpy(),
+            'token_type_ids': token_type_ids.cpu().numpy()})
+        return torch.from_numpy(logits)
+
+    def slot_logits(self, tensor: torch.Tensor, mask: torch.Tensor) -> dict[str, torch.Tensor]:
+        outputs = self.slots_session.run(None, {'input_ids': tensor.cpu().numpy(),
+                                                'attention_mask': mask.cpu().numpy()})
+        return {task: torch.from_numpy(np.asarray(logits))
+                for task, logits in zip(self.tasks, outputs)}
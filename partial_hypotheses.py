@@ -0,0 +1,107 @@
+"""
+Tracking of partial speech recognition hypotheses, which are replaced by
+newer revisions of the same utterance within a few hundred milliseconds
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class HypothesisTracker:
+    """
+    The newest revision of every utterance (stream) of at most max_streams
+    streams, least recently updated streams are dropped first.
+
+    A hypothesis is superseded as soon as a newer revision of its stream
+    arrives, or when it arrives after a newer revision (stale). Superseded
+    hypotheses are dropped when they arrive stale, while they wait to be
+    stable for debounce_ms, or at the latest right before the model would
+    annotate them. Every dropped hypothesis is a saved inference.
+    """
+
+    def __init__(self, debounce_ms: float = 0.0, max_streams: int = 10000):
+        """
+        :param debounce_ms: time without a newer revision after which a
+            hypothesis is annotated, 0 for no debouncing
+        :param max_streams: maximal number of tracked streams
+        """
+        self.debounce = debounce_ms / 1000
+        self.max_streams = max_streams
+        # stream id -> newest revision, least recently updated first
+        self._revisions: OrderedDict[str, int] = OrderedDict()
+        self._changed = threading.Condition()
+        self._hypotheses = 0
+        self._annotated = 0
+        self._dropped = {'stale': 0, 'debounce': 0, 'queued': 0}
+
+    def submit(self, stream: str, revision: int) -> bool:
+        """
+        Register a hypothesis when it arrives.
+        :return: False if a newer revision of the stream arrived before, the
+            hypothesis is dropped as stale then and must not be checked again
+        """
+        with self._changed:
+            self._hypotheses += 1
+            if not self._current(stream, revision):
+                self._dropped['stale'] += 1
+                return False
+            self._revisions[stream] = revision
+            self._revisions.move_to_end(stream)
+            while len(self._revisions) > self.max_streams:
+                self._revisions.popitem(last=False)
+            # wake up the waiting older revisions
+            self._changed.notify_all()
+            return True
+
+    def _current(self, stream: str, revision: int) -> bool:
+        return self._revisions.get(stream, revision) <= revision
+
+    def wait_stable(self, stream: str, revision: int) -> bool:
+        """
+        Wait until the hypothesis has not been superseded for debounce_ms.
+        :return: False if it was superseded
+        """
+        if not self.debounce:
+            # superseded hypotheses are dropped by check()
+            return True
+        deadline = time.monotonic() + self.debounce
+        with self._changed:
+            while self._current(stream, revision):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self._changed.wait(remaining)
+            self._dropped['debounce'] += 1
+            return False
+
+    def check(self, stream: str, revision: int) -> bool:
+        """
+        Check a hypothesis right before it is annotated.
+        :return: False if it was superseded, it must not be annotated then
+        """
+        with self._changed:
+            if self._current(stream, revision):
+                self._annotated += 1
+                return True
+            self._dropped['queued'] += 1
+            return False
+
+    def dropped(self) -> dict[tuple[str], int]:
+        """
+        :return: number of dropped hypotheses per check they failed
+        """
+        with self._changed:
+            return {(when,): count for when, count in self._dropped.items()}
+
+    def stats(self) -> dict[str, float]:
+        with self._changed:
+            dropped = sum(self._dropped.values())
+            return {
+                'streams': len(self._revisions),
+                'debounce_ms': self.debounce * 1000,
+                'hypotheses': self._hypotheses,
+                'annotated': self._annotated,
+                **{f'dropped_{when}': count for when, count in self._dropped.items()},
+                'saved_fraction': dropped / self._hypotheses if self._hypotheses else 0.0,
+            }
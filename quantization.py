@@ -0,0 +1,62 @@
+"""
+Dynamic INT8 quantization of adapter models for CPU inference
+"""
+
+import io
+import logging
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__file__)
+
+
+def _plain_linear(module: nn.Linear) -> nn.Linear:
+    """
+    nn.Linear sharing the weights of a subclass of nn.Linear.
+    """
+    linear = nn.Linear(module.in_features, module.out_features, bias=module.bias is not None)
+    linear.weight = module.weight
+    linear.bias = module.bias
+    return linear
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Quantize the weights of all Linear layers of a model (base model,
+    adapters and heads) to INT8, in place. Activations are quantized
+    dynamically per batch, so no calibration data is needed. CPU only.
+
+    The adapters library replaces the attention projections of the base model
+    with LoRALinear layers, subclasses of nn.Linear that quantize_dynamic does
+    not match. As long as they hold no LoRA weights they compute a plain
+    linear layer and are swapped for one before quantizing.
+    :param model: model in eval mode on the CPU, with all adapters loaded
+    :return: the quantized model
+    """
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, nn.Linear) or type(module) is nn.Linear:
+            continue
+        if getattr(module, 'loras', None):
+            logger.warning(f"not quantizing {name}: it has LoRA weights")
+            continue
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, _plain_linear(module))
+        replaced += 1
+    torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8,
+                                           inplace=True)
+    quantized = sum(isinstance(module, torch.ao.nn.quantized.dynamic.Linear)
+                    for module in model.modules())
+    logger.info(f"quantized {quantized} linear layers ({replaced} LoRALinear layers)")
+    return model
+
+
+def model_size_mb(model: nn.Module) -> float:
+    """
+    Size of the serialized weights of a model in MB, including the packed
+    weights of quantized layers.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
@@ -0,0 +1,125 @@
+"""
+Profiling of single requests with the torch profiler
+"""
+
+import itertools
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+# there can only be one torch profiler running at a time
+_profiler_lock = threading.Lock()
+# set in the thread of the request being profiled
+_state = threading.local()
+_no_range = nullcontext()
+# numbers the profile files of this process
+_profile_numbers = itertools.count()
+
+# prefixes of the ranges of the stages and forward passes
+stage_prefix: str = "stage:"
+forward_prefix: str = "forward:"
+
+
+def profiling() -> bool:
+    """
+    :return: True if the current thread is profiling a request
+    """
+    return getattr(_state, 'active', False)
+
+
+def stage_range(name: str):
+    """
+    Named range of a stage (e.g. 'stage:tokenize') in the profile of the
+    current request, nothing when no request is being profiled.
+    """
+    return record_function(name) if profiling() else _no_range
+
+
+class RequestProfile:
+    """
+    Runs a block of code under the torch profiler, in the current thread only.
+    The stages and forward passes of the block are marked with stage_range(),
+    the profile has their times and the operators they called.
+
+    Usage:
+        request_profile = RequestProfile()
+        with request_profile:
+            ...
+        summary = request_profile.summary()
+        request_profile.write(log_dir, name)
+    """
+
+    def __init__(self, blocking: bool = True):
+        """
+        :param blocking: wait for another profile to finish, otherwise the
+            block runs without profiling (started is False then)
+        """
+        self.blocking = blocking
+        self.started = False
+        self.seconds = 0.0
+        self._profile: profile | None = None
+
+    def __enter__(self) -> 'RequestProfile':
+        self.started = _profiler_lock.acquire(blocking=self.blocking)
+        if self.started:
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self._profile = profile(activities=activities, record_shapes=True)
+            self._profile.__enter__()
+            _state.active = True
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.seconds = time.perf_counter() - self._start
+        if self.started:
+            _state.active = False
+            try:
+                self._profile.__exit__(*exc_info)
+            finally:
+                _profiler_lock.release()
+
+    def summary(self, top: int = 10) -> dict:
+        """
+        :param top: number of operators to list
+        :return: total time, time per stage and forward pass, and the
+            operators with the highest self time, all in milliseconds
+        """
+        events = self._profile.key_averages()
+        stages = {event.key[len(stage_prefix):]: round(event.cpu_time_total / 1000, 3)
+                  for event in events if event.key.startswith(stage_prefix)}
+        forward = {event.key[len(forward_prefix):]: round(event.cpu_time_total / 1000, 3)
+                   for event in events if event.key.startswith(forward_prefix)}
+        operators = sorted((event for event in events
+                            if not event.key.startswith((stage_prefix, forward_prefix))),
+                           key=lambda event: event.self_cpu_time_total, reverse=True)
+        return {
+            'total_ms': round(self.seconds * 1000, 3),
+            'stages_ms': stages,
+            'forward_ms': forward,
+            'top_operators': [{'name': event.key, 'calls': event.count,
+                               'self_cpu_ms': round(event.self_cpu_time_total / 1000, 3),
+                               'cpu_ms': round(event.cpu_time_total / 1000, 3)}
+                              for event in operators[:top]],
+        }
+
+    def write(self, log_dir: str, name: str) -> str:
+        """
+        Write the operator table and a trace that can be opened with
+        chrome://tracing or https://ui.perfetto.dev.
+        :param name: part of the file names, e.g. the process id
+        :return: path of the trace file, the table has the extension .txt
+        """
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(log_dir, f"profile_{time.strftime('%Y%m%d_%H%M%S')}_{name}_"
+                                     f"{next(_profile_numbers)}")
+        self._profile.export_chrome_trace(path + '.json')
+        with open(path + '.txt', 'w') as f:
+            f.write(self._profile.key_averages().table(sort_by='self_cpu_time_total',
+                                                        row_limit=30))
+        return path + '.json'
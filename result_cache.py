@@ -0,0 +1,141 @@
+"""
+In-process cache of annotation results
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Hashable
+
+
+class ResultCache:
+    """
+    LRU cache with a time-to-live for every entry. Requests for a key that
+    is being computed wait for that computation instead of starting their
+    own (single-flight).
+
+    Usage: get() returns a future and whether the caller owns the
+    computation. The owner has to compute the value and call put() or
+    fail() with the future, which also resolves it for all waiting
+    requests.
+
+    A request only waits for a computation whose owner is in the same or a
+    higher priority lane and has no earlier deadline, so that it is neither
+    delayed by a lower lane nor rejected for the deadline of another
+    request; otherwise it computes the value itself.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600.0):
+        """
+        :param max_entries: maximal number of cached results
+        :param ttl: seconds a result stays valid, 0 for no expiry
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        # per key: the computations in flight, with the generation, lane and
+        # deadline of their owners
+        self._inflight: dict[Hashable, list[tuple[Future, int, int, float | None]]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key: Hashable, lane: int = 0,
+            deadline: float | None = None) -> tuple[Future, bool]:
+        """
+        Look up a key.
+        :param lane: priority lane of the request, 0 for the highest
+        :param deadline: time.monotonic() by which the request has to be
+            done, None for no deadline
+        :return: future for the result, and True if the caller has to compute it
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if not self.ttl or time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    future: Future = Future()
+                    future.set_result(value)
+                    return future, False
+                del self._entries[key]
+                self._expirations += 1
+            for future, _, owner_lane, owner_deadline in self._inflight.get(key, ()):
+                if owner_lane <= lane and (owner_deadline is None or deadline is not None
+                                           and owner_deadline >= deadline):
+                    self._coalesced += 1
+                    return future, False
+            self._misses += 1
+            future = Future()
+            self._inflight.setdefault(key, []).append((future, self._generation, lane, deadline))
+            return future, True
+
+    def _land(self, key: Hashable, future: Future) -> int:
+        """
+        Remove a computation from the ones in flight.
+        :return: the generation it was started in
+        """
+        flights = self._inflight[key]
+        index = next(i for i, flight in enumerate(flights) if flight[0] is future)
+        generation = flights.pop(index)[1]
+        if not flights:
+            del self._inflight[key]
+        return generation
+
+    def put(self, key: Hashable, future: Future, value: Any) -> None:
+        """
+        Store the computed value of a key.
+        :param future: the future that get() returned to the owner
+        """
+        with self._lock:
+            generation = self._land(key, future)
+            # results computed before the last clear() are not cached
+            if generation == self._generation:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._evictions += 1
+        future.set_result(value)
+
+    def fail(self, key: Hashable, future: Future, error: BaseException) -> None:
+        """
+        Report that computing the value of a key failed.
+        :param future: the future that get() returned to the owner
+        """
+        with self._lock:
+            self._land(key, future)
+        future.set_exception(error)
+
+    def clear(self) -> None:
+        """
+        Drop all cached results, e.g. after the model has changed.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'inflight': sum(len(flights) for flights in self._inflight.values()),
+                'hits': self._hits,
+                'misses': self._misses,
+                'coalesced': self._coalesced,
+                'hit_rate': (self._hits + self._coalesced) / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
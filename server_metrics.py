@@ -0,0 +1,191 @@
+"""
+Counters, gauges and histograms in the Prometheus text exposition format
+"""
+
+import bisect
+import threading
+import time
+from typing import Callable, TypeVar
+
+# latency buckets in seconds, from half a millisecond to ten seconds
+latency_buckets: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                      0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    """
+    A metric with one series per combination of label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def exposition(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, e.g. of requests. With a function, the
+    count, or the counts per label values, is read from it when the metrics
+    are exported.
+    """
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 function: Callable[[], float | dict[tuple[str, ...], float]] | None = None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def exposition(self) -> list[str]:
+        if self.function:
+            value = self.function()
+            values = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.label_names, label_values)} "
+                                f"{_number(value)}" for label_values, value in values]
+
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down, e.g. requests in flight. With a function,
+    the value is read from it when the metrics are exported.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 function: Callable[[], float] | None = None):
+        super().__init__(name, documentation)
+        self.function = function
+        self._value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def exposition(self) -> list[str]:
+        value = self.function() if self.function else self._value
+        return self.header() + [f"{self.name} {_number(value)}"]
+
+
+class _Timer:
+    """
+    Context manager observing the seconds between entering and leaving it.
+    """
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram: 'Histogram', label_values: tuple[str, ...]):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> '_Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. latencies, counted in buckets with
+    fixed upper bounds, from which percentiles can be estimated.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = latency_buckets):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # per series: count per bucket (not cumulative, the last one is +Inf) and sum
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def time(self, *label_values: str) -> _Timer:
+        """
+        :return: context manager observing the time spent in it
+        """
+        return _Timer(self, label_values)
+
+    def exposition(self) -> list[str]:
+        with self._lock:
+            series = sorted((label_values, (list(counts), total[0]))
+                            for label_values, (counts, total) in self._series.items())
+        lines = self.header()
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip([*map(_number, self.buckets), '+Inf'], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, label_values, le)} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} "
+                         f"{_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} "
+                         f"{cumulative}")
+        return lines
+
+
+MetricType = TypeVar('MetricType', bound=_Metric)
+
+
+class Registry:
+    """
+    The metrics exported by one process.
+    """
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: MetricType) -> MetricType:
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
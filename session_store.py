@@ -0,0 +1,108 @@
+"""
+Last turns of dialogue sessions (e.g. radio channels), so that clients don't
+have to send the previous turn with every utterance
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+
+class Turn(NamedTuple):
+    text: str
+    speaker: str = ''
+    # utterance id of partial hypotheses, whose revisions replace each other
+    stream: str = ''
+
+
+class SessionStore:
+    """
+    The last turns of at most max_sessions sessions. The least recently used
+    session is dropped when a new one would exceed the limit, and sessions
+    without a turn for idle_timeout seconds are dropped as well. Every session
+    keeps at most max_turns turns of at most max_chars characters, so the
+    memory of the store is bounded. A turn with the same stream as the last
+    turn of its session is a new revision of it and replaces it.
+    """
+
+    def __init__(self, max_sessions: int = 10000, idle_timeout: float = 600.0,
+                 max_turns: int = 1, max_chars: int = 1000):
+        """
+        :param max_sessions: maximal number of sessions
+        :param idle_timeout: seconds after the last turn until a session is
+            dropped, 0 for no timeout
+        :param max_turns: number of turns kept per session
+        :param max_chars: maximal length of a kept turn, longer turns are cut
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        # session id -> (turns, time of the last turn), least recently used first
+        self._sessions: OrderedDict[str, tuple[deque, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _expire(self, now: float) -> None:
+        while self._sessions and self.idle_timeout:
+            _, last_turn = next(iter(self._sessions.values()))
+            if now - last_turn < self.idle_timeout:
+                break
+            self._sessions.popitem(last=False)
+            self._expirations += 1
+
+    def advance(self, session_id: str, turn: Turn) -> Turn | None:
+        """
+        Add the current turn of a session.
+        :return: the turn before, None for the first turn of a session
+        """
+        now = time.monotonic()
+        turn = turn._replace(text=turn.text[:self.max_chars],
+                             speaker=turn.speaker[:self.max_chars])
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                # one more, for the turn before a last turn that is replaced
+                turns: deque = deque(maxlen=self.max_turns + 1)
+                self._created += 1
+                if len(self._sessions) >= self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self._evictions += 1
+            else:
+                turns = session[0]
+            if turn.stream and turns and turns[-1].stream == turn.stream:
+                turns.pop()
+            previous = turns[-1] if turns else None
+            turns.append(turn)
+            self._sessions[session_id] = (turns, now)
+        return previous
+
+    def turns(self, session_id: str) -> list[Turn]:
+        """
+        :return: the kept turns of a session, oldest first
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            session = self._sessions.get(session_id)
+            return list(session[0])[-self.max_turns:] if session else []
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._sessions)
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'idle_timeout': self.idle_timeout,
+                'created': self._created,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+            }
@@ -0,0 +1,72 @@
+"""
+Vectorized decoding of BIO tagger predictions into word level phrases
+"""
+
+import torch
+
+
+def word_flags(predictions: torch.Tensor, word_ids: torch.Tensor, num_words: int,
+               begin_id: int, inside_id: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Merge subtoken labels into word labels for any number of tasks and lines
+    at once, with the rules of merge_labels: B overrides I, and I after O
+    becomes B. Words without subtokens get O.
+    :param predictions: label ids of the subtokens, shape (..., batch, sequence)
+    :param word_ids: word index of every subtoken, -1 for special tokens and
+        padding, shape (batch, sequence)
+    :param num_words: number of words of the longest line
+    :param begin_id: id of the B label
+    :param inside_id: id of the I label
+    :return: boolean tensors of shape (..., batch, num_words), True for words
+        labeled B and for words labeled B or I
+    """
+    # special tokens and padding are counted in an extra word that is dropped
+    index = torch.where(word_ids >= 0, word_ids, num_words).expand(predictions.shape)
+    shape = (*predictions.shape[:-1], num_words + 1)
+    has_begin = torch.zeros(shape, dtype=torch.long).scatter_add_(
+        -1, index, (predictions == begin_id).long())[..., :num_words] > 0
+    has_inside = torch.zeros(shape, dtype=torch.long).scatter_add_(
+        -1, index, (predictions == inside_id).long())[..., :num_words] > 0
+    in_phrase = has_begin | has_inside
+    # a merged word label is O exactly if none of its subtokens is B or I,
+    # so I starts a new phrase if the previous word is not in a phrase
+    previous_in_phrase = torch.zeros_like(in_phrase)
+    previous_in_phrase[..., 1:] = in_phrase[..., :-1]
+    begins = has_begin | (has_inside & ~previous_in_phrase)
+    return begins, in_phrase
+
+
+def word_labels(begins: torch.Tensor, in_phrase: torch.Tensor, begin_id: int,
+                inside_id: int, outside_id: int) -> torch.Tensor:
+    """
+    Label ids of the words from the output of word_flags.
+    """
+    labels = torch.full(begins.shape, outside_id, dtype=torch.long)
+    labels[in_phrase] = inside_id
+    labels[begins] = begin_id
+    return labels
+
+
+def decode_spans(predictions: torch.Tensor, word_ids: torch.Tensor, num_words: int,
+                 begin_id: int, inside_id: int) -> torch.Tensor:
+    """
+    Find the phrases of BIO tagger predictions as word index ranges.
+    :param predictions: label ids of the subtokens, shape (..., batch, sequence)
+    :param word_ids: word index of every subtoken, -1 for special tokens and
+        padding, shape (batch, sequence)
+    :param num_words: number of words of the longest line
+    :param begin_id: id of the B label
+    :param inside_id: id of the I label
+    :return: one row per phrase with the leading indices of predictions (e.g.
+        task and line), the first word and the word after the last word,
+        ordered by the leading indices and the first word
+    """
+    begins, in_phrase = word_flags(predictions, word_ids, num_words, begin_id, inside_id)
+    # a phrase ends at a word in a phrase that is not followed by a word
+    # continuing it
+    continues = in_phrase & ~begins
+    next_continues = torch.zeros_like(continues)
+    next_continues[..., :-1] = continues[..., 1:]
+    starts = begins.nonzero()
+    ends = (in_phrase & ~next_continues).nonzero()[:, -1:] + 1
+    return torch.cat([starts, ends], dim=1)
@@ -0,0 +1,116 @@
+"""
+WebSocket streaming of utterances and their annotations, one connection per
+radio channel
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from aiohttp import WSMsgType, web
+
+logger = logging.getLogger(__file__)
+
+
+class StreamServer:
+    """
+    asyncio server with a WebSocket endpoint /stream/<channel>, running its
+    event loop in a thread of its own next to the WSGI server.
+
+    Clients send one JSON object per message, the same as a line of
+    /annotate_batch, and get one annotation per utterance back, in the same
+    order, as soon as it is done. The annotations are computed in a thread
+    pool shared by all connections, so the event loop never waits for the
+    model.
+
+    Backpressure: at most max_pending utterances per connection are being
+    annotated or waiting to be sent. When a client sends faster than its
+    utterances are annotated, or reads the annotations slower, the server
+    stops reading from its connection until it has caught up.
+    """
+
+    def __init__(self, annotate: Callable[[Any], dict], parse: Callable[[str, str], Any],
+                 ready: threading.Event, threads: int = 4, max_pending: int = 16):
+        """
+        :param annotate: function computing the annotation of a parsed utterance
+        :param parse: function converting a message and the channel it was
+            sent on into an utterance to annotate, or into an error message
+            string for invalid messages
+        :param ready: set when the model can be used, connections are closed
+            before
+        :param threads: number of threads annotating utterances of all connections
+        :param max_pending: maximal number of pending utterances per connection
+        """
+        self.annotate = annotate
+        self.parse = parse
+        self.ready = ready
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='stream')
+        self.connections = 0
+
+    async def _send(self, ws: web.WebSocketResponse, pending: asyncio.Queue) -> None:
+        while True:
+            result = await pending.get()
+            try:
+                annotation = await result
+            except Exception as e:
+                logger.error(e)
+                annotation = {'error': str(e)}
+            await ws.send_str(json.dumps(annotation))
+
+    async def _handle(self, request: web.Request) -> web.WebSocketResponse:
+        channel = request.match_info['channel']
+        ws = web.WebSocketResponse(heartbeat=30.0)
+        await ws.prepare(request)
+        if not self.ready.is_set():
+            # 1013: try again later
+            await ws.close(code=1013, message=b"model is loading")
+            return ws
+        loop = asyncio.get_running_loop()
+        pending: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+        sender = asyncio.create_task(self._send(ws, pending))
+        self.connections += 1
+        logger.info(f"channel {channel} connected")
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                item = self.parse(message.data, channel)
+                if isinstance(item, str):
+                    result = loop.create_future()
+                    result.set_result({'error': item})
+                else:
+                    result = loop.run_in_executor(self.executor, self.annotate, item)
+                # waits while the client is max_pending utterances behind
+                await pending.put(result)
+        finally:
+            self.connections -= 1
+            sender.cancel()
+            # don't annotate utterances nobody is waiting for any more
+            while not pending.empty():
+                pending.get_nowait().cancel()
+            logger.info(f"channel {channel} disconnected")
+        return ws
+
+    def _run(self, sock: socket.socket) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get('/stream/{channel}', self._handle)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.SockSite(runner, sock).start())
+        loop.run_forever()
+
+    def start(self, sock: socket.socket) -> None:
+        """
+        Serve WebSocket connections on a listening socket, in a new thread.
+        """
+        threading.Thread(target=self._run, args=(sock,), name='stream-server',
+                         daemon=True).start()
+        logger.info(f"streaming on ws://{sock.getsockname()[0]}:{sock.getsockname()[1]}"
+                    f"/stream/<channel>")
@@ -4,9 +4,9 @@ send() {
     curl -G --data-urlencode 'text=Wassertrupp jetzt mit dem Rollschlauch zur Brandbekämpfung vorangehen!' --data-urlencode 'prev_text=Truppführer hört' 'http://localhost:5050/annotate' 2>/dev/null
 }
 
-is_alive() {
-    res=`curl http://localhost:5050/alive 2>/dev/null`
-    test "$res" = 'tag server is alive'
+is_ready() {
+    res=`curl http://localhost:5050/ready 2>/dev/null`
+    test "$res" = 'tag server is ready'
 }
 
 get_pid() {
@@ -15,12 +15,12 @@ get_pid() {
 
 if docker images 2>&1 | grep -q drz_daslot; then
     DOCKER_ARGS="--rm -d --name 'test_drzintent'" ./run_docker.sh >/dev/null 2>/dev/null
-    until is_alive; do
+    until is_ready; do
         sleep 3
     done
 else
     uv run adapters_bio_tags_server.py >logs/test.log 2>&1 &
-    until is_alive; do
+    until is_ready; do
         sleep 3
     done
 fi
@@ -0,0 +1,139 @@
+"""
+Pre-fork worker processes sharing the model loaded by the parent process
+"""
+
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__file__)
+
+
+def process_memory(pid: int) -> dict[str, float]:
+    """
+    Memory usage of a process in MB (Linux only). PSS divides shared pages
+    among the processes sharing them, so the PSS of all workers adds up to
+    the memory they really use. USS is the memory the process does not share.
+    :return: rss, pss and uss, empty if the values are not available
+    """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[key] = int(value.split()[0]) / 1024
+    except OSError:
+        return {}
+    return {'rss_mb': memory.get('Rss', 0.0), 'pss_mb': memory.get('Pss', 0.0),
+            'uss_mb': memory.get('Private_Clean', 0.0) + memory.get('Private_Dirty', 0.0)}
+
+
+class WorkerPool:
+    """
+    Forks worker processes after the model has been loaded, so that all
+    workers share the memory of the model weights copy-on-write. The parent
+    process only supervises the workers and restarts those that die.
+    """
+
+    def __init__(self, num_workers: int, run_worker: Callable[[], None],
+                 init_worker: Callable[[], None] | None = None):
+        """
+        :param num_workers: number of worker processes
+        :param run_worker: function that serves requests in a worker process
+        :param init_worker: function run in every worker process before
+            run_worker, for everything that must not exist before the fork,
+            e.g. the thread pools of torch (optional)
+        """
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.init_worker = init_worker
+        # index of the current worker, None in the parent process
+        self.index: int | None = None
+        self._pids = multiprocessing.Array('i', num_workers, lock=False)
+        self._requests = multiprocessing.Array('q', num_workers, lock=False)
+        self._started = multiprocessing.Array('d', num_workers, lock=False)
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def count_requests(self, n: int = 1) -> None:
+        """
+        Add n to the request counter of the current worker.
+        """
+        if self.index is not None:
+            with self._lock:
+                self._requests[self.index] += n
+
+    def report(self) -> list[dict[str, float]]:
+        """
+        Memory and throughput of all workers.
+        """
+        report = []
+        now = time.time()
+        for i in range(self.num_workers):
+            uptime = now - self._started[i]
+            report.append({
+                'worker': i,
+                'pid': self._pids[i],
+                'requests': self._requests[i],
+                'requests_per_sec': self._requests[i] / uptime if uptime > 0 else 0.0,
+                **process_memory(self._pids[i]),
+            })
+        return report
+
+    def _fork(self, index: int) -> None:
+        pid = os.fork()
+        if pid:
+            self._pids[index] = pid
+            return
+        # worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.index = index
+        self._requests[index] = 0
+        self._started[index] = time.time()
+        try:
+            if self.init_worker:
+                self.init_worker()
+            self.run_worker()
+        except Exception as e:
+            logger.exception(e)
+            os._exit(1)
+        os._exit(0)
+
+    def _stop(self, signum, frame) -> None:
+        self._stopping = True
+        for pid in self._pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self) -> None:
+        """
+        Fork the workers and wait for them, restarting workers that die.
+        """
+        # keep the garbage collector from touching (and thereby copying) the
+        # pages of the objects that already exist
+        gc.collect()
+        gc.freeze()
+        for i in range(self.num_workers):
+            self._fork(i)
+        logger.info(f"started {self.num_workers} workers: {list(self._pids)}")
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while True:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if self._stopping:
+                continue
+            index = list(self._pids).index(pid)
+            logger.error(f"worker {index} (pid {pid}) died with status {status}, restarting")
+            self._fork(index)